@@ -0,0 +1,83 @@
+import asyncio
+import functools
+from collections.abc import Callable
+from contextvars import ContextVar
+from time import perf_counter
+
+from fastapi import Request, Response
+from fastapi.exceptions import HTTPException, RequestValidationError
+from fastapi.routing import APIRoute
+
+from app.profiling import PROFILE_ID_HEADER, is_admin, profile_requested, profiles
+from metrics import REQUEST_DURATION, REQUESTS, STAGE_DURATION, Stage
+
+# Moment the endpoint function returned, what happens after it until the response is ready is serialization
+_endpoint_returned_at: ContextVar[float | None] = ContextVar("endpoint_returned_at", default=None)
+
+
+def _record_return_time(endpoint: Callable) -> Callable:
+    if not asyncio.iscoroutinefunction(endpoint):
+        return endpoint
+
+    # FastAPI follows __wrapped__ to read the parameters and return annotation of the endpoint
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        result = None
+        try:
+            result = await endpoint(*args, **kwargs)
+            return result
+        finally:
+            # An endpoint that returns a Response has encoded it already, and times that itself
+            if not isinstance(result, Response):
+                _endpoint_returned_at.set(perf_counter())
+
+    return wrapper
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Route that counts requests by status and records their duration and the time spent serializing the response.
+
+    The route template rather than the requested path is used as label, to keep the amount of series bounded.
+    Requests are also profiled here when asked for, or when sampled, see `app.profiling`.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _record_return_time(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def instrumented_handler(request: Request) -> Response:
+            requested = profile_requested(request)
+            if requested and not is_admin(request):
+                raise HTTPException(status_code=403, detail="Profiling a request requires the admin token")
+            profiler = profiles.try_start(requested=requested)
+
+            start = perf_counter()
+            _endpoint_returned_at.set(None)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            finally:
+                end = perf_counter()
+                REQUESTS.inc(request.method, self.path, str(status))
+                REQUEST_DURATION.observe(end - start, request.method, self.path)
+                if profiler is not None:
+                    profile = profiles.finish(profiler, request, requested=requested)
+
+            returned_at = _endpoint_returned_at.get()
+            if returned_at is not None:
+                STAGE_DURATION.observe(end - returned_at, Stage.SERIALIZATION)
+            if requested:
+                response.headers[PROFILE_ID_HEADER] = profile.id
+            return response
+
+        return instrumented_handler
@@ -1,10 +1,35 @@
+import asyncio
+import contextlib
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from app.resources import resources
+from app.routers import admin, art
+from config import settings
+from metrics import REGISTRY
+
 
-from app.routers import art
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    if settings.metrics_dir is not None:
+        REGISTRY.share(settings.metrics_dir, settings.metrics_snapshot_interval)
+    # Models are loaded in the background, so the server binds right away and reports readiness on /ready
+    loading = asyncio.create_task(resources.load())
+    yield
 
-app = FastAPI()
+    loading.cancel()
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        await loading
+    await resources.close()
+    REGISTRY.stop_sharing()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(art.router)
+app.include_router(admin.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,3 +43,21 @@ app.add_middleware(
 @app.get("/health", tags=["general"])
 def health():
     return "ok"
+
+
+@app.get("/ready", tags=["general"])
+def ready():
+    if not resources.ready:
+        return JSONResponse(status_code=503, content="loading")
+    return "ok"
+
+
+@app.get("/metrics", tags=["general"], response_class=PlainTextResponse)
+def metrics():
+    """
+    Request counts, per stage latency histograms and cache hit ratios in the Prometheus text format.
+
+    With several workers the counts and histograms are the totals of all workers, while the cache hit
+    ratios are those of the worker that answers.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,169 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import uuid
+from collections import Counter, deque
+from time import perf_counter, time
+from types import FrameType
+
+from fastapi import Request
+
+from config import settings
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"  # noqa: S105
+
+# Explicitly requested profiles that are kept until they are fetched or pushed out
+MAX_REQUESTED_PROFILES = 20
+# Threads of pools that wait for work are left out of samples, unless they are the event loop thread
+IDLE_FUNCTIONS = {"wait", "get", "_wait_for_tstate_lock", "_worker", "select", "poll"}
+
+
+def is_admin(request: Request) -> bool:
+    token = request.headers.get(ADMIN_TOKEN_HEADER)
+    return settings.admin_token is not None and token is not None and hmac.compare_digest(token, settings.admin_token)
+
+
+def profile_requested(request: Request) -> bool:
+    return request.headers.get(PROFILE_HEADER) == "1" or request.query_params.get("profile") == "true"
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{code.co_qualname}"
+
+
+class Profile:
+    """Stack samples of one request, which render as collapsed stacks that flamegraph tools read."""
+
+    def __init__(self, method: str, path: str, query: str, duration: float, samples: Counter[str]):
+        self.id = uuid.uuid4().hex
+        self.created_at = time()
+        self.method = method
+        self.path = path
+        self.query = query
+        self.duration = duration
+        self.samples = samples
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "created_at": self.created_at,
+            "method": self.method,
+            "path": self.path,
+            "query": self.query,
+            "duration": self.duration,
+            "samples": sum(self.samples.values()),
+            # Profiles are kept in the worker process that handled the request
+            "worker_pid": os.getpid(),
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class SamplingProfiler:
+    """
+    Sample the Python stacks of all threads from a background thread while a request is handled.
+
+    Unlike a deterministic profiler this adds no overhead to the profiled code itself. Every sample
+    holds the stack of the event loop thread, which runs the request, and of the worker threads
+    that are busy, so work the request hands to executors shows up as well. Other requests that
+    run at the same time are sampled too.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> "SamplingProfiler":
+        self._start = perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self, request: Request) -> Profile:
+        duration = perf_counter() - self._start
+        self._stopped.set()
+        self._thread.join()
+        return Profile(request.method, request.url.path, request.url.query, duration, self.samples)
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():  # noqa: SLF001
+            if thread_id == own_id:
+                continue
+            if thread_id != self._loop_thread_id and frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+
+            stack = []
+            current: FrameType | None = frame
+            while current is not None:
+                stack.append(_frame_name(current))
+                current = current.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+
+class ProfileStore:
+    """Requested profiles, and the slowest of those taken in the background, kept in memory."""
+
+    def __init__(self, keep_slowest: int, max_concurrent: int):
+        self.keep_slowest = keep_slowest
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self._requested: deque[Profile] = deque(maxlen=MAX_REQUESTED_PROFILES)
+        self._slowest: list[Profile] = []
+        self._lock = threading.Lock()
+
+    def try_start(self, *, requested: bool) -> SamplingProfiler | None:
+        """Start a profiler for a request that asked for it, or for a sampled fraction of all requests."""
+        sampled = random.random() < settings.profile_sample_rate  # noqa: S311
+        if not requested and not sampled:
+            return None
+
+        with self._lock:
+            # Background profiles are skipped under load, a requested profile always runs
+            if not requested and self.active >= self.max_concurrent:
+                return None
+            self.active += 1
+
+        return SamplingProfiler(settings.profile_interval_ms / 1000).start()
+
+    def finish(self, profiler: SamplingProfiler, request: Request, *, requested: bool) -> Profile:
+        profile = profiler.stop(request)
+        with self._lock:
+            self.active -= 1
+            if requested:
+                self._requested.append(profile)
+            else:
+                self._slowest.append(profile)
+                self._slowest.sort(key=lambda slow_profile: slow_profile.duration, reverse=True)
+                del self._slowest[self.keep_slowest :]
+        return profile
+
+    def get(self, profile_id: str) -> Profile | None:
+        with self._lock:
+            return next((profile for profile in (*self._requested, *self._slowest) if profile.id == profile_id), None)
+
+    def summaries(self) -> dict[str, list[dict]]:
+        with self._lock:
+            return {
+                "requested": [profile.summary() for profile in reversed(self._requested)],
+                "slowest": [profile.summary() for profile in self._slowest],
+            }
+
+
+profiles = ProfileStore(keep_slowest=settings.profile_keep_slowest, max_concurrent=settings.profile_max_concurrent)
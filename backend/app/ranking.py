@@ -0,0 +1,23 @@
+from config import settings
+from db.crud import ArtObjectWithCoords
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[ArtObjectWithCoords]], top_k: int, k: int = settings.hybrid_rrf_k
+) -> list[ArtObjectWithCoords]:
+    """
+    Merge several rankings of ArtObjects by summing `1 / (k + rank)` over the rankings each ArtObject appears in.
+
+    Only ranks are used, so rankings with incomparable scores, like text search ranks and cosine
+    distances, can be combined. ArtObjects with equal scores keep the order in which they were first seen.
+    """
+    scores: dict[int, float] = {}
+    rows: dict[int, ArtObjectWithCoords] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            art_object_id = row[0].id
+            scores[art_object_id] = scores.get(art_object_id, 0.0) + 1 / (k + rank)
+            rows.setdefault(art_object_id, row)
+
+    best_ids = sorted(scores, key=scores.__getitem__, reverse=True)[:top_k]
+    return [rows[art_object_id] for art_object_id in best_ids]
@@ -0,0 +1,285 @@
+import asyncio
+import gc
+import os
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from fastapi.exceptions import HTTPException
+from loguru import logger
+from sqlalchemy import text
+
+from app.result_cache import ResultCache
+from config import EmbedderBackend, SearchBackend, settings
+from db.async_crud import async_engine, retrieve_dataset_version
+from etl.embed.batching import BatchingTextEmbedder
+from etl.embed.cache import CachedTextEmbedder
+from metrics import REGISTRY
+
+if TYPE_CHECKING:
+    from etl.dim_reduc import LinearProjection
+    from etl.embed.models import TextEmbedder
+    from etl.embed.onnx_models import OnnxTextEmbedder
+
+WARMUP_TEXTS = ["a portrait of a woman dressed in black", "sunflowers in a vase", "a stormy sea with sailing ships"]
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Log how long a startup phase took."""
+    start = perf_counter()
+    logger.info(f"Startup phase '{phase}' started.")
+    yield
+    logger.info(f"Startup phase '{phase}' done in {perf_counter() - start:.3f} seconds.")
+
+
+def inference_threads() -> int | None:
+    """Intra-op threads for model inference in this worker, None leaves it to the runtime."""
+    if settings.inference_threads:
+        return settings.inference_threads
+    if settings.serve_workers > 1:
+        # Without dividing the cores, every worker's runtime starts a thread per core and they all compete
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        return max(1, cores // settings.serve_workers)
+    return None
+
+
+def load_text_embedder():
+    """Load the text embedder of the configured backend, importing torch only when it is needed."""
+    if settings.embedder_backend == EmbedderBackend.ONNX:
+        from etl.embed.onnx_models import get_onnx_text_embedder
+
+        return get_onnx_text_embedder(intra_op_threads=settings.onnx_intra_op_threads or inference_threads() or 0)
+
+    from etl.embed.models import TextEmbedder
+
+    return TextEmbedder(device="cpu")
+
+
+class Resources:
+    """
+    Models and other heavy state of the API, loaded in the background after the server has started.
+
+    Until loading and warmup are done, `ready` is False and the search routes answer with a 503,
+    while `/health` already reports the process as alive.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.base_text_embedder: TextEmbedder | OnnxTextEmbedder | None = None
+        self.batching_text_embedder: BatchingTextEmbedder | None = None
+        self.text_embedder: CachedTextEmbedder | None = None
+        self.projection: LinearProjection | None = None
+        self.result_cache = ResultCache(
+            max_size=settings.result_cache_size,
+            redis_url=settings.result_cache_redis_url,
+            shared_ttl=settings.result_cache_shared_ttl,
+        )
+        self._version_poller: asyncio.Task | None = None
+        # Modification time of the PCA file the projection was loaded from
+        self._projection_mtime: float | None = None
+        # Intra-op threads torch would have used, before `preload` limited the server process to one
+        self._torch_threads: int | None = None
+        # Model inference is CPU bound, so it runs on its own threads instead of blocking the event loop
+        self.inference_executor = ThreadPoolExecutor(
+            max_workers=settings.inference_workers, thread_name_prefix="inference"
+        )
+
+    def _load_shared(self, *, forking: bool = False) -> None:
+        """Load the models and vector data that are only read after loading, skipping what is already loaded."""
+        # An ONNX Runtime session starts its thread pool when it is created, which does not survive a fork
+        if self.base_text_embedder is None and not (forking and settings.embedder_backend == EmbedderBackend.ONNX):
+            with timed("load text embedder"):
+                self.base_text_embedder = load_text_embedder()
+
+        if self.projection is None:
+            with timed("load projection"):
+                self._load_projection()
+
+        # The shard worker processes and their pipes belong to the process that started them
+        if settings.search_backend == SearchBackend.MEMMAP or (
+            settings.search_backend == SearchBackend.SHARDED and not forking
+        ):
+            with timed("load vector snapshot"):
+                from db.vector_store import get_vector_store
+
+                get_vector_store()
+
+    def _load_projection(self) -> None:
+        from etl.dim_reduc import PCA_PATH, LinearProjection, load_pca
+
+        # Read before loading, so a refit that is written in the meantime is picked up by the next reload
+        self._projection_mtime = PCA_PATH.stat().st_mtime
+        self.projection = LinearProjection.from_pipeline(load_pca())
+
+    def _reload_refitted_projection(self) -> None:
+        from etl.dim_reduc import PCA_PATH
+
+        if PCA_PATH.stat().st_mtime != self._projection_mtime:
+            with timed("reload projection"):
+                self._load_projection()
+
+    def preload(self) -> None:
+        """
+        Load the models and vector data in the server process, before it forks the workers.
+
+        The workers then share the physical memory of the weights and vectors, which is only copied
+        for pages that are written to. Nothing is run on the models and no threads are started here,
+        as the thread pools of the inference runtimes are not carried over into forked processes.
+
+        Loading the torch weights can still run operators, which would start the OpenMP thread pool of
+        libgomp. A child forked after that hangs in its first parallel region, since it inherits the state
+        of the pool but none of its threads. With a single intra-op thread, OpenMP never starts a pool, so
+        that is safe to fork. The workers set their own amount of threads before they run the models.
+        """
+        if settings.embedder_backend == EmbedderBackend.TORCH:
+            import torch
+
+            self._torch_threads = torch.get_num_threads()
+            torch.set_num_threads(1)
+
+        self._load_shared(forking=True)
+        # Collections write to the headers of every tracked object, which would copy their pages into each worker
+        gc.freeze()
+
+    def _load_models(self) -> None:
+        if settings.embedder_backend == EmbedderBackend.TORCH and (
+            threads := inference_threads() or self._torch_threads
+        ):
+            import torch
+
+            torch.set_num_threads(threads)
+
+        self._load_shared()
+        self.batching_text_embedder = BatchingTextEmbedder(
+            self.base_text_embedder,
+            max_batch_size=settings.text_embedding_max_batch_size,
+            max_wait_ms=settings.text_embedding_max_wait_ms,
+        )
+
+        with timed("load text embedding cache"):
+            self.text_embedder = CachedTextEmbedder(
+                self.batching_text_embedder,
+                max_size=settings.text_embedding_cache_size,
+                ttl=settings.text_embedding_cache_ttl,
+                persist_path=settings.text_embedding_cache_path,
+            )
+
+    def _warmup_models(self) -> None:
+        """Run the models on sample inputs, so the first requests do not pay for one-time initialisation."""
+        text_embedder = self.base_text_embedder
+        for _ in range(settings.warmup_iterations):
+            # Both the single query and the batched code paths are exercised
+            for sample in WARMUP_TEXTS:
+                text_embedder(sample)
+            text_embedder(WARMUP_TEXTS)
+
+        if settings.search_backend != SearchBackend.PGVECTOR:
+            from db.vector_store import get_vector_store
+
+            store = get_vector_store()
+            if len(store):
+                store.search(store.get_vector(int(store.ids[0])), 1)
+
+    async def _warmup_database(self) -> None:
+        # Open the connections the pool keeps, so requests do not wait on connection setup
+        connections = [await async_engine.connect() for _ in range(settings.db_pool_size)]
+        for connection in connections:
+            await connection.execute(text("SELECT 1"))
+            await connection.close()
+
+    def cache_metrics(self) -> list[str]:
+        """Hits and misses of the caches, rendered at scrape time since the caches count them already."""
+        caches = {"result": self.result_cache.stats}
+        if self.text_embedder is not None:
+            caches["text_embedding"] = self.text_embedder.stats
+
+        lines = []
+        for kind in ("hits", "misses"):
+            name = f"sem_art_search_cache_{kind}_total"
+            lines += [f"# HELP {name} Cache {kind}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{cache="{cache}"}} {stats[kind]}' for cache, stats in caches.items()]
+
+        name = "sem_art_search_cache_hit_ratio"
+        lines += [f"# HELP {name} Fraction of cache lookups that were hits", f"# TYPE {name} gauge"]
+        for cache, stats in caches.items():
+            lookups = stats["hits"] + stats["misses"]
+            lines.append(f'{name}{{cache="{cache}"}} {stats["hits"] / lookups if lookups else 0.0}')
+        return lines
+
+    async def _poll_dataset_version(self) -> None:
+        """
+        Keep the result cache on the current dataset version, bypassing it while the version is unknown.
+
+        Refitting the projection bumps the version as well, so whenever the version changes, the projection
+        is reloaded if its file was rewritten. Otherwise query coordinates would be computed with the old
+        projection, while the stored coordinates of ArtObjects come from the new one.
+        """
+        version = None
+        while True:
+            try:
+                current = await retrieve_dataset_version()
+                if version is not None and current != version:
+                    await asyncio.to_thread(self._reload_refitted_projection)
+                version = current
+                self.result_cache.set_version(version)
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"Could not follow the dataset version, bypassing the result cache: {e}")
+                self.result_cache.set_version(None)
+            await asyncio.sleep(settings.dataset_version_poll_interval)
+
+    async def load(self) -> None:
+        start = perf_counter()
+        try:
+            await asyncio.to_thread(self._load_models)
+
+            if settings.warmup_iterations:
+                with timed("warmup models"):
+                    await asyncio.to_thread(self._warmup_models)
+                with timed("warmup database pool"):
+                    await self._warmup_database()
+        except Exception:
+            logger.exception("Loading the API resources failed, the API will not become ready.")
+            raise
+
+        self._version_poller = asyncio.create_task(self._poll_dataset_version())
+
+        self.ready = True
+        logger.info(f"API ready after {perf_counter() - start:.3f} seconds.")
+
+    async def close(self) -> None:
+        self.ready = False
+        if self._version_poller is not None:
+            self._version_poller.cancel()
+        self.inference_executor.shutdown()
+
+        if self.batching_text_embedder is not None:
+            self.batching_text_embedder.close()
+
+        if self.text_embedder is not None:
+            logger.info(f"Text embedding cache stats: {self.text_embedder.stats}")
+            if self.text_embedder.persist_path is not None:
+                self.text_embedder.save()
+
+        if settings.search_backend == SearchBackend.SHARDED:
+            from db.vector_store import get_vector_store
+
+            if get_vector_store.cache_info().currsize:
+                get_vector_store().close()
+
+        logger.info(f"Result cache stats: {self.result_cache.stats}")
+        await self.result_cache.close()
+        await async_engine.dispose()
+
+
+resources = Resources()
+REGISTRY.register_collector(resources.cache_metrics)
+
+
+def get_resources() -> Resources:
+    """Dependency for routes that need the loaded models."""
+    if not resources.ready:
+        raise HTTPException(status_code=503, detail="The API is still starting up")
+    return resources
@@ -0,0 +1,116 @@
+import json
+from collections import OrderedDict
+from typing import Any
+
+from loguru import logger
+
+SHARED_KEY_PREFIX = "sem-art-search:results"
+
+# A cache key starts with the dataset version it was made for, followed by the request parameters
+CacheKey = tuple
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of encoded API responses, valid for a single dataset version.
+
+    Keys include the dataset version that was current when the request came in, so a bump of the version in the
+    database makes all existing entries unreachable, rather than having them expire after a guessed TTL. With a
+    Redis url, responses are also stored in Redis, which shares them between workers and API instances.
+
+    The cache is only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_size: int = 10000, redis_url: str | None = None, shared_ttl: int = 24 * 60 * 60):
+        self.max_size = max_size
+        self.shared_ttl = shared_ttl
+        # None until the dataset version has been read from the database, the cache is bypassed until then
+        self.version: int | None = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[CacheKey, bytes] = OrderedDict()
+        self._redis = None
+        if redis_url is not None:
+            import redis.asyncio
+
+            self._redis = redis.asyncio.from_url(redis_url)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def set_version(self, version: int | None) -> None:
+        """Switch to a new dataset version, dropping the entries of the previous one."""
+        if version == self.version:
+            return
+
+        logger.info(f"Dataset version changed from {self.version} to {version}, clearing {len(self)} cached results.")
+        self.version = version
+        self._entries.clear()
+
+    def key(self, *params: Any) -> CacheKey | None:
+        """Cache key for a request with the given parameters, None when results should not be cached."""
+        if self.version is None or not self.max_size:
+            return None
+        return (self.version, *params)
+
+    def _shared_key(self, key: CacheKey) -> str:
+        return f"{SHARED_KEY_PREFIX}:{json.dumps(key)}"
+
+    async def get(self, key: CacheKey | None) -> bytes | None:
+        """Look up an encoded response, first in this process and then in the shared cache."""
+        if key is None:
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        if self._redis is not None:
+            try:
+                payload = await self._redis.get(self._shared_key(key))
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"Could not read from the shared result cache: {e}")
+                payload = None
+
+            if payload is not None:
+                self.hits += 1
+                self._put_local(key, payload)
+                return payload
+
+        self.misses += 1
+        return None
+
+    def _put_local(self, key: CacheKey, payload: bytes) -> None:
+        # A shared entry can be read while the version changes
+        if key[0] != self.version:
+            return
+
+        self._entries[key] = payload
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def put(self, key: CacheKey | None, payload: bytes) -> None:
+        # Results computed while the version changed belong to the old version, other workers may have moved on
+        # already, so they are stored neither here nor in the shared cache
+        if key is None or key[0] != self.version:
+            return
+
+        self._put_local(key, payload)
+
+        if self._redis is not None:
+            try:
+                await self._redis.set(self._shared_key(key), payload, ex=self.shared_ttl)
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"Could not write to the shared result cache: {e}")
+
+    async def close(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
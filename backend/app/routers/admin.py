@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.profiling import is_admin, profiles
+
+
+def require_admin(request: Request) -> None:
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="A valid admin token is required")
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@router.get("/profiles", tags=["admin"])
+def list_profiles() -> dict[str, list[dict]]:
+    """
+    Summaries of the requested profiles, newest first, and of the slowest background profiles.
+
+    Every worker process keeps its own profiles, so with several workers this lists only those of the
+    worker that handles this request, and a profile can only be fetched from the worker that recorded it.
+    """
+    return profiles.summaries()
+
+
+@router.get("/profiles/{profile_id}", tags=["admin"], response_class=PlainTextResponse)
+def get_profile(profile_id: str):
+    """
+    A profile as collapsed stacks, one `frame;frame;frame count` line per stack, e.g. for flamegraph.pl or speedscope.
+    """
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(profile.collapsed())
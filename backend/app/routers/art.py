@@ -1,82 +1,269 @@
-from typing import Annotated
+import asyncio
+from enum import StrEnum
+from typing import Annotated, Any
 
 import numpy as np
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Depends, Query, Request, Response
 from fastapi.exceptions import HTTPException
+from loguru import logger
+from pydantic import TypeAdapter
 
-from db.crud import retrieve_best_image_match_w_embedding, retrieve_closest_to_artobject
-from db.models import ArtObjectsWithCoord, ArtQueryWithCoordsResponse
-from etl.dim_reduc import get_embedding_coordinates, load_pca
-from etl.embed.models import TextEmbedder
+from app.instrumentation import InstrumentedRoute
+from app.profiling import profile_requested
+from app.ranking import reciprocal_rank_fusion
+from app.resources import Resources, get_resources
+from app.result_cache import CacheKey
+from config import HNSW_MAX_EF_SEARCH, settings
+from db.async_crud import (
+    retrieve_best_image_match_w_embedding,
+    retrieve_best_image_matches_w_embeddings,
+    retrieve_closest_to_artobject,
+    retrieve_closest_to_artobjects,
+    retrieve_embeddings_by_ids,
+    retrieve_lexical_matches,
+)
+from db.crud import ArtObjectWithCoords
+from db.models import (
+    ArtObjectFilter,
+    ArtObjectNeighboursRequest,
+    ArtObjects,
+    ArtObjectsColumns,
+    ArtObjectsWithCoord,
+    ArtQueryBatchRequest,
+    ArtQueryColumnsResponse,
+    ArtQueryWithCoordsResponse,
+)
+from etl.embed.cache import normalize_query
+from etl.sources import ArtSource
+from metrics import Stage, timed_stage
 
 # Added comment for test
-router = APIRouter()
+router = APIRouter(route_class=InstrumentedRoute)
 
-text_embedder = TextEmbedder(device="cpu")
 
-pca = load_pca()
+class QueryMode(StrEnum):
+    VECTOR = "vector"
+    # Fuses the CLIP matches with full-text and artist name matches
+    HYBRID = "hybrid"
+
+
+class ResponseFormat(StrEnum):
+    OBJECTS = "objects"
+    # One array per field rather than one object per art object, which is smaller and faster to build and parse
+    COLUMNAR = "columnar"
+
 
 TopK = Annotated[int, Query(ge=1, le=15)]
+# Optional recall/latency knobs for the HNSW and IVFFlat indexes, the index defaults are used when omitted
+EfSearch = Annotated[int | None, Query(ge=1, le=HNSW_MAX_EF_SEARCH)]
+Probes = Annotated[int | None, Query(ge=1, le=1000)]
+ReadyResources = Annotated[Resources, Depends(get_resources)]
+# Restrict results to one artist and/or source
+Artist = Annotated[str | None, Query(max_length=250)]
+Source = Annotated[ArtSource | None, Query()]
+Format = Annotated[ResponseFormat, Query()]
+
+# Responses are encoded by pydantic-core straight from the models, rather than by FastAPI, which validates
+# the returned value against the response model again before encoding it
+QUERY_RESPONSE = TypeAdapter(ArtQueryWithCoordsResponse | ArtQueryColumnsResponse)
+IMAGE_RESPONSE = TypeAdapter(list[ArtObjectsWithCoord] | ArtObjectsColumns)
+QUERY_BATCH_RESPONSE = TypeAdapter(list[ArtQueryWithCoordsResponse])
+IMAGE_BATCH_RESPONSE = TypeAdapter(dict[int, list[ArtObjectsWithCoord]])
+
+# Art objects with their map coordinates resolved
+ResolvedRows = list[tuple[ArtObjects, float, float]]
+
+
+def _json_response(value: Any, adapter: TypeAdapter) -> Response:
+    with timed_stage(Stage.SERIALIZATION):
+        return Response(adapter.dump_json(value), media_type="application/json")
+
+
+async def _with_coordinates_many(groups: list[list[ArtObjectWithCoords]], resources: Resources) -> list[ResolvedRows]:
+    """Attach the stored map coordinates, projecting embeddings only for art objects without them."""
+    missing_ids = list(dict.fromkeys(art_object.id for rows in groups for art_object, x, _ in rows if x is None))
+    if not missing_ids:
+        return groups
+
+    logger.warning(f"{len(missing_ids)} art objects have no stored coordinates, run the coordinates backfill.")
+    embeddings = await retrieve_embeddings_by_ids(missing_ids)
+    with timed_stage(Stage.PROJECTION):
+        coordinates = resources.projection(np.stack([embeddings[art_object_id] for art_object_id in missing_ids]))
+    projected = dict(zip(missing_ids, coordinates.tolist(), strict=True))
+
+    return [
+        [(art_object, *projected[art_object.id]) if x is None else (art_object, x, y) for art_object, x, y in rows]
+        for rows in groups
+    ]
+
+
+def _art_objects(rows: ResolvedRows) -> list[ArtObjectsWithCoord]:
+    with timed_stage(Stage.HYDRATION):
+        return [ArtObjectsWithCoord.from_art_object(art_object, x, y) for art_object, x, y in rows]
 
 
-@router.get("/query", tags=["art"])
-def get_query_nearest_neighbors(art_query: Annotated[str, Query(max_length=250)], top_k: TopK) -> ArtQueryWithCoordsResponse:
+def _art_object_columns(rows: ResolvedRows) -> ArtObjectsColumns:
+    with timed_stage(Stage.HYDRATION):
+        return ArtObjectsColumns.from_rows(rows)
+
+
+def _result_cache_key(request: Request, resources: Resources, *params: Any) -> CacheKey | None:
+    """Key of a request in the result cache, None for a profiled request, whose profile should show the search."""
+    if profile_requested(request):
+        return None
+    return resources.result_cache.key(*params)
+
+
+@router.get("/query", tags=["art"], response_model=ArtQueryWithCoordsResponse | ArtQueryColumnsResponse)
+async def get_query_nearest_neighbors(
+    art_query: Annotated[str, Query(max_length=250)],
+    top_k: TopK,
+    request: Request,
+    resources: ReadyResources,
+    ef_search: EfSearch = None,
+    probes: Probes = None,
+    mode: QueryMode = QueryMode.VECTOR,
+    artist: Artist = None,
+    source: Source = None,
+    format: Format = ResponseFormat.OBJECTS,  # noqa: A002
+) -> Response:
     """
     Get's nearest neighbor images based on given test `query`.
+
+    In hybrid mode, art objects whose title or artist match the query are fused with the nearest
+    neighbours by reciprocal rank fusion. Both retrievals run concurrently.
     """
-    text_embedding = text_embedder(art_query)[0].cpu().detach().numpy()
+    filters = ArtObjectFilter(artist=artist, source=source)
+    cache_key = _result_cache_key(
+        request, resources, "query", normalize_query(art_query), top_k, ef_search, probes, mode, artist, source, format
+    )
+    if (cached := await resources.result_cache.get(cache_key)) is not None:
+        return Response(cached, media_type="application/json")
+
+    async def vector_search() -> tuple[np.ndarray, list[ArtObjectWithCoords]]:
+        loop = asyncio.get_running_loop()
+        text_embedding = await loop.run_in_executor(resources.inference_executor, resources.text_embedder, art_query)
+        candidates = top_k if mode == QueryMode.VECTOR else max(top_k, settings.hybrid_candidates)
+        return text_embedding, await retrieve_best_image_match_w_embedding(
+            text_embedding, candidates, ef_search, probes, filters
+        )
 
-    art_objects_embeddings = retrieve_best_image_match_w_embedding(text_embedding, top_k)
+    if mode == QueryMode.HYBRID:
+        (text_embedding, vector_matches), lexical_matches = await asyncio.gather(
+            vector_search(), retrieve_lexical_matches(art_query, max(top_k, settings.hybrid_candidates), filters)
+        )
+        art_objects_with_coords = reciprocal_rank_fusion([vector_matches, lexical_matches], top_k)
+    else:
+        text_embedding, art_objects_with_coords = await vector_search()
 
-    if not art_objects_embeddings:
+    if not art_objects_with_coords:
         raise HTTPException(status_code=404, detail="No art objects found")
 
-    query_x, query_y = get_embedding_coordinates(pca, text_embedding.reshape(1, -1))[0]
+    with timed_stage(Stage.PROJECTION):
+        query_x, query_y = resources.projection(text_embedding.reshape(1, -1))[0].tolist()
 
-    img_embeddings = []
-    art_objects = []
+    (rows,) = await _with_coordinates_many([art_objects_with_coords], resources)
+    if format == ResponseFormat.COLUMNAR:
+        result = ArtQueryColumnsResponse.model_construct(
+            query_x=query_x, query_y=query_y, art_objects=_art_object_columns(rows)
+        )
+    else:
+        result = ArtQueryWithCoordsResponse.model_construct(
+            query_x=query_x, query_y=query_y, art_objects_with_coords=_art_objects(rows)
+        )
 
-    for art_object, img_embedding in art_objects_embeddings:
-        img_embeddings.append(img_embedding)
-        art_objects.append(art_object)
+    response = _json_response(result, QUERY_RESPONSE)
+    await resources.result_cache.put(cache_key, response.body)
+    return response
 
-    all_img_embeddings = np.stack(img_embeddings)
-    coordinates = get_embedding_coordinates(pca, all_img_embeddings)
 
-    art_objs_with_coords = []
+@router.post("/query/batch", tags=["art"], response_model=list[ArtQueryWithCoordsResponse])
+async def get_batch_query_nearest_neighbors(
+    batch: ArtQueryBatchRequest,
+    resources: ReadyResources,
+    ef_search: EfSearch = None,
+    probes: Probes = None,
+) -> Response:
+    """
+    Get's nearest neighbor images for each of the given text queries, in the order of the queries.
+
+    All queries are embedded in one model call and searched in one database round trip. A query
+    without any matches gets an empty list of art objects, rather than failing the whole batch.
+    """
+    loop = asyncio.get_running_loop()
+    text_embeddings = await loop.run_in_executor(
+        resources.inference_executor, resources.text_embedder.embed_many, batch.art_queries
+    )
 
-    for art_object, coords in zip(art_objects, coordinates, strict=False):
-        x, y = coords
-        art_objs_with_coords.append(ArtObjectsWithCoord.from_art_object(art_object, x.item(), y.item()))
+    matches_per_query = await retrieve_best_image_matches_w_embeddings(text_embeddings, batch.top_k, ef_search, probes)
+    with timed_stage(Stage.PROJECTION):
+        query_coordinates = resources.projection(text_embeddings).tolist()
 
-    return ArtQueryWithCoordsResponse(query_x=query_x, query_y=query_y, art_objects_with_coords=art_objs_with_coords)
+    result = [
+        ArtQueryWithCoordsResponse.model_construct(
+            query_x=query_x, query_y=query_y, art_objects_with_coords=_art_objects(rows)
+        )
+        for (query_x, query_y), rows in zip(
+            query_coordinates, await _with_coordinates_many(matches_per_query, resources), strict=True
+        )
+    ]
+    return _json_response(result, QUERY_BATCH_RESPONSE)
 
 
-@router.get("/image", tags=["art"])
-def get_image_nearest_neighbors(idx: Annotated[int, Query(ge=1)], top_k: TopK) -> list[ArtObjectsWithCoord]:
+@router.get("/image", tags=["art"], response_model=list[ArtObjectsWithCoord] | ArtObjectsColumns)
+async def get_image_nearest_neighbors(
+    idx: Annotated[int, Query(ge=1)],
+    top_k: TopK,
+    request: Request,
+    resources: ReadyResources,
+    ef_search: EfSearch = None,
+    probes: Probes = None,
+    artist: Artist = None,
+    source: Source = None,
+    format: Format = ResponseFormat.OBJECTS,  # noqa: A002
+) -> Response:
     """
     Get's nearest neighbor images based on given test `query`.
     """
-    art_objects_embeddings = retrieve_closest_to_artobject(idx, top_k)
+    cache_key = _result_cache_key(request, resources, "image", idx, top_k, ef_search, probes, artist, source, format)
+    if (cached := await resources.result_cache.get(cache_key)) is not None:
+        return Response(cached, media_type="application/json")
 
-    if not art_objects_embeddings:
+    filters = ArtObjectFilter(artist=artist, source=source)
+    art_objects_with_coords = await retrieve_closest_to_artobject(idx, top_k, ef_search, probes, filters)
+
+    if not art_objects_with_coords:
         raise HTTPException(status_code=404, detail="No art objects found")
 
-    img_embeddings = []
-    art_objects = []
+    (rows,) = await _with_coordinates_many([art_objects_with_coords], resources)
+    result = _art_object_columns(rows) if format == ResponseFormat.COLUMNAR else _art_objects(rows)
 
-    for art_object, img_embedding in art_objects_embeddings:
-        img_embeddings.append(img_embedding)
-        art_objects.append(art_object)
+    response = _json_response(result, IMAGE_RESPONSE)
+    await resources.result_cache.put(cache_key, response.body)
+    return response
 
-    all_img_embeddings = np.stack(img_embeddings)
-    coordinates = get_embedding_coordinates(pca, all_img_embeddings)
 
-    close_images = []
+@router.post("/image/batch", tags=["art"], response_model=dict[int, list[ArtObjectsWithCoord]])
+async def get_batch_image_nearest_neighbors(
+    batch: ArtObjectNeighboursRequest,
+    resources: ReadyResources,
+    ef_search: EfSearch = None,
+    probes: Probes = None,
+) -> Response:
+    """
+    Get's nearest neighbor images for each of the given art object ids, keyed by id.
 
-    for art_object, coords in zip(art_objects, coordinates, strict=False):
-        x, y = coords
-        close_image = ArtObjectsWithCoord.from_art_object(art_object, x.item(), y.item())
-        close_images.append(close_image)
+    The neighbours of all ids are computed together in one pass. Ids that are unknown or
+    have no image embedding are left out of the response.
+    """
+    art_object_ids = list(dict.fromkeys(batch.idxs))
+    neighbours = await retrieve_closest_to_artobjects(art_object_ids, batch.top_k, ef_search, probes)
 
-    return close_images
+    found_ids = [art_object_id for art_object_id in art_object_ids if art_object_id in neighbours]
+    with_coordinates = await _with_coordinates_many(
+        [neighbours[art_object_id] for art_object_id in found_ids], resources
+    )
+    result = {
+        art_object_id: _art_objects(rows) for art_object_id, rows in zip(found_ids, with_coordinates, strict=True)
+    }
+    return _json_response(result, IMAGE_BATCH_RESPONSE)
@@ -0,0 +1,58 @@
+import tempfile
+from pathlib import Path
+
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+
+from config import settings
+
+
+class PreforkServer(BaseApplication):
+    """
+    Gunicorn server that runs the API in several uvicorn worker processes.
+
+    The app is loaded once in the master process, including the models and vector data, after which
+    gunicorn forks the workers. Each worker still starts its own event loop, database pools, caches
+    and inference threads in the lifespan of the app, see `Resources.load`. The workers share their
+    request metrics through `metrics_dir`, so a scrape of any of them reports the totals of all.
+    """
+
+    def __init__(self, workers: int, host: str, port: int):
+        self.options = {
+            "bind": f"{host}:{port}",
+            "workers": workers,
+            "worker_class": "uvicorn_worker.UvicornWorker",
+            "preload_app": True,
+            # Trust the forwarded headers of the reverse proxy, like `fastapi run --proxy-headers`
+            "forwarded_allow_ips": "*",
+        }
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.main import app
+        from app.resources import resources
+
+        if self.options["workers"] > 1:
+            share_metrics()
+        resources.preload()
+        return app
+
+
+def share_metrics() -> None:
+    """Have the workers share their metrics through a directory, starting from empty snapshots."""
+    if settings.metrics_dir is None:
+        settings.metrics_dir = Path(tempfile.mkdtemp(prefix="sem-art-search-metrics-"))
+    else:
+        # Snapshots of a previous run would be added to the counters of this one
+        for path in settings.metrics_dir.glob("*.json"):
+            path.unlink()
+    logger.info(f"Workers share their metrics through {settings.metrics_dir}")
+
+
+if __name__ == "__main__":
+    logger.info(f"Serving the API with {settings.serve_workers} workers on {settings.serve_host}:{settings.serve_port}")
+    PreforkServer(settings.serve_workers, settings.serve_host, settings.serve_port).run()
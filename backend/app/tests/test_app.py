@@ -1,3 +1,6 @@
+import time
+
+import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session, select
 import numpy as np
@@ -6,16 +9,27 @@ from app.main import app
 from db.models import Embeddings, engine
 from etl.dim_reduc import load_pca, get_embedding_coordinates
 
-client = TestClient(app)
+READY_TIMEOUT = 120
+
+
+@pytest.fixture(scope="module")
+def client():
+    # Entering the client runs the lifespan, which loads the models in the background
+    with TestClient(app) as client:
+        deadline = time.time() + READY_TIMEOUT
+        while client.get("/ready").status_code != 200:
+            assert time.time() < deadline, "API did not become ready"
+            time.sleep(0.1)
+        yield client
 
 
-def test_health():
+def test_health(client):
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == "ok"
 
 
-def test_art_query():
+def test_art_query(client):
     oopjen_id = "nl-SK-C-1768"
     TOP_K = 10
 
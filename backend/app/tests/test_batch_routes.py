@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.resources import get_resources
+from app.routers import art
+from db.models import ArtObjects
+
+
+def art_object(art_object_id: int) -> ArtObjects:
+    return ArtObjects(
+        id=art_object_id,
+        original_id=f"nl-{art_object_id}",
+        image_url=f"https://example.org/{art_object_id}.jpg",
+        long_title=f"Art object {art_object_id}",
+        artist="Rembrandt van Rijn",
+        source="rijksmuseum",
+    )
+
+
+class FakeTextEmbedder:
+    """Embeds the i-th text of a batch as [i, 0]."""
+
+    def embed_many(self, texts: list[str]) -> np.ndarray:
+        return np.array([[index, 0.0] for index in range(len(texts))], dtype=np.float32)
+
+
+@pytest.fixture
+def client():
+    resources = SimpleNamespace(
+        inference_executor=None, text_embedder=FakeTextEmbedder(), projection=lambda embeddings: embeddings[:, :2]
+    )
+    api = FastAPI()
+    api.include_router(art.router)
+    api.dependency_overrides[get_resources] = lambda: resources
+    return TestClient(api)
+
+
+def test_query_batch_answers_in_query_order(client, monkeypatch):
+    async def best_matches(embeddings, top_k, ef_search, probes):
+        # The i-th query matches art objects 10 * i + 1 and onwards
+        return [
+            [(art_object(10 * int(embedding[0]) + rank + 1), 0.0, 0.0) for rank in range(top_k)]
+            for embedding in embeddings
+        ]
+
+    monkeypatch.setattr(art, "retrieve_best_image_matches_w_embeddings", best_matches)
+
+    response = client.post("/query/batch", json={"art_queries": ["portrait", "landscape", "still life"], "top_k": 2})
+
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["query_x"] for result in results] == [0.0, 1.0, 2.0]
+    assert [[hit["id"] for hit in result["art_objects_with_coords"]] for result in results] == [
+        [1, 2],
+        [11, 12],
+        [21, 22],
+    ]
+
+
+def test_query_batch_without_matches_gives_empty_list(client, monkeypatch):
+    async def best_matches(embeddings, top_k, ef_search, probes):
+        return [[(art_object(1), 0.0, 0.0)], []]
+
+    monkeypatch.setattr(art, "retrieve_best_image_matches_w_embeddings", best_matches)
+
+    response = client.post("/query/batch", json={"art_queries": ["portrait", "nothing like it"], "top_k": 1})
+
+    assert response.status_code == 200
+    assert [len(result["art_objects_with_coords"]) for result in response.json()] == [1, 0]
+
+
+def test_image_batch_is_keyed_by_id_and_leaves_out_unknown_ids(client, monkeypatch):
+    requested = []
+
+    async def closest(art_object_ids, top_k, ef_search, probes):
+        requested.append(art_object_ids)
+        # Art object 404 has no embedding
+        return {
+            art_object_id: [(art_object(art_object_id * 100 + rank), 0.0, 0.0) for rank in range(top_k)]
+            for art_object_id in art_object_ids
+            if art_object_id != 404
+        }
+
+    monkeypatch.setattr(art, "retrieve_closest_to_artobjects", closest)
+
+    response = client.post("/image/batch", json={"idxs": [7, 404, 3, 7], "top_k": 2})
+
+    assert response.status_code == 200
+    assert requested == [[7, 404, 3]]
+    assert {
+        art_object_id: [hit["id"] for hit in hits] for art_object_id, hits in response.json().items()
+    } == {"7": [700, 701], "3": [300, 301]}
+    assert list(response.json()) == ["7", "3"]
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from etl.embed.batching import BatchingTextEmbedder
+
+# Long enough that a test only finishes in time when a batch is flushed because it is full
+LONG_WAIT_MS = 10_000
+
+
+class FakeTextEmbedder:
+    """Embeds a text as its length, and records the texts of every call."""
+
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(texts)
+        if self.error is not None:
+            raise self.error
+        return np.array([[len(text)] for text in texts], dtype=np.float32)
+
+
+def test_full_batch_is_flushed_without_waiting():
+    text_embedder = FakeTextEmbedder()
+    batcher = BatchingTextEmbedder(text_embedder, max_batch_size=4, max_wait_ms=LONG_WAIT_MS)
+    texts = ["a", "bb", "ccc", "dddd"]
+
+    start = monotonic()
+    with ThreadPoolExecutor(len(texts)) as pool:
+        embeddings = list(pool.map(batcher, texts))
+    batcher.close()
+
+    assert monotonic() - start < LONG_WAIT_MS / 1000
+    assert [embedding.tolist() for embedding in embeddings] == [[[1.0]], [[2.0]], [[3.0]], [[4.0]]]
+    assert len(text_embedder.calls) == 1
+    assert sorted(text_embedder.calls[0]) == texts
+
+
+def test_partial_batch_is_flushed_after_the_wait_time():
+    text_embedder = FakeTextEmbedder()
+    batcher = BatchingTextEmbedder(text_embedder, max_batch_size=16, max_wait_ms=50)
+
+    start = monotonic()
+    embedding = batcher("a")
+    batcher.close()
+
+    assert monotonic() - start >= 0.05
+    assert embedding.tolist() == [[1.0]]
+    assert text_embedder.calls == [["a"]]
+
+
+def test_embedder_error_reaches_every_caller():
+    error = RuntimeError("model failed")
+    batcher = BatchingTextEmbedder(FakeTextEmbedder(error), max_batch_size=3, max_wait_ms=LONG_WAIT_MS)
+
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(batcher, text) for text in ("a", "b", "c")]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="model failed"):
+                future.result()
+    batcher.close()
@@ -0,0 +1,51 @@
+import hashlib
+import os
+
+from etl.image_cache import ImageCache
+
+
+def test_urls_with_the_same_content_share_a_file(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=1000)
+
+    cache.put("https://example.com/a.jpg", b"image")
+    cache.put("https://example.com/b.jpg", b"image")
+
+    assert cache.get("https://example.com/a.jpg") == b"image"
+    assert cache.get("https://example.com/b.jpg") == b"image"
+    assert cache.get("https://example.com/c.jpg") is None
+    assert cache.stats == {"bytes": 5, "hits": 2, "misses": 1}
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=250)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    # Both are made old, file systems can store modification times at a coarse resolution
+    for last_use, content in enumerate([b"a" * 100, b"b" * 100]):
+        content_hash = hashlib.sha256(content).hexdigest()
+        os.utime(tmp_path / "blobs" / content_hash[:2] / content_hash, (last_use, last_use))
+    cache.get("a")
+
+    cache.put("c", b"c" * 100)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"a" * 100
+    assert cache.get("c") == b"c" * 100
+    assert cache.stats["bytes"] == 200
+
+
+def test_eviction_drops_the_urls_of_evicted_images(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=250)
+    cache.put("a", b"a" * 100)
+    cache.put("a-mirror", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    content_hash = hashlib.sha256(b"a" * 100).hexdigest()
+    os.utime(tmp_path / "blobs" / content_hash[:2] / content_hash, (0, 0))
+
+    cache.put("c", b"c" * 100)
+
+    assert sorted(path.read_text() for path in (tmp_path / "index").glob("*/*")) == sorted(
+        hashlib.sha256(content).hexdigest() for content in (b"b" * 100, b"c" * 100)
+    )
+    assert cache.get("a") is None
+    assert cache.get("b") == b"b" * 100
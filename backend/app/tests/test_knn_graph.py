@@ -0,0 +1,61 @@
+import numpy as np
+
+from db.vector_store import VectorStore
+from etl import knn_graph
+from etl.knn_graph import _merge_neighbours, compute_neighbours, update_knn_graph
+
+RNG = np.random.default_rng(42)
+SIZE = 5
+
+
+def random_embeddings(n: int) -> tuple[np.ndarray, np.ndarray]:
+    vectors = RNG.standard_normal((n, 512)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.arange(1, n + 1, dtype=np.int64), vectors
+
+
+def as_graph(neighbours: list[tuple[int, np.ndarray, np.ndarray]]) -> dict[int, tuple[list[int], list[float]]]:
+    return {
+        int(art_object_id): (np.asarray(ids).tolist(), np.asarray(scores).tolist())
+        for art_object_id, ids, scores in neighbours
+    }
+
+
+def test_merge_keeps_the_most_similar_occurrence_of_an_id():
+    ids, similarities = _merge_neighbours(
+        np.array([7, 3, 9, 3, 4]), np.array([0.9, 0.85, 0.7, 0.8, 0.1], dtype=np.float32), 3
+    )
+
+    assert ids.tolist() == [7, 3, 9]
+    assert similarities.tolist() == np.array([0.9, 0.85, 0.7], dtype=np.float32).tolist()
+
+
+def test_incremental_update_matches_a_full_build(monkeypatch):
+    ids, vectors = random_embeddings(60)
+    # The graph was built when only the first 40 art objects had an embedding
+    graph = as_graph(compute_neighbours(VectorStore(ids[:40], vectors[:40]), ids[:40], SIZE))
+
+    def save_all_neighbours(neighbours):
+        graph.update(as_graph(neighbours))
+
+    monkeypatch.setattr(knn_graph, "load_embeddings", lambda: (ids, vectors))
+    monkeypatch.setattr(
+        knn_graph,
+        "retrieve_neighbour_thresholds",
+        lambda: {art_object_id: (len(scores), min(scores)) for art_object_id, (_, scores) in graph.items()},
+    )
+    monkeypatch.setattr(
+        knn_graph, "retrieve_neighbours", lambda art_object_ids: {key: graph[key] for key in art_object_ids}
+    )
+    monkeypatch.setattr(knn_graph, "save_all_neighbours", save_all_neighbours)
+    monkeypatch.setattr(knn_graph, "bump_dataset_version", lambda: None)
+
+    update_knn_graph(SIZE)
+    # Updating an up to date graph changes nothing
+    update_knn_graph(SIZE)
+
+    expected = as_graph(compute_neighbours(VectorStore(ids, vectors), ids, SIZE))
+    assert {key: neighbour_ids for key, (neighbour_ids, _) in graph.items()} == {
+        key: neighbour_ids for key, (neighbour_ids, _) in expected.items()
+    }
+    assert all(len(set(neighbour_ids)) == SIZE for neighbour_ids, _ in graph.values())
@@ -0,0 +1,57 @@
+import json
+
+from metrics import Counter, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_duration_seconds", "Test durations", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, "db_query")
+
+    lines = histogram.render()
+
+    assert 'test_duration_seconds_bucket{stage="db_query",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{stage="db_query",le="1.0"} 3' in lines
+    assert 'test_duration_seconds_bucket{stage="db_query",le="+Inf"} 4' in lines
+    assert 'test_duration_seconds_count{stage="db_query"} 4' in lines
+
+
+def test_counter_per_label_values():
+    counter = Counter("test_requests_total", "Test requests", ("route", "status"))
+    counter.inc("/query", "200")
+    counter.inc("/query", "200")
+    counter.inc("/image", "404")
+
+    lines = counter.render()
+
+    assert 'test_requests_total{route="/query",status="200"} 2' in lines
+    assert 'test_requests_total{route="/image",status="404"} 1' in lines
+
+
+def test_shared_registry_sums_the_snapshots_of_all_workers(tmp_path):
+    registry = Registry()
+    requests = registry.register(Counter("test_requests_total", "Test requests", ("route",)))
+    durations = registry.register(Histogram("test_duration_seconds", "Test durations", buckets=(0.1, 1.0)))
+    requests.inc("/query")
+    durations.observe(0.05)
+    # Snapshot of another worker, which wrote it before exiting
+    (tmp_path / "1.json").write_text(
+        json.dumps(
+            {
+                "test_requests_total": [[["/query"], 2], [["/image"], 1]],
+                "test_duration_seconds": [[[], [[0, 1, 1], 5.5]]],
+            }
+        )
+    )
+
+    registry.share(tmp_path, interval=60)
+    try:
+        lines = registry.render().splitlines()
+    finally:
+        registry.stop_sharing()
+
+    assert 'test_requests_total{route="/query"} 3' in lines
+    assert 'test_requests_total{route="/image"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="0.1"} 1' in lines
+    assert "test_duration_seconds_count 3" in lines
+    assert "test_duration_seconds_sum 5.55" in lines
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from onnx import TensorProto, helper, numpy_helper
+
+from etl.embed.onnx_models import (
+    IMAGE_ENCODER_FILE,
+    OPSET_VERSION,
+    QUANTIZED_OP_TYPES,
+    TEXT_ENCODER_FILE,
+    OnnxEmbedder,
+    onnx_model_path,
+    quantize_graph,
+)
+
+RNG = np.random.default_rng(42)
+# Highest IR version that all supported ONNX Runtime versions load
+IR_VERSION = 8
+
+
+def weight(name: str, *shape: int) -> onnx.TensorProto:
+    return numpy_helper.from_array(RNG.standard_normal(shape).astype(np.float32), name)
+
+
+def save_graph(path, nodes, inputs, output, initializers) -> None:
+    graph = helper.make_graph(
+        nodes, path.stem, inputs, [helper.make_tensor_value_info(output, TensorProto.FLOAT, ["batch", 8])], initializers
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", OPSET_VERSION)], ir_version=IR_VERSION)
+    onnx.save(model, path)
+
+
+def save_text_encoder(path) -> None:
+    """Token embedding and projection, like the operators of the CLIP text encoder."""
+    save_graph(
+        path,
+        [
+            helper.make_node("Gather", ["token_embedding", "input_ids"], ["tokens"]),
+            helper.make_node("ReduceMean", ["tokens"], ["pooled"], axes=[1], keepdims=0),
+            helper.make_node("MatMul", ["pooled", "projection"], ["text_embeds"]),
+        ],
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"])],
+        "text_embeds",
+        [weight("token_embedding", 100, 16), weight("projection", 16, 8)],
+    )
+
+
+def save_image_encoder(path) -> None:
+    """Patch embedding convolution and projection, like the operators of the CLIP vision encoder."""
+    save_graph(
+        path,
+        [
+            helper.make_node("Conv", ["pixel_values", "patch_embedding"], ["patches"], strides=[4, 4]),
+            helper.make_node("Flatten", ["patches"], ["flat"]),
+            helper.make_node("MatMul", ["flat", "projection"], ["image_embeds"]),
+        ],
+        [helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["batch", 3, 16, 16])],
+        "image_embeds",
+        [weight("patch_embedding", 4, 3, 4, 4), weight("projection", 4 * 4 * 4, 8)],
+    )
+
+
+def test_quantized_graphs_load_and_run(tmp_path):
+    save_text_encoder(onnx_model_path(tmp_path, TEXT_ENCODER_FILE))
+    save_image_encoder(onnx_model_path(tmp_path, IMAGE_ENCODER_FILE))
+    inputs = {
+        TEXT_ENCODER_FILE: {"input_ids": RNG.integers(0, 100, (2, 5))},
+        IMAGE_ENCODER_FILE: {"pixel_values": RNG.standard_normal((2, 3, 16, 16)).astype(np.float32)},
+    }
+
+    for file, file_inputs in inputs.items():
+        quantized_path = onnx_model_path(tmp_path, file, quantized=True)
+        quantize_graph(onnx_model_path(tmp_path, file), quantized_path, QUANTIZED_OP_TYPES[file])
+
+        (embeddings,) = OnnxEmbedder(quantized_path).session.run(None, file_inputs)
+        assert embeddings.shape == (2, 8)
+
+    quantized_image_encoder = onnx.load(onnx_model_path(tmp_path, IMAGE_ENCODER_FILE, quantized=True))
+    image_ops = {node.op_type for node in quantized_image_encoder.graph.node}
+    assert "ConvInteger" not in image_ops
+    assert "MatMulInteger" in image_ops
@@ -0,0 +1,36 @@
+import pytest
+
+from etl.embed.pipeline import Pipeline, PipelineStage
+
+
+def test_items_pass_through_all_stages():
+    saved = []
+    pipeline = Pipeline(
+        [
+            PipelineStage.from_function("double", lambda batch: [item * 2 for item in batch], workers=3, batch_size=4),
+            PipelineStage.from_function("save", lambda batch: saved.extend(batch) or [], batch_size=5, queue_size=2),
+        ]
+    )
+
+    stats = pipeline.run(range(100))
+
+    assert sorted(saved) == [item * 2 for item in range(100)]
+    assert [(stage.items_in, stage.items_out) for stage in stats] == [(100, 100), (100, 0)]
+
+
+def test_failing_stage_stops_pipeline():
+    def fail(batch):
+        if 50 in batch:
+            msg = "broken item"
+            raise ValueError(msg)
+        return batch
+
+    pipeline = Pipeline(
+        [
+            PipelineStage.from_function("fail", fail, workers=2, queue_size=1),
+            PipelineStage.from_function("save", lambda _: [], queue_size=1),
+        ]
+    )
+
+    with pytest.raises(ValueError, match="broken item"):
+        pipeline.run(range(1000))
@@ -0,0 +1,30 @@
+from io import BytesIO
+
+from PIL import Image
+
+from etl.embed.preprocess import decode_image
+
+
+def encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def test_jpeg_is_decoded_at_reduced_size():
+    data = encode(Image.new("RGB", (1000, 800), color=(200, 30, 30)), "JPEG")
+
+    image = decode_image(data, size=224)
+
+    assert image.mode == "RGB"
+    # Halving once more would make the shortest side smaller than 224
+    assert image.size == (500, 400)
+
+
+def test_other_formats_are_decoded_at_full_size():
+    data = encode(Image.new("L", (1000, 800)), "PNG")
+
+    image = decode_image(data, size=224)
+
+    assert image.mode == "RGB"
+    assert image.size == (1000, 800)
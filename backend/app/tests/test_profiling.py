@@ -0,0 +1,110 @@
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from app import profiling
+from app.profiling import ADMIN_TOKEN_HEADER, PROFILE_ID_HEADER, Profile, ProfileStore
+from app.resources import get_resources
+from app.result_cache import ResultCache
+from app.routers import admin, art
+from config import settings
+from db.models import ArtObjects
+
+ADMIN_TOKEN = "secret"  # noqa: S105
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(settings, "admin_token", ADMIN_TOKEN)
+
+
+@pytest.mark.usefixtures("admin_token")
+@pytest.mark.parametrize("headers", [{}, {ADMIN_TOKEN_HEADER: "guess"}])
+def test_admin_routes_reject_requests_without_the_token(headers):
+    api = FastAPI()
+    api.include_router(admin.router)
+
+    assert TestClient(api).get("/admin/profiles", headers=headers).status_code == 403
+
+
+@pytest.mark.usefixtures("admin_token")
+def test_admin_routes_accept_the_token():
+    api = FastAPI()
+    api.include_router(admin.router)
+
+    response = TestClient(api).get("/admin/profiles", headers={ADMIN_TOKEN_HEADER: ADMIN_TOKEN})
+
+    assert response.status_code == 200
+    assert response.json() == {"requested": [], "slowest": []}
+
+
+def test_no_token_is_accepted_when_none_is_configured(monkeypatch):
+    monkeypatch.setattr(settings, "admin_token", None)
+    api = FastAPI()
+    api.include_router(admin.router)
+
+    assert TestClient(api).get("/admin/profiles", headers={ADMIN_TOKEN_HEADER: ""}).status_code == 403
+
+
+def test_store_keeps_the_slowest_background_profiles(monkeypatch):
+    durations = iter([0.3, 0.1, 0.5, 0.2, 0.4])
+
+    class FakeProfiler:
+        def __init__(self, interval: float):
+            pass
+
+        def start(self) -> "FakeProfiler":
+            return self
+
+        def stop(self, request: Request) -> Profile:
+            return Profile("GET", "/query", "", next(durations), Counter())
+
+    monkeypatch.setattr(profiling, "SamplingProfiler", FakeProfiler)
+    monkeypatch.setattr(settings, "profile_sample_rate", 1.0)
+    store = ProfileStore(keep_slowest=3, max_concurrent=1)
+
+    for _ in range(5):
+        store.finish(store.try_start(requested=False), Request({"type": "http"}), requested=False)
+
+    assert [summary["duration"] for summary in store.summaries()["slowest"]] == [0.5, 0.4, 0.3]
+    assert store.active == 0
+
+
+@pytest.mark.usefixtures("admin_token")
+def test_profiled_query_is_not_served_from_the_result_cache(monkeypatch):
+    searches = []
+
+    async def best_match(embedding, top_k, ef_search, probes, filters):
+        searches.append(top_k)
+        return [(ArtObjects(id=1, image_url="https://example.org/1.jpg"), 0.0, 0.0)]
+
+    result_cache = ResultCache()
+    result_cache.set_version(1)
+    resources = SimpleNamespace(
+        inference_executor=None,
+        text_embedder=lambda text: np.zeros(2, dtype=np.float32),
+        projection=lambda embeddings: embeddings[:, :2],
+        result_cache=result_cache,
+    )
+    api = FastAPI()
+    api.include_router(art.router)
+    api.dependency_overrides[get_resources] = lambda: resources
+    monkeypatch.setattr(art, "retrieve_best_image_match_w_embedding", best_match)
+    client = TestClient(api)
+
+    assert client.get("/query", params={"art_query": "portrait", "top_k": 1}).status_code == 200
+    response = client.get(
+        "/query",
+        params={"art_query": "portrait", "top_k": 1, "profile": "true"},
+        headers={ADMIN_TOKEN_HEADER: ADMIN_TOKEN},
+    )
+
+    assert response.status_code == 200
+    assert PROFILE_ID_HEADER.lower() in response.headers
+    assert len(searches) == 2
+    assert result_cache.hits == 0
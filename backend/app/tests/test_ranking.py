@@ -0,0 +1,29 @@
+from app.ranking import reciprocal_rank_fusion
+from db.models import ArtObjects
+
+
+def ranking(*art_object_ids: int) -> list[tuple[ArtObjects, float, float]]:
+    return [(ArtObjects(id=art_object_id), 0.0, 0.0) for art_object_id in art_object_ids]
+
+
+def ids(rows) -> list[int]:
+    return [art_object.id for art_object, _, _ in rows]
+
+
+def test_objects_ranked_high_by_both_rankings_come_first():
+    fused = reciprocal_rank_fusion([ranking(1, 2, 3), ranking(3, 2, 4)], top_k=4, k=1)
+
+    # 3 scores 1/2 + 1/4, 2 scores 1/3 + 1/3 and 1, first in a single ranking, only 1/2
+    assert ids(fused) == [3, 2, 1, 4]
+
+
+def test_objects_found_by_one_ranking_are_kept():
+    fused = reciprocal_rank_fusion([ranking(1), ranking(), ranking(2)], top_k=10)
+
+    assert ids(fused) == [1, 2]
+
+
+def test_ties_keep_the_order_they_were_first_seen_in():
+    fused = reciprocal_rank_fusion([ranking(5, 6), ranking(6, 5), ranking(7)], top_k=2)
+
+    assert ids(fused) == [5, 6]
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+from sqlalchemy.dialects import postgresql
+
+from config import HNSW_MAX_EF_SEARCH, Settings, settings
+from db.crud import best_image_matches_statement, closest_to_artobjects_statement, rerank_ef_search
+
+
+def compile_sql(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_batch_statements_rerank_binary_candidates(monkeypatch):
+    monkeypatch.setattr(settings, "rerank_candidates", 200)
+
+    for statement in (
+        best_image_matches_statement(np.ones((2, 512), dtype=np.float32), 5),
+        closest_to_artobjects_statement([1, 2], 5),
+    ):
+        sql = compile_sql(statement)
+        assert "embeddings.image_code <~> binary_quantize(queries.embedding)" in sql
+        assert "ORDER BY candidates.image <=> queries.embedding" in sql
+        # The candidates of a query are correlated to it, not joined to all queries
+        assert "FROM embeddings, " not in sql
+
+
+def test_batch_statements_search_full_vectors_without_rerank(monkeypatch):
+    monkeypatch.setattr(settings, "rerank_candidates", 0)
+
+    assert "<~>" not in compile_sql(closest_to_artobjects_statement([1, 2], 5))
+
+
+def test_rerank_candidates_fit_in_the_hnsw_candidate_list(monkeypatch):
+    with pytest.raises(ValidationError):
+        Settings(database_url="postgresql://localhost/db", rerank_candidates=HNSW_MAX_EF_SEARCH + 1)
+
+    monkeypatch.setattr(settings, "rerank_candidates", HNSW_MAX_EF_SEARCH)
+    assert rerank_ef_search(40) == HNSW_MAX_EF_SEARCH
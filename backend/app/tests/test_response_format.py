@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.resources import get_resources
+from app.result_cache import ResultCache
+from app.routers import art
+from db.models import ArtObjects
+
+COLUMNS = {
+    "ids": "id",
+    "original_ids": "original_id",
+    "image_urls": "image_url",
+    "long_titles": "long_title",
+    "artists": "artist",
+    "sources": "source",
+    "x": "x",
+    "y": "y",
+}
+
+
+def art_object_with_coords(art_object_id: int) -> tuple[ArtObjects, float, float]:
+    art_object = ArtObjects(
+        id=art_object_id,
+        original_id=f"nl-{art_object_id}",
+        image_url=f"https://example.org/{art_object_id}.jpg",
+        long_title=f"Art object {art_object_id}",
+        artist="Rembrandt van Rijn",
+        source="rijksmuseum",
+    )
+    return art_object, float(art_object_id), -float(art_object_id)
+
+
+def as_columns(rows: list[dict]) -> dict[str, list]:
+    return {column: [row[field] for row in rows] for column, field in COLUMNS.items()}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def best_match(embedding, top_k, ef_search, probes, filters):
+        return [art_object_with_coords(art_object_id) for art_object_id in range(1, top_k + 1)]
+
+    async def closest(art_object_id, top_k, ef_search, probes, filters):
+        return [art_object_with_coords(art_object_id + rank) for rank in range(1, top_k + 1)]
+
+    monkeypatch.setattr(art, "retrieve_best_image_match_w_embedding", best_match)
+    monkeypatch.setattr(art, "retrieve_closest_to_artobject", closest)
+    resources = SimpleNamespace(
+        inference_executor=None,
+        text_embedder=lambda text: np.array([0.5, 0.25, 1.0], dtype=np.float32),
+        projection=lambda embeddings: embeddings[:, :2],
+        # Without a dataset version results are not cached, every request runs the search
+        result_cache=ResultCache(),
+    )
+    api = FastAPI()
+    api.include_router(art.router)
+    api.dependency_overrides[get_resources] = lambda: resources
+    return TestClient(api)
+
+
+def test_columnar_query_response_holds_the_rows_of_the_object_format(client):
+    params = {"art_query": "portrait", "top_k": 3}
+
+    objects = client.get("/query", params=params).json()
+    columnar = client.get("/query", params={**params, "format": "columnar"}).json()
+
+    assert set(columnar) == {"query_x", "query_y", "art_objects"}
+    assert set(columnar["art_objects"]) == set(COLUMNS)
+    assert columnar["art_objects"]["ids"] == [1, 2, 3]
+    assert columnar["art_objects"] == as_columns(objects["art_objects_with_coords"])
+    assert (columnar["query_x"], columnar["query_y"]) == (objects["query_x"], objects["query_y"]) == (0.5, 0.25)
+
+
+def test_columnar_image_response_holds_the_rows_of_the_object_format(client):
+    params = {"idx": 10, "top_k": 2}
+
+    objects = client.get("/image", params=params).json()
+    columnar = client.get("/image", params={**params, "format": "columnar"}).json()
+
+    assert columnar["ids"] == [11, 12]
+    assert columnar == as_columns(objects)
@@ -0,0 +1,59 @@
+import asyncio
+
+from app.result_cache import ResultCache
+
+
+def test_hit_within_version():
+    cache = ResultCache(max_size=10)
+    cache.set_version(1)
+
+    key = cache.key("image", 1, 5)
+    asyncio.run(cache.put(key, b"[2, 3]"))
+
+    assert asyncio.run(cache.get(cache.key("image", 1, 5))) == b"[2, 3]"
+    assert cache.stats["hits"] == 1
+
+
+def test_version_bump_invalidates():
+    cache = ResultCache(max_size=10)
+    cache.set_version(1)
+    stale_key = cache.key("image", 1, 5)
+    asyncio.run(cache.put(cache.key("image", 1, 5), b"[2, 3]"))
+
+    cache.set_version(2)
+    # A result computed before the bump is not stored under the new version
+    asyncio.run(cache.put(stale_key, b"[4]"))
+
+    assert asyncio.run(cache.get(cache.key("image", 1, 5))) is None
+    assert len(cache) == 0
+
+
+def test_bypassed_without_version():
+    cache = ResultCache(max_size=10)
+
+    assert cache.key("image", 1, 5) is None
+    assert asyncio.run(cache.get(None)) is None
+
+
+class FakeRedis:
+    def __init__(self):
+        self.entries = {}
+
+    async def get(self, key):
+        return self.entries.get(key)
+
+    async def set(self, key, value, ex=None):  # noqa: ARG002
+        self.entries[key] = value
+
+
+def test_stale_result_is_not_shared():
+    cache = ResultCache(max_size=10)
+    cache._redis = FakeRedis()  # noqa: SLF001
+    cache.set_version(1)
+    stale_key = cache.key("image", 1, 5)
+
+    cache.set_version(2)
+    asyncio.run(cache.put(stale_key, b"[4]"))
+    asyncio.run(cache.put(cache.key("image", 2, 5), b"[6]"))
+
+    assert list(cache._redis.entries.values()) == [b"[6]"]  # noqa: SLF001
@@ -0,0 +1,63 @@
+import numpy as np
+
+from etl.embed import cache as cache_module
+from etl.embed.cache import CachedTextEmbedder
+
+
+class FakeTextEmbedder:
+    """Embeds a text as its length, and records the texts of every call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        texts = [texts] if isinstance(texts, str) else texts
+        self.calls.append(texts)
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+
+
+def test_least_recently_used_entry_is_evicted():
+    text_embedder = FakeTextEmbedder()
+    cache = CachedTextEmbedder(text_embedder, max_size=2)
+
+    cache("a")
+    cache("bb")
+    # Using "a" again makes "bb" the least recently used entry
+    cache("a")
+    cache("ccc")
+
+    assert len(cache) == 2
+    cache("a")
+    cache("bb")
+    assert text_embedder.calls == [["a"], ["bb"], ["ccc"], ["bb"]]
+    assert cache.stats["hits"] == 2
+
+
+def test_expired_entry_is_embedded_again(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module, "time", lambda: now[0])
+    text_embedder = FakeTextEmbedder()
+    cache = CachedTextEmbedder(text_embedder, ttl=60)
+
+    cache("a portrait")
+    now[0] += 30
+    cache("A  Portrait")
+    now[0] += 61
+    embedding = cache("a portrait")
+
+    assert text_embedder.calls == [["a portrait"], ["a portrait"]]
+    assert embedding.tolist() == [10.0, 1.0]
+
+
+def test_saved_entries_are_loaded_again(tmp_path):
+    path = tmp_path / "text_embeddings.npz"
+    cache = CachedTextEmbedder(FakeTextEmbedder(), persist_path=path)
+    cache("a portrait")
+    cache.save()
+
+    text_embedder = FakeTextEmbedder()
+    loaded = CachedTextEmbedder(text_embedder, persist_path=path)
+
+    assert loaded("a portrait").tolist() == [10.0, 1.0]
+    assert text_embedder.calls == []
+    assert [file.name for file in tmp_path.iterdir()] == ["text_embeddings.npz"]
@@ -0,0 +1,68 @@
+import numpy as np
+
+from db.sharded_store import ShardedVectorStore
+from db.vector_store import VectorStore
+
+RNG = np.random.default_rng(42)
+
+
+def random_store(n: int, block_size: int) -> VectorStore:
+    vectors = RNG.standard_normal((n, 512)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(1, n + 1, dtype=np.int64)
+    return VectorStore(ids, vectors, block_size=block_size)
+
+
+def test_search_matches_exact_scan():
+    store = random_store(1000, block_size=128)
+    query = store.vectors[10]
+
+    ids, scores = store.search(query, 5)
+
+    expected = np.argsort(-(store.vectors @ query))[:5] + 1
+    assert ids.tolist() == expected.tolist()
+    assert ids[0] == 11
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_search_excludes_id():
+    store = random_store(100, block_size=16)
+
+    ids, _ = store.search(store.get_vector(42), 10, exclude_id=42)
+
+    assert len(ids) == 10
+    assert 42 not in ids
+
+
+def test_get_vector_unknown_id():
+    store = random_store(10, block_size=4)
+
+    assert store.get_vector(1000) is None
+
+
+def test_sharded_search_matches_single_store():
+    store = random_store(1000, block_size=128)
+    sharded = ShardedVectorStore(store.ids, store.vectors, shards=3, block_size=128)
+    try:
+        queries = store.get_vectors([5, 500, 999])
+
+        ids, scores = sharded.search_batch(queries, 10, exclude_ids=[5, None, 999])
+        expected_ids, expected_scores = store.search_batch(queries, 10, exclude_ids=[5, None, 999])
+    finally:
+        sharded.close()
+
+    assert [query_ids.tolist() for query_ids in ids] == [query_ids.tolist() for query_ids in expected_ids]
+    assert np.allclose(np.stack(scores), np.stack(expected_scores))
+
+
+def test_search_rows_matches_search_over_subset():
+    store = random_store(1000, block_size=128)
+    subset_ids = [3, 17, 256, 511, 700, 999]
+    query = store.get_vector(17)
+
+    ids, scores = store.search_rows(query, 3, store.rows_of([*subset_ids, 5000]), exclude_id=17)
+
+    subset = VectorStore(np.array(subset_ids), store.get_vectors(subset_ids))
+    expected_ids, expected_scores = subset.search(query, 3, exclude_id=17)
+    assert ids.tolist() == expected_ids.tolist()
+    assert np.allclose(scores, expected_scores)
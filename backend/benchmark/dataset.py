@@ -0,0 +1,140 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from sqlmodel import Session
+
+from config import settings
+from db.crud import (
+    check_count_art_objects,
+    insert_batch_image_embeddings,
+    retrieve_unembedded_image_art,
+    save_objects_to_database,
+)
+from db.models import EMBEDDING_DIM, ArtObjects, create_db_and_tables, engine, refresh_embedding_index
+from db.vector_store import build_snapshot
+from etl.dim_reduc import fit_pca_on_all
+
+BENCHMARK_SOURCE = "benchmark"
+SEED_BATCH_SIZE = 10000
+
+ARTISTS = [
+    "Rembrandt van Rijn",
+    "Johannes Vermeer",
+    "Jan Steen",
+    "Frans Hals",
+    "Vincent van Gogh",
+    "Jacob van Ruisdael",
+    "Pieter de Hooch",
+    "Judith Leyster",
+    "anonymous",
+]
+SUBJECTS = ["portrait", "landscape", "still life", "seascape", "interior", "street", "flowers", "horse", "church"]
+QUALIFIERS = [
+    "of a woman",
+    "of a man",
+    "with ships",
+    "at night",
+    "in winter",
+    "with a dog",
+    "in a vase",
+    "near a river",
+]
+
+
+def fake_title(rng: np.random.Generator) -> str:
+    return f"{rng.choice(SUBJECTS).capitalize()} {rng.choice(QUALIFIERS)}"
+
+
+def fake_query(rng: np.random.Generator) -> str:
+    """A random text query, drawn from enough combinations that a benchmark run rarely repeats one."""
+    return f"{fake_title(rng)} by {rng.choice(ARTISTS)} {rng.integers(1_000_000)}"
+
+
+def random_embeddings(rng: np.random.Generator, centers: np.ndarray, count: int, spread: float) -> np.ndarray:
+    """
+    Normalized vectors scattered around random cluster centers.
+
+    Uniformly random vectors in 512 dimensions are all about equally far apart, which is the worst case
+    for an ANN index. Clustering them gives the index a structure more like that of real embeddings.
+    """
+    vectors = centers[rng.integers(len(centers), size=count)]
+    vectors = vectors + spread * rng.standard_normal((count, EMBEDDING_DIM)) / np.sqrt(EMBEDDING_DIM)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def seed_dataset(
+    size: int, clusters: int = 100, spread: float = 1.0, seed: int = 42, snapshot_dir: Path | None = None
+) -> None:
+    """
+    Fill the configured database with `size` fake ArtObjects with random embeddings, for benchmarking.
+
+    This goes through the same functions as the ETL, so the tables, indexes, coordinates and PCA model
+    end up as they would for real data. Use a dedicated database, and point `pca_path` away from the
+    real model, as both are written to.
+
+    Parameters
+    ----------
+    size: int
+        Amount of ArtObjects to add.
+    clusters: int
+        Amount of cluster centers the embeddings are scattered around, 0 for uniformly random embeddings.
+    spread: float
+        Distance of the embeddings to their cluster center, relative to the length of the center.
+    seed: int
+        Seed of the random generator, the same seed gives the same dataset.
+    snapshot_dir: Path | None
+        Also write a vector snapshot for the memmap search backend to this directory.
+
+    """
+    rng = np.random.default_rng(seed)
+    if clusters:
+        centers = rng.standard_normal((clusters, EMBEDDING_DIM))
+        centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    else:
+        # Scattering around the origin gives uniformly random directions
+        centers, spread = np.zeros((1, EMBEDDING_DIM)), 1.0
+
+    create_db_and_tables()
+    offset = check_count_art_objects()
+    logger.info(f"Adding {size} benchmark art objects to the {offset} in the database.")
+
+    for start in range(0, size, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, size - start)
+        save_objects_to_database(
+            [
+                ArtObjects(
+                    original_id=f"{BENCHMARK_SOURCE}-{offset + start + i}",
+                    image_url=f"https://example.com/{offset + start + i}.jpg",
+                    long_title=fake_title(rng),
+                    artist=str(rng.choice(ARTISTS)),
+                    source=BENCHMARK_SOURCE,
+                )
+                for i in range(count)
+            ]
+        )
+
+        art_object_ids = [art_object_id for art_object_id, _ in retrieve_unembedded_image_art(count)]
+        embeddings = random_embeddings(rng, centers, len(art_object_ids), spread)
+        insert_batch_image_embeddings(Session(engine), list(zip(art_object_ids, embeddings, strict=True)))
+        logger.info(f"Added {start + count} benchmark art objects.")
+
+    refresh_embedding_index()
+    fit_pca_on_all()
+    if snapshot_dir is not None:
+        build_snapshot(snapshot_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill a dedicated database with a synthetic benchmark dataset")
+    parser.add_argument("--size", type=int, default=10000, help="Amount of fake art objects")
+    parser.add_argument("--clusters", type=int, default=100, help="Cluster centers, 0 for uniform embeddings")
+    parser.add_argument("--spread", type=float, default=1.0, help="Distance of embeddings to their center")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random generator")
+    parser.add_argument("--snapshot-dir", type=Path, default=None, help="Also write a memmap vector snapshot")
+    args = parser.parse_args()
+
+    if settings.pca_path == type(settings).model_fields["pca_path"].default:
+        logger.warning(f"Overwriting the PCA model at {settings.pca_path}, set PCA_PATH to keep it.")
+    seed_dataset(args.size, args.clusters, args.spread, args.seed, args.snapshot_dir)
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import json
+import platform
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+from pathlib import Path
+from time import perf_counter, time
+
+import httpx
+import numpy as np
+from loguru import logger
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from benchmark.dataset import fake_query
+from config import settings
+from db.crud import check_count_art_objects
+from db.models import Embeddings, engine
+
+SCENARIOS = ["query", "image", "query_batch", "image_batch"]
+READY_TIMEOUT = 600
+
+# A scenario makes one request, using the random generator for its parameters
+Request = Callable[[httpx.AsyncClient, np.random.Generator], Awaitable[httpx.Response]]
+
+
+def make_requests(id_range: tuple[int, int], top_k: int, batch_size: int) -> dict[str, Request]:
+    low, high = id_range
+
+    def random_ids(rng: np.random.Generator, count: int) -> list[int]:
+        return rng.integers(low, high + 1, size=count).tolist()
+
+    return {
+        "query": lambda client, rng: client.get("/query", params={"art_query": fake_query(rng), "top_k": top_k}),
+        "image": lambda client, rng: client.get("/image", params={"idx": random_ids(rng, 1)[0], "top_k": top_k}),
+        "query_batch": lambda client, rng: client.post(
+            "/query/batch", json={"art_queries": [fake_query(rng) for _ in range(batch_size)], "top_k": top_k}
+        ),
+        "image_batch": lambda client, rng: client.post(
+            "/image/batch", json={"idxs": random_ids(rng, batch_size), "top_k": top_k}
+        ),
+    }
+
+
+def embedded_id_range() -> tuple[int, int]:
+    """Lowest and highest id of the ArtObjects with an embedding, which /image can be asked about."""
+    with Session(engine) as session:
+        low, high = session.exec(select(func.min(Embeddings.art_object_id), func.max(Embeddings.art_object_id))).one()
+    if low is None:
+        msg = "There are no embeddings in the database, seed it with `python -m benchmark.dataset`"
+        raise ValueError(msg)
+    return low, high
+
+
+def summarize(latencies: list[float], errors: int, not_found: int, elapsed: float) -> dict:
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else (None, None, None)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        # Random ids can fall in gaps of the id range, those requests are measured but are cheaper
+        "not_found": not_found,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": float(latencies_ms.mean()) if len(latencies_ms) else None,
+            "p50": None if p50 is None else float(p50),
+            "p95": None if p95 is None else float(p95),
+            "p99": None if p99 is None else float(p99),
+            "max": float(latencies_ms.max()) if len(latencies_ms) else None,
+        },
+    }
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, request: Request, concurrency: int, total: int, warmup: int, seed: int
+) -> dict:
+    """Send `total` requests from `concurrency` concurrent clients, after `warmup` requests that are not measured."""
+    rng = np.random.default_rng(seed)
+    for _ in range(warmup):
+        await request(client, rng)
+
+    latencies: list[float] = []
+    errors = 0
+    not_found = 0
+    remaining = total
+
+    async def worker() -> None:
+        nonlocal remaining, errors, not_found
+        while remaining > 0:
+            remaining -= 1
+            start = perf_counter()
+            try:
+                status = (await request(client, rng)).status_code
+            except httpx.HTTPError:
+                status = None
+            latencies.append(perf_counter() - start)
+            not_found += status == httpx.codes.NOT_FOUND
+            errors += status is None or (status >= httpx.codes.BAD_REQUEST and status != httpx.codes.NOT_FOUND)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, not_found, perf_counter() - start)
+
+
+@asynccontextmanager
+async def benchmark_client(url: str | None):
+    """Client for a running API at `url`, or for the app running in this process when no url is given."""
+    if url is not None:
+        async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+            yield client
+        return
+
+    from app.main import app
+    from app.resources import resources
+
+    async with app.router.lifespan_context(app):
+        start = time()
+        while not resources.ready:
+            if time() - start > READY_TIMEOUT:
+                msg = f"The API did not become ready within {READY_TIMEOUT} seconds"
+                raise TimeoutError(msg)
+            await asyncio.sleep(0.5)
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            yield client
+
+
+async def run_benchmark(
+    scenarios: list[str],
+    concurrencies: list[int],
+    requests: int,
+    warmup: int,
+    top_k: int,
+    batch_size: int,
+    url: str | None,
+    seed: int,
+) -> dict:
+    id_range = embedded_id_range()
+    request_makers = make_requests(id_range, top_k, batch_size)
+
+    results = []
+    async with benchmark_client(url) as client:
+        for scenario in scenarios:
+            for concurrency in concurrencies:
+                logger.info(f"Benchmarking {scenario} with concurrency {concurrency}.")
+                result = await run_scenario(client, request_makers[scenario], concurrency, requests, warmup, seed)
+                results.append({"scenario": scenario, "concurrency": concurrency, **result})
+                logger.info(f"{scenario} x{concurrency}: {result['throughput_rps']:.1f} rps, {result['latency_ms']}")
+
+    return {
+        "created_at": time(),
+        "target": url or "in-process",
+        "machine": {"python": platform.python_version(), "platform": platform.platform()},
+        "config": {
+            "search_backend": settings.search_backend,
+            "ann_index_method": settings.ann_index_method,
+            "embedding_precision": settings.embedding_precision,
+            "embedder_backend": settings.embedder_backend,
+            "rerank_candidates": settings.rerank_candidates,
+            "knn_graph_size": settings.knn_graph_size,
+            "result_cache_size": settings.result_cache_size,
+            "top_k": top_k,
+            "batch_size": batch_size,
+            "requests": requests,
+            "warmup": warmup,
+            "id_range": id_range,
+        },
+        "dataset_size": check_count_art_objects(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure throughput and latency of the search API")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS, help="Endpoints to drive")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32], help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests per scenario and concurrency")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests before each measurement")
+    parser.add_argument("--top-k", type=int, default=10, help="Neighbours per request")
+    parser.add_argument("--batch-size", type=int, default=16, help="Queries or ids per batch request")
+    parser.add_argument("--url", default=None, help="Running API to benchmark, the app is run in-process otherwise")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the request parameters")
+    parser.add_argument("--output", type=Path, default=None, help="JSON file to write the report to")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_benchmark(
+            args.scenarios,
+            args.concurrency,
+            args.requests,
+            args.warmup,
+            args.top_k,
+            args.batch_size,
+            args.url,
+            args.seed,
+        )
+    )
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(output)
+        logger.info(f"Wrote benchmark report to {args.output}")
+    else:
+        print(output)  # noqa: T201
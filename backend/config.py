@@ -1,9 +1,166 @@
+from enum import StrEnum
+from pathlib import Path
+
+from pydantic import Field
 from pydantic_settings import BaseSettings
 
+BACKEND_DIR = Path(__file__).resolve().parent
+# Largest HNSW candidate list size pgvector accepts for hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+
+class SearchBackend(StrEnum):
+    PGVECTOR = "pgvector"
+    MEMMAP = "memmap"
+    # The memmap snapshot split over worker processes, which each search their shard of it
+    SHARDED = "sharded"
+
+
+class AnnIndexMethod(StrEnum):
+    HNSW = "hnsw"
+    IVFFLAT = "ivfflat"
+
+
+class EmbeddingPrecision(StrEnum):
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+
+
+class EmbedderBackend(StrEnum):
+    TORCH = "torch"
+    ONNX = "onnx"
+
+
+class ImageCacheVariant(StrEnum):
+    # The image file as the CDN served it
+    ORIGINAL = "original"
+    # Shortest side resized to the CLIP input size, stored lossless so embeddings match those of the original
+    RESIZED = "resized"
+
 
 class Settings(BaseSettings):
     database_url: str
 
+    # Connection pool of each engine, the API holds one sync and one async engine per worker
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+
+    # Threads that run model inference for the async routes. Requests wait on a thread while their text
+    # is being batched, so this should be at least `text_embedding_max_batch_size`.
+    inference_workers: int = 32
+
+    # Worker processes of `python -m app.serve`, which loads the models and vector data once before forking the
+    # workers so they share that memory. Each worker gets `inference_threads` intra-op threads for model inference,
+    # 0 divides the available cores over the workers.
+    serve_workers: int = 1
+    serve_host: str = "0.0.0.0"  # noqa: S104
+    serve_port: int = 8000
+    inference_threads: int = 0
+    # Directory where every worker writes a snapshot of its request metrics each interval, so /metrics reports the
+    # totals of all workers rather than those of the worker that answers the scrape. With several workers, a
+    # temporary directory is used when none is given. Cache hit metrics are still reported per worker.
+    metrics_dir: Path | None = None
+    metrics_snapshot_interval: float = 1.0
+
+    # Which engine answers nearest neighbour queries, Postgres is always used to hydrate ArtObjects
+    search_backend: SearchBackend = SearchBackend.PGVECTOR
+    vector_snapshot_dir: Path = BACKEND_DIR / "models" / "vectors"
+    # Worker processes of the sharded backend, 0 starts one per core. The shards are held by every API worker, so
+    # this backend is meant for a single worker per host.
+    vector_shards: int = 0
+
+    # Version of the 2-D map projection in `pca_path`, bump it when refitting the PCA
+    projection_version: int = 1
+    pca_path: Path = BACKEND_DIR / "models" / "pca.joblib"
+
+    # Storage type of Embeddings.image, float16 uses pgvector's halfvec. Changing it requires a migration,
+    # see `python -m db.models --migrate-precision`
+    embedding_precision: EmbeddingPrecision = EmbeddingPrecision.FLOAT32
+
+    # Neighbours per art object in the precomputed graph of `python -m etl.knn_graph`. /image looks them up
+    # instead of searching when top_k is at most this, 0 disables the lookup. Once built, the embed stage merges the
+    # art objects it embedded into the graph.
+    knn_graph_size: int = 15
+
+    # Hybrid /query mode: candidates taken from both the lexical and the vector retrieval, and the constant of
+    # reciprocal rank fusion, higher values flatten the difference between high and low ranks
+    hybrid_candidates: int = 30
+    hybrid_rrf_k: int = 60
+
+    # Filtered searches: filters that match at most `filter_exact_threshold` art objects are searched exactly over
+    # just those. Broader filters over-fetch nearest neighbours and filter them, the amount of candidates grows by
+    # `filter_overfetch` until enough match or `filter_max_candidates` is passed. Then pgvector falls back to an exact
+    # search, while the memmap and sharded backends return the matches they found.
+    filter_exact_threshold: int = 20000
+    filter_overfetch: int = 4
+    filter_max_candidates: int = Field(default=1000, ge=1, le=HNSW_MAX_EF_SEARCH)
+
+    # When set, the pgvector backend first selects this many candidates by Hamming distance between binary codes
+    # of the embeddings and then re-ranks those by exact cosine distance. 0 searches the full vectors directly. The
+    # HNSW candidate list is raised to hold all candidates, which limits them to the largest list size.
+    rerank_candidates: int = Field(default=0, ge=0, le=HNSW_MAX_EF_SEARCH)
+
+    # Approximate nearest neighbour index on Embeddings.image used by the pgvector backend
+    ann_index_method: AnnIndexMethod = AnnIndexMethod.HNSW
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    # After a bulk load, the IVFFlat index is rebuilt once the amount of embeddings differs by more than this
+    # fraction from the amount it was built on
+    ivfflat_rebuild_threshold: float = 0.2
+
+    # Runtime of the CLIP encoders, the onnx graphs are written by `python -m etl.embed.onnx_models`
+    embedder_backend: EmbedderBackend = EmbedderBackend.TORCH
+    onnx_model_dir: Path = BACKEND_DIR / "models" / "onnx"
+    onnx_quantized: bool = False
+    # 0 lets ONNX Runtime pick the amount of threads, or uses `inference_threads` when serving several workers
+    onnx_intra_op_threads: int = 0
+    onnx_inter_op_threads: int = 0
+
+    # On-disk cache of the images the embed stage downloads, disabled without a directory. The least recently used
+    # images are evicted beyond the maximum size. In cache-only mode images are never downloaded, those that are not
+    # cached are skipped, so re-embedding and benchmarking can run offline.
+    image_cache_dir: Path | None = None
+    image_cache_max_bytes: int = 20 * 1024**3
+    image_cache_variant: ImageCacheVariant = ImageCacheVariant.ORIGINAL
+    image_cache_only: bool = False
+
+    # Passes over sample inputs after loading the models, before the API reports itself ready
+    warmup_iterations: int = 1
+
+    # Cache of CLIP text embeddings for /query, persisted on shutdown when a path is given
+    text_embedding_cache_size: int = 10000
+    text_embedding_cache_ttl: float | None = None
+    text_embedding_cache_path: Path | None = None
+
+    # Concurrent /query requests arriving within the wait time are embedded in one batch
+    text_embedding_max_batch_size: int = 16
+    text_embedding_max_wait_ms: float = 5.0
+
+    # Cache of /query and /image responses, keyed on the dataset version so it is invalidated whenever the data
+    # changes. The version is polled from the database every interval, 0 disables the cache. With a Redis url,
+    # cached responses are shared by all workers, where entries of old versions expire after the shared TTL.
+    result_cache_size: int = 10000
+    result_cache_redis_url: str | None = None
+    result_cache_shared_ttl: int = 24 * 60 * 60
+    # When a refit of the PCA changed the version, polling also reloads the projection of each worker.
+    dataset_version_poll_interval: float = 5.0
+    # Token for the admin endpoints and for profiling a request with the X-Profile header or `profile=true`,
+    # both are disabled without one. In the background, a fraction of requests is profiled and the slowest kept.
+    # Profiles are kept per worker, with several `serve_workers` the admin endpoints only see those of the worker
+    # that answers them.
+    admin_token: str | None = None
+    profile_interval_ms: float = 5.0
+    profile_sample_rate: float = 0.0
+    profile_keep_slowest: int = 10
+    profile_max_concurrent: int = 2
+
+    @property
+    def async_database_url(self) -> str:
+        """The database url with its driver replaced by asyncpg."""
+        scheme, rest = self.database_url.split("://", 1)
+        return f"{scheme.split('+')[0]}+asyncpg://{rest}"
+
 
 class EtlSettings(Settings):
     rijksmuseum_api_key: str
@@ -0,0 +1,324 @@
+import asyncio
+from time import monotonic, perf_counter
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import SearchBackend, settings
+from db.crud import (
+    ArtObjectWithCoords,
+    ann_search_params,
+    art_objects_by_ids_statement,
+    best_image_match_statement,
+    best_image_matches_statement,
+    closest_to_artobject_statement,
+    closest_to_artobjects_statement,
+    dataset_version_statement,
+    embeddings_by_ids_statement,
+    exact_filtered_statement,
+    filter_clauses,
+    filtered_count_statement,
+    filtered_ids_statement,
+    group_by_query,
+    knn_graph_built_statement,
+    lexical_match_statement,
+    order_by_ids,
+    overfetch_filtered_statement,
+    precomputed_neighbours_statement,
+    rerank_ef_search,
+    split_graph_hits,
+    use_knn_graph,
+)
+from db.models import ArtObjectFilter, Embeddings
+from db.vector_store import get_vector_store
+from metrics import STAGE_DURATION, Stage
+
+async_engine = create_async_engine(
+    settings.async_database_url,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_pre_ping=True,
+)
+
+# Whether the precomputed graph holds any neighbours, checked again once the dataset version poll interval has passed
+_knn_graph_built = False
+_knn_graph_checked_at: float | None = None
+
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):  # noqa: ARG001
+    context._query_start = perf_counter()  # noqa: SLF001
+
+
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):  # noqa: ARG001
+    # asyncpg fetches all rows while executing, so this includes transferring the results
+    STAGE_DURATION.observe(perf_counter() - context._query_start, Stage.DB_QUERY)  # noqa: SLF001
+
+
+async def _set_ann_search_params(session: AsyncSession, ef_search: int | None, probes: int | None) -> None:
+    for statement, params in ann_search_params(ef_search, probes):
+        await session.execute(statement, params)
+
+
+async def _hydrate_art_objects(
+    art_object_ids: list[int], filters: ArtObjectFilter | None = None
+) -> list[ArtObjectWithCoords]:
+    statement = art_objects_by_ids_statement(art_object_ids).where(*filter_clauses(filters))
+    async with AsyncSession(async_engine) as session:
+        rows = (await session.exec(statement)).all()
+
+    return order_by_ids(rows, art_object_ids)
+
+
+async def _retrieve_filtered_memmap(
+    embedding: np.ndarray, top_k: int, filters: ArtObjectFilter, exclude_id: int | None, *, exact: bool
+) -> list[ArtObjectWithCoords]:
+    store = get_vector_store()
+
+    if exact:
+        async with AsyncSession(async_engine) as session:
+            filtered_ids = (await session.exec(filtered_ids_statement(filters))).all()
+        # The snapshot can lag behind the database, ids that are not in it yet are left out
+        rows = store.rows_of(filtered_ids)
+        ids, _ = await asyncio.to_thread(store.search_rows, embedding, top_k, rows, exclude_id=exclude_id)
+        return await _hydrate_art_objects(ids.tolist())
+
+    rows = []
+    candidates = top_k * settings.filter_overfetch
+    while candidates <= settings.filter_max_candidates:
+        ids, _ = await asyncio.to_thread(store.search, embedding, candidates, exclude_id=exclude_id)
+        rows = await _hydrate_art_objects(ids.tolist(), filters)
+        # Fewer ids than candidates means the whole snapshot has been searched
+        if len(rows) >= top_k or len(ids) < candidates:
+            break
+        candidates *= settings.filter_overfetch
+
+    if len(rows) < top_k:
+        # Scanning the embeddings of all ArtObjects that pass a broad filter costs more than it is worth
+        logger.debug(f"Over-fetching found {len(rows)} of {top_k} matches for {filters}.")
+    return rows[:top_k]
+
+
+async def retrieve_filtered(
+    query_image: np.ndarray | None,
+    top_k: int,
+    filters: ArtObjectFilter,
+    exclude_id: int | None = None,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[ArtObjectWithCoords]:
+    """
+    Nearest neighbours among the ArtObjects that pass the filters, with a strategy picked by their selectivity.
+
+    A plain filter on an ANN search either scans everything or returns too few rows, because the index
+    returns its nearest candidates before the filter is applied. Instead, narrow filters are searched
+    exactly over the embeddings that pass them. Broad filters over-fetch candidates from the ANN index,
+    fetching more until `top_k` of them pass. When that takes too many, pgvector falls back to an exact
+    search, the in-process backends return the matches found so far rather than scanning every embedding
+    that passes the filters.
+
+    Parameters
+    ----------
+    query_image: np.ndarray | None
+        Query embedding, or None to use the stored embedding of `exclude_id`.
+    top_k: int
+        Amount of neighbours to return.
+    filters: ArtObjectFilter
+        Filters the neighbours have to pass.
+    exclude_id: int | None
+        ArtObject that should not be returned, e.g. the one that is queried for.
+    ef_search: int | None
+        Minimum HNSW candidate list size, it is raised to the amount of over-fetched candidates.
+    probes: int | None
+        Amount of IVFFlat lists to search.
+
+    """
+    async with AsyncSession(async_engine) as session:
+        count = (await session.exec(filtered_count_statement(filters, settings.filter_exact_threshold + 1))).one()
+    exact = count <= settings.filter_exact_threshold
+
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        if query_image is None:
+            query_image = get_vector_store().get_vector(exclude_id)
+            if query_image is None:
+                return []
+        return await _retrieve_filtered_memmap(query_image, top_k, filters, exclude_id, exact=exact)
+
+    if query_image is None:
+        query_image = select(Embeddings.image).where(Embeddings.art_object_id == exclude_id).scalar_subquery()
+
+    if not exact:
+        candidates = top_k * settings.filter_overfetch
+        while candidates <= settings.filter_max_candidates:
+            async with AsyncSession(async_engine) as session:
+                # The index has to produce all candidates, not just its default candidate list size
+                await _set_ann_search_params(session, max(ef_search or 0, candidates), probes)
+                rows = (
+                    await session.exec(
+                        overfetch_filtered_statement(query_image, candidates, top_k, filters, exclude_id)
+                    )
+                ).all()
+
+            if len(rows) == top_k:
+                return list(rows)
+            candidates *= settings.filter_overfetch
+
+        # Few of the nearest neighbours pass the filters, they are more selective here than overall
+        logger.debug(f"Over-fetching did not find {top_k} matches for {filters}, searching exactly.")
+
+    async with AsyncSession(async_engine) as session:
+        return list((await session.exec(exact_filtered_statement(query_image, top_k, filters, exclude_id))).all())
+
+
+async def _knn_graph_is_built() -> bool:
+    """Whether the precomputed graph holds any neighbours, read from the database at most once per poll interval."""
+    global _knn_graph_built, _knn_graph_checked_at  # noqa: PLW0603
+    now = monotonic()
+    if _knn_graph_checked_at is None or now - _knn_graph_checked_at >= settings.dataset_version_poll_interval:
+        async with AsyncSession(async_engine) as session:
+            _knn_graph_built = bool((await session.exec(knn_graph_built_statement())).first())
+        _knn_graph_checked_at = now
+    return _knn_graph_built
+
+
+async def _retrieve_precomputed_neighbours(
+    art_object_ids: list[int], top_k: int
+) -> tuple[dict[int, list[ArtObjectWithCoords]], list[int]]:
+    """Look up neighbours in the precomputed graph, returns the hits and the ids that still need a search."""
+    if not use_knn_graph(top_k) or not await _knn_graph_is_built():
+        return {}, art_object_ids
+
+    async with AsyncSession(async_engine) as session:
+        rows = (await session.exec(precomputed_neighbours_statement(art_object_ids, top_k))).all()
+
+    return split_graph_hits(rows, art_object_ids, top_k)
+
+
+async def retrieve_closest_to_artobject(
+    art_object_id: int,
+    top_k: int,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    filters: ArtObjectFilter | None = None,
+) -> list[ArtObjectWithCoords]:
+    if filters is not None and not filters.is_empty():
+        return await retrieve_filtered(None, top_k, filters, art_object_id, ef_search, probes)
+
+    hits, _ = await _retrieve_precomputed_neighbours([art_object_id], top_k)
+    if art_object_id in hits:
+        return hits[art_object_id]
+
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        embedding = store.get_vector(art_object_id)
+        if embedding is None:
+            return []
+        # NumPy releases the GIL during the matmul, so the search does not block the event loop
+        ids, _ = await asyncio.to_thread(store.search, embedding, top_k, exclude_id=art_object_id)
+        return await _hydrate_art_objects(ids.tolist())
+
+    async with AsyncSession(async_engine) as session:
+        await _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        return list((await session.exec(closest_to_artobject_statement(art_object_id, top_k))).all())
+
+
+async def retrieve_best_image_match_w_embedding(
+    embedding: np.ndarray,
+    top_k: int,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    filters: ArtObjectFilter | None = None,
+) -> list[ArtObjectWithCoords]:
+    if filters is not None and not filters.is_empty():
+        return await retrieve_filtered(embedding, top_k, filters, None, ef_search, probes)
+
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        ids, _ = await asyncio.to_thread(store.search, embedding, top_k)
+        return await _hydrate_art_objects(ids.tolist())
+
+    async with AsyncSession(async_engine) as session:
+        await _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        return list((await session.exec(best_image_match_statement(embedding, top_k))).all())
+
+
+async def retrieve_lexical_matches(
+    query: str, top_k: int, filters: ArtObjectFilter | None = None
+) -> list[ArtObjectWithCoords]:
+    async with AsyncSession(async_engine) as session:
+        return list((await session.exec(lexical_match_statement(query, top_k, filters))).all())
+
+
+async def retrieve_best_image_matches_w_embeddings(
+    embeddings: np.ndarray, top_k: int, ef_search: int | None = None, probes: int | None = None
+) -> list[list[ArtObjectWithCoords]]:
+    """Nearest neighbours for several query embeddings at once, in one search pass and one round trip."""
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        ids_per_query, _ = await asyncio.to_thread(store.search_batch, embeddings, top_k)
+        all_ids = list(dict.fromkeys(art_object_id for ids in ids_per_query for art_object_id in ids.tolist()))
+        rows = await _hydrate_art_objects(all_ids)
+        return [order_by_ids(rows, ids.tolist()) for ids in ids_per_query]
+
+    async with AsyncSession(async_engine) as session:
+        await _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        rows = (await session.exec(best_image_matches_statement(embeddings, top_k))).all()
+
+    grouped = group_by_query(rows)
+    return [grouped.get(query_index, []) for query_index in range(len(embeddings))]
+
+
+async def retrieve_closest_to_artobjects(
+    art_object_ids: list[int], top_k: int, ef_search: int | None = None, probes: int | None = None
+) -> dict[int, list[ArtObjectWithCoords]]:
+    """
+    Nearest neighbours of several ArtObjects at once, in one search pass and one round trip.
+
+    Ids of ArtObjects without an embedding are left out of the result. ArtObjects in the precomputed
+    neighbour graph are looked up, only the others are searched for.
+    """
+    hits, art_object_ids = await _retrieve_precomputed_neighbours(art_object_ids, top_k)
+    if not art_object_ids:
+        return hits
+
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        known_ids = [art_object_id for art_object_id in art_object_ids if store.get_vector(art_object_id) is not None]
+        if not known_ids:
+            return hits
+
+        ids_per_query, _ = await asyncio.to_thread(
+            store.search_batch, store.get_vectors(known_ids), top_k, exclude_ids=known_ids
+        )
+        all_ids = list(dict.fromkeys(art_object_id for ids in ids_per_query for art_object_id in ids.tolist()))
+        rows = await _hydrate_art_objects(all_ids)
+        return hits | {
+            art_object_id: order_by_ids(rows, ids.tolist())
+            for art_object_id, ids in zip(known_ids, ids_per_query, strict=True)
+        }
+
+    async with AsyncSession(async_engine) as session:
+        await _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        rows = (await session.exec(closest_to_artobjects_statement(art_object_ids, top_k))).all()
+
+    return hits | group_by_query(rows)
+
+
+async def retrieve_embeddings_by_ids(art_object_ids: list[int]) -> dict[int, np.ndarray]:
+    async with AsyncSession(async_engine) as session:
+        rows = (await session.exec(embeddings_by_ids_statement(art_object_ids))).all()
+
+    return dict(rows)
+
+
+async def retrieve_dataset_version() -> int:
+    async with AsyncSession(async_engine) as session:
+        version = (await session.exec(dataset_version_statement())).first()
+
+    return version or 0
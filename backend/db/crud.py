@@ -1,9 +1,50 @@
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
 import numpy as np
-import torch
-from sqlalchemy import func
+from sqlalchemy import (
+    ColumnElement,
+    Subquery,
+    TextClause,
+    and_,
+    bindparam,
+    cast,
+    delete,
+    func,
+    literal,
+    literal_column,
+    or_,
+    text,
+    true,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel import Session, col, exists, select
+from sqlmodel.sql.expression import Select
+
+from config import SearchBackend, settings
+from db.models import (
+    SEARCH_DOCUMENT_COLUMN,
+    TEXT_SEARCH_CONFIG,
+    ArtCoordinates,
+    ArtNeighbours,
+    ArtObjectFilter,
+    ArtObjects,
+    DatasetVersion,
+    Embeddings,
+    bump_dataset_version_statement,
+    embedding_column_type,
+    engine,
+)
+from db.quantization import binary_code
+from db.vector_store import get_vector_store
+
+if TYPE_CHECKING:
+    import torch
 
-from db.models import ArtObjects, Embeddings, engine
+# An ArtObject with its x and y coordinate on the map, which are None if it has not been projected yet
+ArtObjectWithCoords = tuple[ArtObjects, float | None, float | None]
 
 
 def check_count_art_objects() -> int:
@@ -13,15 +54,53 @@ def check_count_art_objects() -> int:
         return count if count else 0
 
 
+def _bump_dataset_version(session: Session) -> None:
+    """Increment the dataset version as part of the session's transaction, this invalidates cached API results."""
+    session.execute(bump_dataset_version_statement())
+
+
+def bump_dataset_version() -> None:
+    with Session(engine) as session:
+        _bump_dataset_version(session)
+        session.commit()
+
+
+def _last_embedding_id() -> int:
+    with Session(engine) as session:
+        return session.exec(select(func.max(Embeddings.id))).one() or 0
+
+
+@contextmanager
+def bump_dataset_version_after_ingest() -> Iterator[None]:
+    """
+    Bump the dataset version once at the end of an ingest run, if any embeddings were saved in it.
+
+    Embeddings are saved batch by batch, bumping once per run rather than per batch keeps cached API
+    results valid while the run is in progress. The bump also happens when the run fails, so batches
+    that were committed before the failure do not stay hidden behind cached results.
+    """
+    last_id = _last_embedding_id()
+    try:
+        yield
+    finally:
+        if _last_embedding_id() != last_id:
+            bump_dataset_version()
+
+
+def dataset_version_statement() -> Select:
+    return select(DatasetVersion.version).where(DatasetVersion.id == 1)
+
+
 def save_objects_to_database(art_objects: list[ArtObjects]):
     with Session(engine) as session:
         session.bulk_save_objects(art_objects)
+        _bump_dataset_version(session)
         session.commit()
 
 
 def insert_batch_image_embeddings(
     conn: Session,
-    batch_embeddings: list[tuple[int, torch.Tensor]],
+    batch_embeddings: list[tuple[int, np.ndarray]],
 ) -> None:
     """
     Insert a batch of embeddings.
@@ -35,7 +114,7 @@ def insert_batch_image_embeddings(
     ----------
     conn: SQLmodel.Session
         Connection to database.
-    batch_embeddings: list[tuple[int, torch.Tensor]]
+    batch_embeddings: list[tuple[int, np.ndarray]]
         List of tuples, each containing the ID of the corresponding ArtObject and its CLIP embedding
 
     Raises
@@ -49,11 +128,11 @@ def insert_batch_image_embeddings(
         raise ValueError(msg)
 
     with conn as session:
-        embeddings = [
-            Embeddings(art_object_id=art_object_id,
-                       image=embedding.detach().cpu().numpy())
-            for art_object_id, embedding in batch_embeddings
-        ]
+        embeddings = []
+        for art_object_id, embedding in batch_embeddings:
+            embeddings.append(
+                Embeddings(art_object_id=art_object_id, image=embedding, image_code=binary_code(embedding))
+            )
         session.bulk_save_objects(embeddings)
         session.commit()
 
@@ -83,7 +162,7 @@ def retrieve_unembedded_image_art(count: int, offset: int = 0):
         return result.all()
 
 
-def retrieve_best_image_match(embedding: torch.Tensor, top_k: int) -> list[ArtObjects]:
+def retrieve_best_image_match(embedding: "torch.Tensor", top_k: int) -> list[ArtObjects]:
     with Session(engine) as session:
         top_ids = session.exec(
             select(Embeddings.art_object_id)
@@ -97,34 +176,532 @@ def retrieve_best_image_match(embedding: torch.Tensor, top_k: int) -> list[ArtOb
     return list(art_objects)
 
 
-def retrieve_closest_to_artobject(art_object_id: int, top_k: int) -> list[tuple[ArtObjects, np.ndarray]]:
-    with Session(engine) as session:
-        subquery = (
-            select(Embeddings.image)
-            .where(Embeddings.art_object_id == art_object_id)
-            .scalar_subquery()
+def ann_search_params(ef_search: int | None = None, probes: int | None = None) -> list[tuple[TextClause, dict]]:
+    """
+    Statements that tune the recall/latency trade-off of the embedding index for the current transaction only.
+
+    Parameters
+    ----------
+    ef_search: int | None
+        Size of the HNSW candidate list, higher gives better recall. Should be at least `top_k`.
+    probes: int | None
+        Amount of IVFFlat lists to search, higher gives better recall.
+
+    """
+    statements = []
+    if ef_search is not None:
+        statements.append((text("SELECT set_config('hnsw.ef_search', :value, true)"), {"value": str(ef_search)}))
+    if probes is not None:
+        statements.append((text("SELECT set_config('ivfflat.probes', :value, true)"), {"value": str(probes)}))
+    return statements
+
+
+def _set_ann_search_params(session: Session, ef_search: int | None = None, probes: int | None = None) -> None:
+    for statement, params in ann_search_params(ef_search, probes):
+        session.execute(statement, params)
+
+
+def _coordinates_on_clause(projection_version: int) -> ColumnElement[bool]:
+    return and_(
+        ArtCoordinates.art_object_id == ArtObjects.id,
+        ArtCoordinates.projection_version == projection_version,
+    )
+
+
+def art_objects_by_ids_statement(
+    art_object_ids: list[int], projection_version: int = settings.projection_version
+) -> Select:
+    return (
+        select(ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .where(col(ArtObjects.id).in_(art_object_ids))
+    )
+
+
+def order_by_ids(rows: Sequence[ArtObjectWithCoords], art_object_ids: list[int]) -> list[ArtObjectWithCoords]:
+    """Put hydrated ArtObjects in the order of the ids found by an in-process search."""
+    by_id = {row[0].id: row for row in rows}
+    return [by_id[art_object_id] for art_object_id in art_object_ids if art_object_id in by_id]
+
+
+def rerank_ef_search(ef_search: int | None) -> int | None:
+    """
+    HNSW candidate list size for a search that may start with a pass over the binary codes.
+
+    That pass walks the HNSW index on the codes, which returns at most ef_search rows, so the list is
+    made large enough to hold all `rerank_candidates`.
+    """
+    if settings.rerank_candidates:
+        return max(ef_search or 0, settings.rerank_candidates)
+    return ef_search
+
+
+def _binary_candidates(query_code, candidates: int, exclude_id: int | None = None) -> Subquery:
+    """
+    First search pass over the binary codes, selecting `candidates` embeddings by Hamming distance.
+
+    The codes have an HNSW index, see `create_binary_code_index`, so this pass does not scan every embedding.
+    Embeddings without a binary code are left out, see `db.quantization`.
+    """
+    statement = select(Embeddings.art_object_id, Embeddings.image)
+    if exclude_id is not None:
+        statement = statement.where(Embeddings.art_object_id != exclude_id)
+    return statement.order_by(Embeddings.image_code.hamming_distance(query_code)).limit(candidates).subquery()
+
+
+def _rerank_statement(candidates: Subquery, query_image, top_k: int, projection_version: int) -> Select:
+    """Second search pass, re-ranking the candidates by exact cosine distance of their full vectors."""
+    return (
+        select(ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .select_from(candidates)
+        .join(ArtObjects, ArtObjects.id == candidates.c.art_object_id)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .order_by(candidates.c.image.cosine_distance(query_image))
+        .limit(top_k)
+    )
+
+
+def closest_to_artobject_statement(
+    art_object_id: int, top_k: int, projection_version: int = settings.projection_version
+) -> Select:
+    subquery = select(Embeddings.image).where(Embeddings.art_object_id == art_object_id).scalar_subquery()
+
+    if settings.rerank_candidates:
+        code_subquery = select(Embeddings.image_code).where(Embeddings.art_object_id == art_object_id).scalar_subquery()
+        candidates = _binary_candidates(code_subquery, settings.rerank_candidates, exclude_id=art_object_id)
+        return _rerank_statement(candidates, subquery, top_k, projection_version)
+
+    return (
+        select(ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .select_from(Embeddings)
+        .join(ArtObjects)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .where(ArtObjects.id != art_object_id)
+        .order_by(Embeddings.image.cosine_distance(subquery))
+        .limit(top_k)
+    )
+
+
+def best_image_match_statement(
+    embedding: np.ndarray, top_k: int, projection_version: int = settings.projection_version
+) -> Select:
+    if settings.rerank_candidates:
+        candidates = _binary_candidates(binary_code(embedding), settings.rerank_candidates)
+        return _rerank_statement(candidates, embedding, top_k, projection_version)
+
+    return (
+        select(ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .select_from(Embeddings)
+        .join(ArtObjects)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .order_by(Embeddings.image.cosine_distance(embedding))
+        .limit(top_k)
+    )
+
+
+def _queries_subquery(embeddings: np.ndarray) -> Subquery:
+    """Turn query embeddings into a derived table of (query_index, embedding) rows, like a VALUES list."""
+    vector_type = embedding_column_type(settings.embedding_precision)
+    rows = [
+        select(
+            literal(query_index).label("query_index"),
+            cast(bindparam(f"embedding_{query_index}", embedding, type_=vector_type), vector_type).label("embedding"),
         )
-        return session.exec(
-            select(ArtObjects, Embeddings.image)
-            .where(ArtObjects.id != art_object_id)
-            .order_by(Embeddings.image.cosine_distance(subquery))
-            .join(ArtObjects)
-            .limit(top_k)
+        for query_index, embedding in enumerate(embeddings)
+    ]
+    return union_all(*rows).subquery("queries")
+
+
+def _lateral_neighbours_statement(
+    queries: Subquery, key: ColumnElement, top_k: int, projection_version: int, *, exclude_key: bool = False
+) -> Select:
+    """
+    Nearest neighbours of every row of `queries` in one statement, through a LATERAL join per query.
+
+    Each lateral subquery is a regular `ORDER BY ... LIMIT` on Embeddings, so it can use the ANN index.
+    With `rerank_candidates` set, it selects the candidates of its query by their binary codes first and
+    re-ranks those, like the single query statements do. Rows start with the query's `key` and are
+    ordered by key and then by distance.
+    """
+    if settings.rerank_candidates:
+        candidates = select(Embeddings.art_object_id, Embeddings.image)
+        if exclude_key:
+            candidates = candidates.where(Embeddings.art_object_id != key)
+        candidates = (
+            candidates.order_by(Embeddings.image_code.hamming_distance(func.binary_quantize(queries.c.embedding)))
+            .limit(settings.rerank_candidates)
+            # The queries are joined two levels up, they are not found by automatic correlation
+            .correlate(queries)
+            .lateral("candidates")
+        )
+        distance = candidates.c.image.cosine_distance(queries.c.embedding)
+        neighbours = select(candidates.c.art_object_id, distance.label("distance")).select_from(candidates)
+    else:
+        distance = Embeddings.image.cosine_distance(queries.c.embedding)
+        neighbours = select(Embeddings.art_object_id, distance.label("distance"))
+        if exclude_key:
+            neighbours = neighbours.where(Embeddings.art_object_id != key)
+    neighbours = neighbours.order_by(distance).limit(top_k).lateral("neighbours")
+
+    return (
+        select(key, ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .select_from(queries)
+        .join(neighbours, true())
+        .join(ArtObjects, ArtObjects.id == neighbours.c.art_object_id)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .order_by(key, neighbours.c.distance)
+    )
+
+
+def best_image_matches_statement(
+    embeddings: np.ndarray, top_k: int, projection_version: int = settings.projection_version
+) -> Select:
+    """Nearest neighbours of several query embeddings, rows start with the index of their query."""
+    queries = _queries_subquery(embeddings)
+    return _lateral_neighbours_statement(queries, queries.c.query_index, top_k, projection_version)
+
+
+def closest_to_artobjects_statement(
+    art_object_ids: list[int], top_k: int, projection_version: int = settings.projection_version
+) -> Select:
+    """Nearest neighbours of several ArtObjects, excluding themselves, rows start with the queried id."""
+    queries = (
+        select(Embeddings.art_object_id.label("query_id"), Embeddings.image.label("embedding"))
+        .where(col(Embeddings.art_object_id).in_(art_object_ids))
+        .subquery("queries")
+    )
+    return _lateral_neighbours_statement(queries, queries.c.query_id, top_k, projection_version, exclude_key=True)
+
+
+def group_by_query(rows: Sequence[tuple]) -> dict[int, list[ArtObjectWithCoords]]:
+    """Split rows that start with a query key into one list of results per query."""
+    grouped: dict[int, list[ArtObjectWithCoords]] = {}
+    for key, *row in rows:
+        grouped.setdefault(key, []).append(tuple(row))
+    return grouped
+
+
+def filter_clauses(filters: ArtObjectFilter | None) -> list[ColumnElement[bool]]:
+    if filters is None:
+        return []
+
+    clauses = []
+    if filters.artist is not None:
+        clauses.append(ArtObjects.artist == filters.artist)
+    if filters.source is not None:
+        clauses.append(ArtObjects.source == filters.source)
+    return clauses
+
+
+def filtered_ids_statement(filters: ArtObjectFilter) -> Select:
+    """Ids of the ArtObjects with an embedding that pass the filters."""
+    return (
+        select(Embeddings.art_object_id)
+        .join(ArtObjects, ArtObjects.id == Embeddings.art_object_id)
+        .where(*filter_clauses(filters))
+    )
+
+
+def filtered_count_statement(filters: ArtObjectFilter, cap: int) -> Select:
+    """Count the ArtObjects that pass the filters, up to `cap`, so broad filters are not counted in full."""
+    return select(func.count()).select_from(filtered_ids_statement(filters).limit(cap).subquery())
+
+
+def exact_filtered_statement(
+    query_image,
+    top_k: int,
+    filters: ArtObjectFilter,
+    exclude_id: int | None = None,
+    projection_version: int = settings.projection_version,
+) -> Select:
+    """
+    Nearest neighbours among the ArtObjects that pass the filters, by an exact scan over just those.
+
+    The filtered embeddings are materialized first, which keeps the planner from walking the ANN
+    index and discarding most of what it finds.
+    """
+    statement = (
+        select(Embeddings.art_object_id, Embeddings.image)
+        .join(ArtObjects, ArtObjects.id == Embeddings.art_object_id)
+        .where(*filter_clauses(filters))
+    )
+    if exclude_id is not None:
+        statement = statement.where(Embeddings.art_object_id != exclude_id)
+    candidates = statement.cte("filtered").prefix_with("MATERIALIZED")
+    return _rerank_statement(candidates, query_image, top_k, projection_version)
+
+
+def overfetch_filtered_statement(
+    query_image,
+    candidates: int,
+    top_k: int,
+    filters: ArtObjectFilter,
+    exclude_id: int | None = None,
+    projection_version: int = settings.projection_version,
+) -> Select:
+    """
+    Nearest neighbours among the ArtObjects that pass the filters, by filtering `candidates` nearest neighbours.
+
+    The candidates come from the ANN index, so this returns fewer than `top_k` rows when too few of
+    them pass the filters, see `db.async_crud.retrieve_filtered`.
+    """
+    statement = select(Embeddings.art_object_id, Embeddings.image)
+    if exclude_id is not None:
+        statement = statement.where(Embeddings.art_object_id != exclude_id)
+    nearest = statement.order_by(Embeddings.image.cosine_distance(query_image)).limit(candidates).subquery()
+    return _rerank_statement(nearest, query_image, top_k, projection_version).where(*filter_clauses(filters))
+
+
+def lexical_match_statement(
+    query: str,
+    top_k: int,
+    filters: ArtObjectFilter | None = None,
+    projection_version: int = settings.projection_version,
+) -> Select:
+    """
+    ArtObjects with an embedding whose title or artist matches the query text, best matches first.
+
+    Full-text matches on the title and artist and fuzzy matches on the artist name are combined,
+    both through their GIN indexes, see `db.models.create_text_search_indexes`. Matches on the
+    artist rank first, as those queries are the ones CLIP handles poorly.
+    """
+    document = literal_column(f"artobjects.{SEARCH_DOCUMENT_COLUMN}")
+    # The configuration is inlined rather than bound, so the match is planned against the index
+    ts_query = func.websearch_to_tsquery(literal_column(f"'{TEXT_SEARCH_CONFIG}'"), query)
+    artist_similarity = func.word_similarity(query, ArtObjects.artist)
+
+    return (
+        select(ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .join(Embeddings, Embeddings.art_object_id == ArtObjects.id)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .where(or_(document.op("@@")(ts_query), ArtObjects.artist.op("%>")(query)), *filter_clauses(filters))
+        .order_by(artist_similarity.desc(), func.ts_rank(document, ts_query).desc())
+        .limit(top_k)
+    )
+
+
+def use_knn_graph(top_k: int) -> bool:
+    """Whether neighbour lookups of this size can be answered from the precomputed graph."""
+    return top_k <= settings.knn_graph_size
+
+
+def knn_graph_built_statement() -> Select:
+    """Whether the precomputed graph holds any neighbours."""
+    return select(exists().select_from(ArtNeighbours))
+
+
+def knn_graph_is_built() -> bool:
+    with Session(engine) as session:
+        return bool(session.exec(knn_graph_built_statement()).first())
+
+
+def precomputed_neighbours_statement(
+    art_object_ids: list[int], top_k: int, projection_version: int = settings.projection_version
+) -> Select:
+    """Neighbours of several ArtObjects from the precomputed graph, rows start with the queried id."""
+    return (
+        select(ArtNeighbours.art_object_id, ArtObjects, ArtCoordinates.x, ArtCoordinates.y)
+        .join(ArtObjects, ArtObjects.id == ArtNeighbours.neighbour_id)
+        .outerjoin(ArtCoordinates, _coordinates_on_clause(projection_version))
+        .where(col(ArtNeighbours.art_object_id).in_(art_object_ids), ArtNeighbours.rank < top_k)
+        .order_by(ArtNeighbours.art_object_id, ArtNeighbours.rank)
+    )
+
+
+def split_graph_hits(
+    rows: Sequence[tuple], art_object_ids: list[int], top_k: int
+) -> tuple[dict[int, list[ArtObjectWithCoords]], list[int]]:
+    """
+    Separate ArtObjects whose neighbours were found in the precomputed graph from those that need a search.
+
+    ArtObjects ingested after the graph was computed have no entries yet, and a graph computed with a
+    smaller size than `top_k` does not hold enough of them, both fall back to searching.
+    """
+    grouped = group_by_query(rows)
+    hits = {key: neighbours for key, neighbours in grouped.items() if len(neighbours) == top_k}
+    misses = [art_object_id for art_object_id in art_object_ids if art_object_id not in hits]
+    return hits, misses
+
+
+def retrieve_neighbours(art_object_ids: list[int]) -> dict[int, tuple[list[int], list[float]]]:
+    """Retrieve the stored neighbour ids and similarities of ArtObjects in the graph, ordered by rank."""
+    neighbours: dict[int, tuple[list[int], list[float]]] = {}
+    with Session(engine) as session:
+        rows = session.exec(
+            select(ArtNeighbours.art_object_id, ArtNeighbours.neighbour_id, ArtNeighbours.similarity)
+            .where(col(ArtNeighbours.art_object_id).in_(art_object_ids))
+            .order_by(ArtNeighbours.art_object_id, ArtNeighbours.rank)
         ).all()
 
+    for art_object_id, neighbour_id, similarity in rows:
+        neighbour_ids, similarities = neighbours.setdefault(art_object_id, ([], []))
+        neighbour_ids.append(neighbour_id)
+        similarities.append(similarity)
+    return neighbours
+
 
-def retrieve_best_image_match_w_embedding(embedding: np.ndarray, top_k: int) -> list[tuple[ArtObjects, np.ndarray]]:
+def retrieve_neighbour_thresholds() -> dict[int, tuple[int, float]]:
+    """Per ArtObject in the graph its amount of stored neighbours and the similarity of the least similar one."""
     with Session(engine) as session:
-        joined_result = session.exec(
-            select(ArtObjects, Embeddings.image)
-            .order_by(Embeddings.image.cosine_distance(embedding))
-            .limit(top_k)
-            .join(ArtObjects)
+        rows = session.exec(
+            select(ArtNeighbours.art_object_id, func.count(), func.min(ArtNeighbours.similarity)).group_by(
+                ArtNeighbours.art_object_id
+            )
         ).all()
 
+    return {art_object_id: (count, threshold) for art_object_id, count, threshold in rows}
+
+
+def save_neighbours(conn: Session, batch_neighbours: list[tuple[int, np.ndarray, np.ndarray]]) -> None:
+    """
+    Replace the stored neighbours of a batch of ArtObjects.
+
+    Parameters
+    ----------
+    conn: SQLmodel.Session
+        Connection to database.
+    batch_neighbours: list[tuple[int, np.ndarray, np.ndarray]]
+        List of tuples, each containing the ID of an ArtObject, the IDs of its neighbours
+        and their similarities, ordered from most to least similar.
+
+    """
+    if not batch_neighbours:
+        return
+
+    art_object_ids = [art_object_id for art_object_id, _, _ in batch_neighbours]
+    rows = [
+        {"art_object_id": art_object_id, "rank": rank, "neighbour_id": int(neighbour_id), "similarity": float(score)}
+        for art_object_id, neighbour_ids, similarities in batch_neighbours
+        for rank, (neighbour_id, score) in enumerate(zip(neighbour_ids, similarities, strict=True))
+    ]
+
+    with conn as session:
+        session.execute(delete(ArtNeighbours).where(col(ArtNeighbours.art_object_id).in_(art_object_ids)))
+        if rows:
+            session.execute(insert(ArtNeighbours).values(rows))
+        session.commit()
+
+
+def _hydrate_art_objects(art_object_ids: list[int]) -> list[ArtObjectWithCoords]:
+    """Fetch the ArtObjects for ids found by an in-process search, keeping the order of the ids."""
+    with Session(engine) as session:
+        rows = session.exec(art_objects_by_ids_statement(art_object_ids)).all()
+
+    return order_by_ids(rows, art_object_ids)
+
+
+def retrieve_closest_to_artobject(
+    art_object_id: int, top_k: int, ef_search: int | None = None, probes: int | None = None
+) -> list[ArtObjectWithCoords]:
+    """
+    Retrieve the ArtObjects with the image embeddings closest to that of the given ArtObject.
+
+    The stored map coordinates of the current projection are returned alongside each ArtObject,
+    these are None for ArtObjects that have not been projected yet.
+    """
+    if use_knn_graph(top_k):
+        with Session(engine) as session:
+            rows = session.exec(precomputed_neighbours_statement([art_object_id], top_k)).all()
+        hits, _ = split_graph_hits(rows, [art_object_id], top_k)
+        if art_object_id in hits:
+            return hits[art_object_id]
+
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        embedding = store.get_vector(art_object_id)
+        if embedding is None:
+            return []
+        ids, _ = store.search(embedding, top_k, exclude_id=art_object_id)
+        return _hydrate_art_objects(ids.tolist())
+
+    with Session(engine) as session:
+        _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        return list(session.exec(closest_to_artobject_statement(art_object_id, top_k)).all())
+
+
+def retrieve_best_image_match_w_embedding(
+    embedding: np.ndarray, top_k: int, ef_search: int | None = None, probes: int | None = None
+) -> list[ArtObjectWithCoords]:
+    """
+    Retrieve the ArtObjects with the image embeddings closest to the given embedding.
+
+    The stored map coordinates of the current projection are returned alongside each ArtObject,
+    these are None for ArtObjects that have not been projected yet.
+    """
+    if settings.search_backend != SearchBackend.PGVECTOR:
+        store = get_vector_store()
+        ids, _ = store.search(embedding, top_k)
+        return _hydrate_art_objects(ids.tolist())
+
+    with Session(engine) as session:
+        _set_ann_search_params(session, rerank_ef_search(ef_search), probes)
+        joined_result = session.exec(best_image_match_statement(embedding, top_k)).all()
+
     return list(joined_result)
 
 
+def embeddings_by_ids_statement(art_object_ids: list[int]) -> Select:
+    return select(Embeddings.art_object_id, Embeddings.image).where(col(Embeddings.art_object_id).in_(art_object_ids))
+
+
+def retrieve_embeddings_without_coordinates(
+    count: int, projection_version: int = settings.projection_version
+) -> list[tuple[int, np.ndarray]]:
+    """Retrieve a batch of embeddings of ArtObjects that have no coordinates in the given projection yet."""
+    with Session(engine) as session:
+        statement = (
+            select(Embeddings.art_object_id, Embeddings.image)
+            .where(
+                ~exists(
+                    select(ArtCoordinates.art_object_id).where(
+                        ArtCoordinates.art_object_id == Embeddings.art_object_id,
+                        ArtCoordinates.projection_version == projection_version,
+                    )
+                )
+            )
+            .order_by(col(Embeddings.art_object_id).asc())
+            .limit(count)
+        )
+        return list(session.exec(statement).all())
+
+
+def save_coordinates(
+    conn: Session,
+    batch_coordinates: list[tuple[int, float, float]],
+    projection_version: int = settings.projection_version,
+) -> None:
+    """
+    Insert or overwrite the map coordinates of a batch of ArtObjects.
+
+    Parameters
+    ----------
+    conn: SQLmodel.Session
+        Connection to database.
+    batch_coordinates: list[tuple[int, float, float]]
+        List of tuples, each containing the ID of an ArtObject and its x and y coordinate.
+    projection_version: int
+        Version of the projection the coordinates were computed with.
+
+    """
+    if not batch_coordinates:
+        return
+
+    statement = insert(ArtCoordinates).values(
+        [
+            {"art_object_id": art_object_id, "projection_version": projection_version, "x": x, "y": y}
+            for art_object_id, x, y in batch_coordinates
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[ArtCoordinates.art_object_id, ArtCoordinates.projection_version],
+        set_={"x": statement.excluded.x, "y": statement.excluded.y},
+    )
+
+    with conn as session:
+        session.execute(statement)
+        session.commit()
+
+
 def retrieve_embeddings(limit: int | None = None) -> list[Embeddings]:
     with Session(engine) as session:
         query = select(Embeddings)
@@ -1,10 +1,21 @@
-from typing import Any
+import argparse
+from typing import Annotated, Any
 
-from pgvector.sqlalchemy import Vector
+import numpy as np
+from loguru import logger
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
+from pydantic import PositiveInt, StringConstraints
 from sqlalchemy import Column, create_engine, text
+from sqlalchemy.dialects.postgresql import Insert, insert
 from sqlmodel import Field, SQLModel
 
-from config import settings
+from config import AnnIndexMethod, EmbeddingPrecision, settings
+
+EMBEDDING_DIM = 512
+# Lexical search is language agnostic, titles come in several languages and artist names should not be stemmed
+TEXT_SEARCH_CONFIG = "simple"
+# Generated tsvector column of ArtObjects, it is not part of the model since it can not be written to
+SEARCH_DOCUMENT_COLUMN = "search_document"
 
 
 class ArtObjects(SQLModel, table=True):
@@ -22,7 +33,8 @@ class ArtObjectsWithCoord(ArtObjects, table=False):
 
     @classmethod
     def from_art_object(cls, art_object: ArtObjects, x: float, y: float):
-        return cls(
+        # The ArtObject was validated when it was loaded, so the fields are copied over without validating again
+        return cls.model_construct(
             id=art_object.id,
             original_id=art_object.original_id,
             image_url=art_object.image_url,
@@ -41,13 +53,346 @@ class ArtQueryWithCoordsResponse(SQLModel, table=False):
     art_objects_with_coords: list[ArtObjectsWithCoord]
 
 
+class ArtObjectsColumns(SQLModel, table=False):
+    """Compact alternative to a list of ArtObjectsWithCoord, with one array per field instead of one object per hit."""
+
+    ids: list[int]
+    original_ids: list[str]
+    image_urls: list[str]
+    long_titles: list[str]
+    artists: list[str]
+    sources: list[str]
+    x: list[float]
+    y: list[float]
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple[ArtObjects, float, float]]) -> "ArtObjectsColumns":
+        return cls.model_construct(
+            ids=[art_object.id for art_object, _, _ in rows],
+            original_ids=[art_object.original_id for art_object, _, _ in rows],
+            image_urls=[art_object.image_url for art_object, _, _ in rows],
+            long_titles=[art_object.long_title for art_object, _, _ in rows],
+            artists=[art_object.artist for art_object, _, _ in rows],
+            sources=[art_object.source for art_object, _, _ in rows],
+            x=[x for _, x, _ in rows],
+            y=[y for _, _, y in rows],
+        )
+
+
+class ArtQueryColumnsResponse(SQLModel, table=False):
+    query_x: float
+    query_y: float
+
+    art_objects: ArtObjectsColumns
+
+
+class ArtQueryBatchRequest(SQLModel, table=False):
+    art_queries: list[Annotated[str, StringConstraints(max_length=250)]] = Field(min_length=1, max_length=64)
+    top_k: int = Field(ge=1, le=15)
+
+
+class ArtObjectFilter(SQLModel, table=False):
+    """Restricts a search to ArtObjects of one artist and/or source, unset fields do not filter."""
+
+    artist: str | None = None
+    source: str | None = None
+
+    def is_empty(self) -> bool:
+        return self.artist is None and self.source is None
+
+
+class ArtObjectNeighboursRequest(SQLModel, table=False):
+    idxs: list[PositiveInt] = Field(min_length=1, max_length=64)
+    top_k: int = Field(ge=1, le=15)
+
+
+class HalfVector(HALFVEC):
+    """pgvector halfvec column that, like Vector, reads values as float32 NumPy arrays."""
+
+    cache_ok = True
+
+    def result_processor(self, dialect, coltype):
+        process = super().result_processor(dialect, coltype)
+
+        def to_numpy(value):
+            value = process(value)
+            return None if value is None else value.to_numpy().astype(np.float32)
+
+        return to_numpy
+
+
+def embedding_column_type(precision: EmbeddingPrecision) -> Vector | HalfVector:
+    if precision == EmbeddingPrecision.FLOAT16:
+        return HalfVector(EMBEDDING_DIM)
+    return Vector(EMBEDDING_DIM)
+
+
 class Embeddings(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    image: Any = Field(sa_column=Column(Vector(512)))
+    image: Any = Field(sa_column=Column(embedding_column_type(settings.embedding_precision)))
+    # Sign bit of every dimension of the image embedding, used for a cheap first search pass
+    image_code: str | None = Field(default=None, sa_column=Column(BIT(EMBEDDING_DIM), nullable=True))
     art_object_id: int = Field(foreign_key="artobjects.id", unique=True)
 
 
-engine = create_engine(settings.database_url)
+class ArtCoordinates(SQLModel, table=True):
+    """Position of an ArtObject on the 2-D map, for each version of the projection."""
+
+    art_object_id: int = Field(foreign_key="artobjects.id", primary_key=True)
+    projection_version: int = Field(primary_key=True)
+    x: float
+    y: float
+
+
+class ArtNeighbours(SQLModel, table=True):
+    """Precomputed nearest neighbours by image embedding, see `etl.knn_graph`."""
+
+    art_object_id: int = Field(foreign_key="artobjects.id", primary_key=True)
+    rank: int = Field(primary_key=True)
+    neighbour_id: int = Field(foreign_key="artobjects.id")
+    similarity: float
+
+
+class DatasetVersion(SQLModel, table=True):
+    """Single row counter that is bumped whenever data that search results depend on changes."""
+
+    id: int = Field(default=1, primary_key=True)
+    version: int = 0
+
+
+def bump_dataset_version_statement() -> Insert:
+    """Increment the dataset version, this invalidates cached API results."""
+    statement = insert(DatasetVersion).values(id=1, version=1)
+    return statement.on_conflict_do_update(
+        index_elements=[DatasetVersion.id], set_={"version": DatasetVersion.version + 1}
+    )
+
+
+engine = create_engine(
+    settings.database_url,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_pre_ping=True,
+)
+
+
+# pgvector recommends rows / 1000 lists up to 1M rows and sqrt(rows) above that
+IVFFLAT_MIN_LISTS = 1
+IVFFLAT_ROWS_PER_LIST = 1000
+IVFFLAT_SQRT_THRESHOLD = 1_000_000
+
+
+# Operator class for cosine distance and the SQL type of Embeddings.image per precision
+COSINE_OPS = {EmbeddingPrecision.FLOAT32: "vector_cosine_ops", EmbeddingPrecision.FLOAT16: "halfvec_cosine_ops"}
+SQL_TYPES = {EmbeddingPrecision.FLOAT32: "vector", EmbeddingPrecision.FLOAT16: "halfvec"}
+
+
+def embedding_index_name(method: AnnIndexMethod) -> str:
+    return f"embeddings_image_{method}_idx"
+
+
+def _ivfflat_lists(row_count: int) -> int:
+    if row_count > IVFFLAT_SQRT_THRESHOLD:
+        return int(row_count**0.5)
+    return max(IVFFLAT_MIN_LISTS, row_count // IVFFLAT_ROWS_PER_LIST)
+
+
+def _index_row_count(con, index_name: str) -> int | None:
+    """Amount of embeddings an IVFFlat index was built on, recorded in the comment of the index."""
+    comment = con.execute(
+        text("SELECT obj_description(to_regclass(:name), 'pg_class')"), {"name": index_name}
+    ).scalar()
+    return int(comment) if comment is not None and comment.isdigit() else None
+
+
+def _build_embedding_index(con, index_name: str, method: AnnIndexMethod) -> None:
+    if method == AnnIndexMethod.HNSW:
+        options = f"m = {settings.hnsw_m}, ef_construction = {settings.hnsw_ef_construction}"
+    else:
+        row_count = con.execute(text("SELECT count(*) FROM embeddings")).scalar_one()
+        options = f"lists = {_ivfflat_lists(row_count)}"
+
+    logger.info(f"Building {method} index {index_name} with {options}")
+    con.execute(
+        text(
+            f"CREATE INDEX CONCURRENTLY {index_name} "
+            f"ON embeddings USING {method} (image {COSINE_OPS[settings.embedding_precision]}) WITH ({options})"
+        )
+    )
+    if method == AnnIndexMethod.IVFFLAT:
+        con.execute(text(f"COMMENT ON INDEX {index_name} IS '{row_count}'"))
+    logger.info(f"Done building index {index_name}")
+
+
+def create_embedding_index(method: AnnIndexMethod | None = None, *, rebuild: bool = False) -> None:
+    """
+    Create the approximate nearest neighbour index on Embeddings.image, without blocking writes.
+
+    Indexes of the other method are dropped, so switching `ann_index_method` is a matter of calling
+    this function again. An index left invalid by an interrupted concurrent build is rebuilt.
+
+    Parameters
+    ----------
+    method: AnnIndexMethod | None
+        Index type to build, defaults to the `ann_index_method` setting.
+    rebuild: bool
+        Rebuild an existing index. The new index is built next to it and swapped in once it is
+        ready, so queries keep using the old index in the meantime.
+
+    """
+    method = method or settings.ann_index_method
+    index_name = embedding_index_name(method)
+    # Name of the replacement while it is being built next to the live index
+    new_index_name = f"{index_name}_new"
+
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        for other_method in AnnIndexMethod:
+            if other_method != method:
+                con.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {embedding_index_name(other_method)}"))
+        # Left behind by an interrupted rebuild
+        con.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {new_index_name}"))
+
+        is_valid = con.execute(
+            text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": index_name}
+        ).scalar()
+
+        if is_valid is False:
+            # Queries do not use an invalid index, so nothing is lost by dropping it before building it again
+            logger.warning(f"Index {index_name} is invalid, probably due to an interrupted build. Rebuilding it.")
+            con.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+        elif is_valid and not rebuild:
+            return
+
+        if not is_valid:
+            _build_embedding_index(con, index_name, method)
+            return
+
+        _build_embedding_index(con, new_index_name, method)
+
+    # Swapping the indexes only holds a lock on the table for as long as dropping the old one takes
+    with engine.begin() as con:
+        con.execute(text(f"DROP INDEX {index_name}"))
+        con.execute(text(f"ALTER INDEX {new_index_name} RENAME TO {index_name}"))
+    logger.info(f"Replaced index {index_name} with the rebuilt one")
+
+
+def refresh_embedding_index() -> None:
+    """Bring the embedding index up to date after a bulk load of embeddings."""
+    if settings.ann_index_method == AnnIndexMethod.HNSW:
+        # HNSW graphs are maintained on insert
+        create_embedding_index()
+        return
+
+    # IVFFlat lists are clustered on the embeddings at build time, and only recomputed once the amount of
+    # embeddings has changed enough for the clusters to no longer fit the data
+    with engine.connect() as con:
+        built_on = _index_row_count(con, embedding_index_name(AnnIndexMethod.IVFFLAT))
+        row_count = con.execute(text("SELECT count(*) FROM embeddings")).scalar_one()
+
+    rebuild = built_on is None or abs(row_count - built_on) > settings.ivfflat_rebuild_threshold * built_on
+    if not rebuild:
+        logger.info(f"Keeping the IVFFlat index built on {built_on} embeddings, there are {row_count} now.")
+    create_embedding_index(rebuild=rebuild)
+
+
+def create_text_search_indexes() -> None:
+    """
+    Create the indexes for lexical search over ArtObjects.
+
+    A generated tsvector column over the title and artist gets a GIN index for full-text matches,
+    and the artist a trigram index for fuzzy matches of artist names. Adding the column rewrites
+    the table once, the indexes are built without blocking writes.
+    """
+    with engine.begin() as con:
+        con.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        # Added after the artobjects table, create_all does not add columns to existing tables
+        con.execute(
+            text(
+                f"ALTER TABLE artobjects ADD COLUMN IF NOT EXISTS {SEARCH_DOCUMENT_COLUMN} tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', long_title || ' ' || artist)) STORED"
+            )
+        )
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        con.execute(
+            text(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS artobjects_search_document_idx "
+                f"ON artobjects USING gin ({SEARCH_DOCUMENT_COLUMN})"
+            )
+        )
+        con.execute(
+            text(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS artobjects_artist_trgm_idx "
+                "ON artobjects USING gin (artist gin_trgm_ops)"
+            )
+        )
+
+
+def create_filter_indexes() -> None:
+    """Create the indexes used to estimate the selectivity of, and to scan, filtered searches."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        for column in ("artist", "source"):
+            con.execute(
+                text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS artobjects_{column}_idx ON artobjects ({column})")
+            )
+
+
+def create_binary_code_index() -> None:
+    """Create the HNSW index that the first, Hamming distance, pass of re-ranked searches walks."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as con:
+        con.execute(
+            text(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS embeddings_image_code_idx "
+                "ON embeddings USING hnsw (image_code bit_hamming_ops) "
+                f"WITH (m = {settings.hnsw_m}, ef_construction = {settings.hnsw_ef_construction})"
+            )
+        )
+
+
+def get_stored_embedding_precision() -> EmbeddingPrecision | None:
+    """Precision Embeddings.image currently has in the database, None if the table does not exist yet."""
+    with engine.connect() as con:
+        sql_type = con.execute(
+            text(
+                "SELECT t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+                "WHERE a.attrelid = to_regclass('embeddings') AND a.attname = 'image'"
+            )
+        ).scalar()
+
+    for precision, precision_type in SQL_TYPES.items():
+        if sql_type == precision_type:
+            return precision
+    return None
+
+
+def migrate_embedding_precision(precision: EmbeddingPrecision | None = None) -> None:
+    """
+    Convert the stored embeddings to the given precision, by default the `embedding_precision` setting.
+
+    The column is rewritten in place, which locks the embeddings table for the duration of the
+    conversion. The index is dropped first, since its operator class depends on the column type,
+    and rebuilt concurrently afterwards.
+    """
+    precision = precision or settings.embedding_precision
+    current = get_stored_embedding_precision()
+
+    if current is None or current == precision:
+        logger.info(f"Embeddings are already stored as {precision}, nothing to migrate.")
+        return
+
+    logger.info(f"Migrating embeddings from {current} to {precision}.")
+    with engine.begin() as con:
+        for method in AnnIndexMethod:
+            con.execute(text(f"DROP INDEX IF EXISTS {embedding_index_name(method)}"))
+        sql_type = f"{SQL_TYPES[precision]}({EMBEDDING_DIM})"
+        con.execute(text(f"ALTER TABLE embeddings ALTER COLUMN image TYPE {sql_type} USING image::{sql_type}"))
+        # Distances, and with them the order of results, shift slightly with the precision
+        con.execute(bump_dataset_version_statement())
+    logger.info("Done converting embeddings, rebuilding the index.")
+
+    create_embedding_index()
 
 
 def create_db_and_tables():
@@ -57,6 +402,35 @@ def create_db_and_tables():
 
     SQLModel.metadata.create_all(engine)
 
+    with engine.begin() as con:
+        # Added after the embeddings table, create_all does not add columns to existing tables
+        con.execute(text(f"ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS image_code bit({EMBEDDING_DIM})"))
+
+    create_text_search_indexes()
+    create_filter_indexes()
+    create_binary_code_index()
+
+    stored_precision = get_stored_embedding_precision()
+    if stored_precision != settings.embedding_precision:
+        logger.error(
+            f"Embeddings are stored as {stored_precision} but embedding_precision is {settings.embedding_precision}, "
+            "run `python -m db.models --migrate-precision`."
+        )
+        return
+
+    create_embedding_index()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the database tables and embedding index")
+    parser.add_argument("--rebuild-index", action="store_true", help="Rebuild the embedding index from scratch")
+    parser.add_argument(
+        "--migrate-precision", action="store_true", help="Convert stored embeddings to the embedding_precision setting"
+    )
+    args = parser.parse_args()
+
+    if args.migrate_precision:
+        migrate_embedding_precision()
     create_db_and_tables()
+    if args.rebuild_index:
+        create_embedding_index(rebuild=True)
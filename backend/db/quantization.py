@@ -0,0 +1,70 @@
+import argparse
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import text
+
+from db.models import bump_dataset_version_statement, engine
+
+REBUILD_BATCH_SIZE = 10000
+
+
+def binary_code(embedding: np.ndarray) -> str:
+    """
+    Binary quantize an embedding into a bit string with one bit per dimension, set when the value is positive.
+
+    This matches pgvector's `binary_quantize`, so codes made here and in SQL can be compared.
+    """
+    return "".join(np.where(np.asarray(embedding).reshape(-1) > 0, "1", "0"))
+
+
+def rebuild_binary_codes(batch_size: int = REBUILD_BATCH_SIZE, *, only_missing: bool = True) -> None:
+    """
+    Compute the binary codes of stored embeddings in the database, in batches to keep transactions short.
+
+    Parameters
+    ----------
+    batch_size: int
+        Amount of embeddings updated per transaction.
+    only_missing: bool
+        Only fill in codes that are missing, rather than recomputing all of them.
+
+    """
+    total = 0
+    last_id = 0
+
+    while True:
+        with engine.begin() as con:
+            updated_ids = con.execute(
+                text(
+                    "UPDATE embeddings SET image_code = binary_quantize(image) "
+                    "WHERE id IN ("
+                    "  SELECT id FROM embeddings WHERE id > :last_id"
+                    f"{' AND image_code IS NULL' if only_missing else ''}"
+                    "  ORDER BY id LIMIT :batch_size"
+                    ") RETURNING id"
+                ),
+                {"last_id": last_id, "batch_size": batch_size},
+            ).scalars().all()
+
+        if not updated_ids:
+            break
+
+        last_id = max(updated_ids)
+        total += len(updated_ids)
+        logger.info(f"Computed binary codes for {total} embeddings.")
+
+    if total:
+        # The first pass of re-ranked searches picks its candidates by these codes
+        with engine.begin() as con:
+            con.execute(bump_dataset_version_statement())
+    logger.info(f"Done computing binary codes for {total} embeddings.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute binary codes of the stored embeddings")
+    parser.add_argument("--all", action="store_true", help="Recompute all codes instead of only the missing ones")
+    parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH_SIZE, help="Embeddings per transaction")
+    args = parser.parse_args()
+
+    rebuild_binary_codes(args.batch_size, only_missing=not args.all)
@@ -0,0 +1,110 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from db.vector_store import DEFAULT_BLOCK_SIZE, VectorStore
+
+# Shard of a worker process, attached once when the process starts
+_shard: VectorStore | None = None
+_shard_memory: SharedMemory | None = None
+
+
+def _attach_shard(memory_name: str, ids: np.ndarray, dtype: str, dim: int, block_size: int) -> None:
+    global _shard, _shard_memory  # noqa: PLW0603
+    from threadpoolctl import threadpool_limits
+
+    # Each shard gets a core of its own, BLAS threads on top of that would only compete for the same cores
+    threadpool_limits(1)
+
+    _shard_memory = SharedMemory(name=memory_name)
+    vectors = np.ndarray((len(ids), dim), dtype=np.dtype(dtype), buffer=_shard_memory.buf)
+    _shard = VectorStore(ids, vectors, block_size=block_size)
+
+
+def _search_shard(
+    queries: np.ndarray, top_k: int, exclude_ids: list[int | None] | None
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    return _shard._search_batch(queries, top_k, exclude_ids)  # noqa: SLF001
+
+
+class ShardedVectorStore(VectorStore):
+    """
+    VectorStore that splits the snapshot over worker processes, which search their shard in parallel.
+
+    Each shard is copied into a shared memory segment once, which its worker maps without copying. A search
+    is sent to all shards, every shard finds its own top-k with the blocked search of `VectorStore`, and
+    those are merged into the overall top-k here. Lookups of stored vectors are answered in this process,
+    from the memory-mapped snapshot.
+    """
+
+    def __init__(
+        self, ids: np.ndarray, vectors: np.ndarray, shards: int | None = None, block_size: int = DEFAULT_BLOCK_SIZE
+    ):
+        super().__init__(ids, vectors, block_size=block_size)
+
+        shards = max(1, min(shards or os.cpu_count() or 1, len(ids)))
+        bounds = np.linspace(0, len(ids), shards + 1).astype(int)
+        dim = vectors.shape[1]
+        # Forking a process that already runs threads, like the API, can deadlock the child
+        context = get_context("spawn")
+
+        self._memories: list[SharedMemory] = []
+        self._workers: list[ProcessPoolExecutor] = []
+        for start, end in zip(bounds[:-1], bounds[1:], strict=True):
+            memory = SharedMemory(create=True, size=max(1, (end - start) * dim * vectors.dtype.itemsize))
+            shard_vectors = np.ndarray((end - start, dim), dtype=vectors.dtype, buffer=memory.buf)
+            shard_vectors[:] = vectors[start:end]
+            # The segment can only be closed once no array refers to its buffer anymore
+            del shard_vectors
+
+            self._memories.append(memory)
+            self._workers.append(
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_attach_shard,
+                    initargs=(memory.name, ids[start:end], vectors.dtype.str, dim, block_size),
+                )
+            )
+        logger.info(f"Split the vector snapshot over {shards} shards of about {len(ids) // shards} vectors.")
+
+    @classmethod
+    def load(
+        cls, directory: Path, block_size: int = DEFAULT_BLOCK_SIZE, shards: int | None = None
+    ) -> "ShardedVectorStore":
+        """Memory-map a snapshot created by `build_snapshot` and split it over `shards` worker processes."""
+        snapshot = VectorStore.load(directory, block_size=block_size)
+        return cls(snapshot.ids, snapshot.vectors, shards=shards, block_size=block_size)
+
+    def _search_batch(
+        self, queries: np.ndarray, top_k: int, exclude_ids: list[int | None] | None
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        # Every shard already leaves out the excluded ids, so `top_k` per shard is enough
+        futures = [worker.submit(_search_shard, queries, top_k, exclude_ids) for worker in self._workers]
+        shard_results = [future.result() for future in futures]
+
+        result_ids = []
+        result_scores = []
+        for query_index in range(len(queries)):
+            query_ids = np.concatenate([ids[query_index] for ids, _ in shard_results])
+            query_scores = np.concatenate([scores[query_index] for _, scores in shard_results])
+
+            order = np.argsort(-query_scores, kind="stable")[:top_k]
+            result_ids.append(query_ids[order])
+            result_scores.append(query_scores[order])
+
+        return result_ids, result_scores
+
+    def close(self) -> None:
+        """Stop the worker processes and free the shared memory of the shards."""
+        for worker in self._workers:
+            worker.shutdown(cancel_futures=True)
+        for memory in self._memories:
+            memory.close()
+            memory.unlink()
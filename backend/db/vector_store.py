@@ -0,0 +1,267 @@
+import argparse
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import func
+from sqlmodel import Session, col, select
+
+from config import SearchBackend, settings
+from db.models import EMBEDDING_DIM, Embeddings, engine
+from metrics import Stage, timed_stage
+
+IDS_FILE = "ids.npy"
+VECTORS_FILE = "vectors.npy"
+
+# Rows scored per matmul, keeps the temporary score buffer small enough to stay in cache
+DEFAULT_BLOCK_SIZE = 16384
+SNAPSHOT_BATCH_SIZE = 10000
+
+
+class VectorStore:
+    """
+    In-process exact nearest neighbour search over a snapshot of all image embeddings.
+
+    The snapshot consists of a sorted array of ArtObject ids and a matrix with one normalized
+    embedding per row, both usually memory-mapped from disk. Because the embeddings are normalized,
+    the cosine similarity is a plain dot product, which is computed block by block.
+    """
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE):
+        if len(ids) != len(vectors):
+            msg = f"Amount of ids ({len(ids)}) does not match amount of vectors ({len(vectors)})"
+            raise ValueError(msg)
+
+        self.ids = ids
+        self.vectors = vectors
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, directory: Path, block_size: int = DEFAULT_BLOCK_SIZE) -> "VectorStore":
+        """Memory-map a snapshot created by `build_snapshot`."""
+        ids = np.load(directory / IDS_FILE)
+        # The vectors file can hold trailing unused rows when embeddings were deleted while snapshotting
+        vectors = np.load(directory / VECTORS_FILE, mmap_mode="r")[: len(ids)]
+        logger.info(f"Loaded vector snapshot with {len(ids)} vectors of dtype {vectors.dtype} from {directory}")
+        return cls(ids, vectors, block_size=block_size)
+
+    def get_vector(self, art_object_id: int) -> np.ndarray | None:
+        """Look up the stored embedding of an ArtObject, None if it is not in the snapshot."""
+        row = np.searchsorted(self.ids, art_object_id)
+        if row == len(self.ids) or self.ids[row] != art_object_id:
+            return None
+        return np.asarray(self.vectors[row], dtype=np.float32)
+
+    def get_vectors(self, art_object_ids: list[int]) -> np.ndarray:
+        """Look up the stored embeddings of ArtObjects that are known to be in the snapshot."""
+        rows = np.searchsorted(self.ids, art_object_ids)
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def rows_of(self, art_object_ids: list[int] | np.ndarray) -> np.ndarray:
+        """Rows of the ArtObjects in the snapshot, ids that are not in it are left out."""
+        art_object_ids = np.asarray(art_object_ids, dtype=self.ids.dtype)
+        rows = np.searchsorted(self.ids, art_object_ids)
+        found = rows < len(self.ids)
+        found[found] = self.ids[rows[found]] == art_object_ids[found]
+        return rows[found]
+
+    def search_rows(
+        self, query: np.ndarray, top_k: int, rows: np.ndarray, exclude_id: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the `top_k` vectors with the highest cosine similarity to `query` among the given rows only.
+
+        Only the vectors of `rows` are read, so a search over a small subset does not scan the snapshot.
+
+        Parameters
+        ----------
+        query: np.ndarray
+            Normalized query embedding.
+        top_k: int
+            Amount of neighbours to return.
+        rows: np.ndarray
+            Rows of the snapshot to search, e.g. from `rows_of`.
+        exclude_id: int | None
+            ArtObject id that should never be returned, e.g. the id that is queried for.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The ArtObject ids and their similarities, ordered from most to least similar.
+
+        """
+        with timed_stage(Stage.VECTOR_SEARCH):
+            if exclude_id is not None:
+                rows = rows[self.ids[rows] != exclude_id]
+            # Fancy indexing reads just these rows from the memory map, in row order
+            rows = np.sort(rows)
+            query = np.asarray(query, dtype=np.float32).reshape(-1)
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+
+            if len(rows) > top_k:
+                top = np.argpartition(scores, -top_k)[-top_k:]
+            else:
+                top = np.arange(len(rows))
+            order = top[np.argsort(-scores[top], kind="stable")]
+            return self.ids[rows[order]], scores[order]
+
+    def search(
+        self, query: np.ndarray, top_k: int, exclude_id: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the `top_k` vectors with the highest cosine similarity to `query`.
+
+        Parameters
+        ----------
+        query: np.ndarray
+            Normalized query embedding.
+        top_k: int
+            Amount of neighbours to return.
+        exclude_id: int | None
+            ArtObject id that should never be returned, e.g. the id that is queried for.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The ArtObject ids and their similarities, ordered from most to least similar.
+
+        """
+        exclude_ids = None if exclude_id is None else [exclude_id]
+        ids, scores = self.search_batch(np.asarray(query).reshape(1, -1), top_k, exclude_ids)
+        return ids[0], scores[0]
+
+    def search_batch(
+        self, queries: np.ndarray, top_k: int, exclude_ids: list[int | None] | None = None
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Find the `top_k` most similar vectors for each of several queries in one pass over the snapshot.
+
+        Parameters
+        ----------
+        queries: np.ndarray
+            Normalized query embeddings, one per row.
+        top_k: int
+            Amount of neighbours to return per query.
+        exclude_ids: list[int | None] | None
+            Per query an ArtObject id that should not be returned for it.
+
+        Returns
+        -------
+        tuple[list[np.ndarray], list[np.ndarray]]
+            Per query the ArtObject ids and their similarities, ordered from most to least similar.
+
+        """
+        with timed_stage(Stage.VECTOR_SEARCH):
+            return self._search_batch(queries, top_k, exclude_ids)
+
+    def _search_batch(
+        self, queries: np.ndarray, top_k: int, exclude_ids: list[int | None] | None
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        # Fetch one extra so excluding a single id still leaves `top_k` results
+        k = top_k + 1 if exclude_ids is not None else top_k
+
+        candidate_rows = []
+        candidate_scores = []
+
+        for start in range(0, len(self.vectors), self.block_size):
+            # float16 snapshots are upcast per block, NumPy has no BLAS kernels for half precision
+            block = np.asarray(self.vectors[start : start + self.block_size], dtype=np.float32)
+            # Shape (n_queries, block_size)
+            scores = queries @ block.T
+
+            if scores.shape[1] > k:
+                local_rows = np.argpartition(scores, -k, axis=1)[:, -k:]
+            else:
+                local_rows = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+
+            candidate_rows.append(local_rows + start)
+            candidate_scores.append(np.take_along_axis(scores, local_rows, axis=1))
+
+        if not candidate_rows:
+            empty_ids, empty_scores = np.empty(0, dtype=self.ids.dtype), np.empty(0, dtype=np.float32)
+            return [empty_ids] * len(queries), [empty_scores] * len(queries)
+
+        rows = np.concatenate(candidate_rows, axis=1)
+        scores = np.concatenate(candidate_scores, axis=1)
+
+        result_ids = []
+        result_scores = []
+        for query_index in range(len(queries)):
+            query_ids, query_scores = self.ids[rows[query_index]], scores[query_index]
+
+            exclude_id = exclude_ids[query_index] if exclude_ids is not None else None
+            if exclude_id is not None:
+                keep = query_ids != exclude_id
+                query_ids, query_scores = query_ids[keep], query_scores[keep]
+
+            order = np.argsort(-query_scores, kind="stable")[:top_k]
+            result_ids.append(query_ids[order])
+            result_scores.append(query_scores[order])
+
+        return result_ids, result_scores
+
+
+def build_snapshot(directory: Path = settings.vector_snapshot_dir, dtype: str = "float32") -> None:
+    """
+    Write all embeddings in the database to a snapshot that can be memory-mapped by `VectorStore`.
+
+    Parameters
+    ----------
+    directory: Path
+        Directory to write the ids and vectors files to.
+    dtype: str
+        Storage precision of the vectors, either float32 or float16.
+
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with Session(engine) as session:
+        count = session.exec(select(func.count()).select_from(Embeddings)).one()
+        logger.info(f"Writing snapshot of {count} embeddings to {directory}")
+
+        ids = np.empty(count, dtype=np.int64)
+        vectors = np.lib.format.open_memmap(
+            directory / VECTORS_FILE, mode="w+", dtype=np.dtype(dtype), shape=(count, EMBEDDING_DIM)
+        )
+
+        result = session.exec(
+            select(Embeddings.art_object_id, Embeddings.image)
+            .order_by(col(Embeddings.art_object_id).asc())
+            .execution_options(yield_per=SNAPSHOT_BATCH_SIZE)
+        )
+
+        row = 0
+        for art_object_id, image in result:
+            if row == count:
+                # Rows inserted after counting are picked up by the next snapshot
+                break
+            ids[row] = art_object_id
+            vectors[row] = image
+            row += 1
+
+    vectors.flush()
+    np.save(directory / IDS_FILE, ids[:row])
+    logger.info(f"Done writing snapshot of {row} embeddings.")
+
+
+@cache
+def get_vector_store() -> VectorStore:
+    if settings.search_backend == SearchBackend.SHARDED:
+        from db.sharded_store import ShardedVectorStore
+
+        return ShardedVectorStore.load(settings.vector_snapshot_dir, shards=settings.vector_shards or None)
+    return VectorStore.load(settings.vector_snapshot_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a vector snapshot for the memmap search backend")
+    parser.add_argument("--directory", type=Path, default=settings.vector_snapshot_dir, help="Output directory")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32", help="Storage precision")
+    args = parser.parse_args()
+
+    build_snapshot(args.directory, args.dtype)
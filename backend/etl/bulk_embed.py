@@ -5,16 +5,19 @@ from multiprocessing import Pool
 
 from loguru import logger
 
-from db.crud import retrieve_unembedded_image_art
+from db.crud import bump_dataset_version_after_ingest, retrieve_unembedded_image_art
+from db.models import refresh_embedding_index
 from etl.embed.embed import _run_embed_stage, batched
 from etl.embed.models import get_image_embedder
+from etl.knn_graph import refresh_knn_graph
 
-NUM_THREADS_PER_PROC = 3
+NUM_THREADS_PER_PROC = 5
 
 def process_batch(args):
     id_url_pairs, retrieval_batch_size, embedding_batch_size = args
     image_embedder = get_image_embedder()
-    _run_embed_stage(id_url_pairs, image_embedder, retrieval_batch_size, embedding_batch_size)
+    # Processes of a multiprocessing pool can not start processes of their own, so they preprocess in a thread
+    _run_embed_stage(id_url_pairs, image_embedder, retrieval_batch_size, embedding_batch_size, preprocess_workers=0)
 
 
 def embed_in_parallel(total_amount: int, num_processes: int, retrieval_batch_size: int, embedding_batch_size: int):
@@ -24,7 +27,7 @@ def embed_in_parallel(total_amount: int, num_processes: int, retrieval_batch_siz
     start = time.time()
     unembedded_art = retrieve_unembedded_image_art(total_amount)
     if num_processes == -1:
-        # Each process has 3 threads, so we want to spin up
+        # Each process runs 2 download, 1 preprocess, 1 embed and 1 save thread, so we want to spin up
         num_processes = os.cpu_count() // NUM_THREADS_PER_PROC
         logger.info("num_processes is passed -1, so using all logical cores")
     logger.info(f"total_amount: {total_amount}")
@@ -40,8 +43,12 @@ def embed_in_parallel(total_amount: int, num_processes: int, retrieval_batch_siz
 
     process_args = [(batch, retrieval_batch_size, embedding_batch_size) for batch in batches]
 
-    with Pool(num_processes) as pool:
-        pool.map(process_batch, process_args)
+    with bump_dataset_version_after_ingest():
+        with Pool(num_processes) as pool:
+            pool.map(process_batch, process_args)
+
+        refresh_embedding_index()
+        refresh_knn_graph()
 
     end = time.time()
     logger.info(f"Total processing time: {end - start} seconds, to process {len(unembedded_art)} embeddings.")
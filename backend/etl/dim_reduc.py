@@ -1,3 +1,5 @@
+import argparse
+
 import numpy as np
 from joblib import dump, load
 from loguru import logger
@@ -5,12 +7,47 @@ from sklearn.base import TransformerMixin
 from sklearn.decomposition import PCA
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import MinMaxScaler
+from sqlmodel import Session
 
-from db.crud import retrieve_embeddings
-from etl.constants import MODEL_DIR
+from config import settings
+from db.crud import (
+    bump_dataset_version,
+    retrieve_embeddings,
+    retrieve_embeddings_without_coordinates,
+    save_coordinates,
+)
+from db.models import engine
 
 SEED = 42
-PCA_PATH = MODEL_DIR / "pca.joblib"
+PCA_PATH = settings.pca_path
+COORDINATES_BATCH_SIZE = 10000
+
+
+class LinearProjection:
+    """
+    NumPy equivalent of the fitted PCA and MinMaxScaler pipeline.
+
+    Both steps are affine, so projecting is one matrix product, which is cheap enough to do
+    on the request path without going through sklearn's input validation.
+    """
+
+    def __init__(self, components: np.ndarray, mean: np.ndarray, scale: np.ndarray, offset: np.ndarray):
+        self.components = components.astype(np.float32)
+        self.mean = mean.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+        self.offset = offset.astype(np.float32)
+
+    @classmethod
+    def from_pipeline(cls, pipeline: Pipeline) -> "LinearProjection":
+        pca = pipeline.named_steps["projection"]
+        scaler = pipeline.named_steps["scaler"]
+        if pca.whiten:
+            msg = "Whitened PCA projections are not supported"
+            raise ValueError(msg)
+        return cls(pca.components_, pca.mean_, scaler.scale_, scaler.min_)
+
+    def __call__(self, embeddings: np.ndarray) -> np.ndarray:
+        return ((embeddings - self.mean) @ self.components.T) * self.scale + self.offset
 
 
 def build_projection_pipe(projection: TransformerMixin) -> Pipeline:
@@ -22,22 +59,63 @@ def fit_pca_on_image_embeddings(limit: int | None = None):
     embeddings = retrieve_embeddings(limit=limit)
     logger.info("Done retrieving embeddings")
     X = np.array([embedding.image for embedding in embeddings])
+    art_object_ids = [embedding.art_object_id for embedding in embeddings]
 
     logger.info("Starting to fit PCA model.")
     pca_pipeline = build_projection_pipe(PCA(n_components=2, random_state=SEED))
     pca_pipeline.fit(X)
     coordinates = pca_pipeline.transform(X)
     logger.info("Done fitting PCA model!")
-    return pca_pipeline, coordinates
+    return pca_pipeline, coordinates, art_object_ids
 
 
-def fit_pca_on_all():
+def save_all_coordinates(
+    art_object_ids: list[int], coordinates: np.ndarray, projection_version: int = settings.projection_version
+) -> None:
+    logger.info(f"Saving {len(art_object_ids)} coordinates for projection version {projection_version}.")
+    with Session(engine) as conn:
+        for start in range(0, len(art_object_ids), COORDINATES_BATCH_SIZE):
+            batch = [
+                (art_object_id, x.item(), y.item())
+                for art_object_id, (x, y) in zip(
+                    art_object_ids[start : start + COORDINATES_BATCH_SIZE],
+                    coordinates[start : start + COORDINATES_BATCH_SIZE],
+                    strict=True,
+                )
+            ]
+            save_coordinates(conn, batch, projection_version)
+    logger.info("Done saving coordinates!")
+
+
+def fit_pca_on_all(projection_version: int = settings.projection_version):
     logger.info("Starting to fit PCA model on all image embeddings in DB.")
-    pca, _ = fit_pca_on_image_embeddings()
+    pca, coordinates, art_object_ids = fit_pca_on_image_embeddings()
     logger.info("Done fitting model.")
     logger.info(f"Saving model to {PCA_PATH}")
     dump(pca, PCA_PATH)
     logger.info("Done saving model!")
+    save_all_coordinates(art_object_ids, coordinates, projection_version)
+    bump_dataset_version()
+
+
+def backfill_coordinates(projection_version: int = settings.projection_version) -> None:
+    """Project all embeddings that have no coordinates yet in the given projection version."""
+    projection = LinearProjection.from_pipeline(load_pca())
+    total = 0
+
+    with Session(engine) as conn:
+        while batch := retrieve_embeddings_without_coordinates(COORDINATES_BATCH_SIZE, projection_version):
+            art_object_ids, images = zip(*batch, strict=True)
+            coordinates = projection(np.stack(images))
+            batch_coordinates = [
+                (art_object_id, x.item(), y.item())
+                for art_object_id, (x, y) in zip(art_object_ids, coordinates, strict=True)
+            ]
+            save_coordinates(conn, batch_coordinates, projection_version)
+            total += len(batch)
+            logger.info(f"Backfilled coordinates for {total} art objects.")
+
+    logger.info(f"Done backfilling coordinates for {total} art objects.")
 
 
 def load_pca() -> PCA:
@@ -52,4 +130,16 @@ def get_embedding_coordinates(pca: PCA, embeddings: np.ndarray) -> np.ndarray:
 
 
 if __name__ == "__main__":
-    fit_pca_on_all()
+    parser = argparse.ArgumentParser(description="Fit the 2-D map projection and store the coordinates")
+    parser.add_argument(
+        "--backfill", action="store_true", help="Only project embeddings without coordinates, using the saved model"
+    )
+    parser.add_argument(
+        "--projection-version", type=int, default=settings.projection_version, help="Version to store coordinates as"
+    )
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_coordinates(args.projection_version)
+    else:
+        fit_pca_on_all(args.projection_version)
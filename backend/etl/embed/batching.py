@@ -0,0 +1,105 @@
+import threading
+from concurrent.futures import Future
+from queue import Empty, Queue
+from time import monotonic
+from typing import TYPE_CHECKING
+
+import numpy as np
+from loguru import logger
+
+if TYPE_CHECKING:
+    import torch
+
+    from etl.embed.models import TextEmbedder
+    from etl.embed.onnx_models import OnnxTextEmbedder
+
+_STOP = object()
+
+
+class BatchingTextEmbedder:
+    """
+    Coalesce concurrent single text embedding requests into batched forward passes.
+
+    Callers block until their embedding is ready, like with a plain TextEmbedder. A background
+    thread collects the texts that arrive within `max_wait_ms` of the first one, up to
+    `max_batch_size`, and embeds them in one tokenizer and model call.
+    """
+
+    def __init__(
+        self,
+        text_embedder: "TextEmbedder | OnnxTextEmbedder",
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+    ):
+        self.text_embedder = text_embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._requests: Queue = Queue()
+        self._worker = threading.Thread(target=self._run, name="text-embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def __call__(self, texts: str | list[str]) -> "torch.Tensor | np.ndarray":
+        """Embed texts, single texts are batched together with those of other callers."""
+        if not isinstance(texts, str):
+            # Already a batch, nothing to gain from coalescing
+            return self.text_embedder(texts)
+
+        future: Future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+
+    def close(self) -> None:
+        """Stop the batching thread after it has handled all pending requests."""
+        self._requests.put(_STOP)
+        self._worker.join()
+
+    def _collect_batch(self, first_request: tuple[str, Future]) -> tuple[list[tuple[str, Future]], bool]:
+        """Gather requests until the batch is full or the wait time is up, returns whether to stop."""
+        batch = [first_request]
+        deadline = monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except Empty:
+                break
+
+            if request is _STOP:
+                return batch, True
+            batch.append(request)
+
+        return batch, False
+
+    def _embed_batch(self, batch: list[tuple[str, Future]]) -> None:
+        # Identical texts in one batch only have to be embedded once
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+
+        try:
+            embeddings = self.text_embedder(unique_texts)
+        except Exception as e:  # noqa: BLE001
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        rows = {text: row for row, text in enumerate(unique_texts)}
+        for text, future in batch:
+            row = rows[text]
+            future.set_result(embeddings[row : row + 1])
+
+    def _run(self) -> None:
+        while True:
+            request = self._requests.get()
+            if request is _STOP:
+                break
+
+            batch, stop = self._collect_batch(request)
+            if len(batch) > 1:
+                logger.debug(f"Coalesced {len(batch)} text embedding requests into one batch")
+            self._embed_batch(batch)
+
+            if stop:
+                break
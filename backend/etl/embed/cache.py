@@ -0,0 +1,149 @@
+import threading
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path
+from time import time
+from typing import TYPE_CHECKING
+
+import numpy as np
+from loguru import logger
+
+from etl.embed.utils import to_numpy
+
+if TYPE_CHECKING:
+    import torch
+
+
+def normalize_query(text: str) -> str:
+    """Fold case and whitespace, so trivially different queries share a cache entry."""
+    return " ".join(text.casefold().split())
+
+
+class CachedTextEmbedder:
+    """
+    Bounded LRU cache with an optional TTL in front of a TextEmbedder, or anything with the same call contract.
+
+    Embeddings are stored as read-only float32 vectors, keyed by the normalized query text.
+    The cache can be persisted to a `.npz` file, so a restarted API starts with a warm cache.
+    """
+
+    def __init__(
+        self,
+        text_embedder: Callable[[str | list[str]], "torch.Tensor | np.ndarray"],
+        max_size: int = 10000,
+        ttl: float | None = None,
+        persist_path: Path | None = None,
+    ):
+        self.text_embedder = text_embedder
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+
+        self.hits = 0
+        self.misses = 0
+
+        # Maps the normalized query to the time it was embedded and its embedding
+        self._entries: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        if persist_path is not None and persist_path.exists():
+            self.load(persist_path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time() - created_at > self.ttl
+
+    def _get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry[0]):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, key: str, embedding: np.ndarray, created_at: float) -> np.ndarray:
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+
+        with self._lock:
+            self._entries[key] = (created_at, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return embedding
+
+    def __call__(self, text: str) -> np.ndarray:
+        """Get the normalized embedding of one text, only running the model on a cache miss."""
+        key = normalize_query(text)
+
+        embedding = self._get(key)
+        if embedding is not None:
+            return embedding
+
+        # The model runs outside of the lock, so concurrent misses do not wait on each other
+        embedding = to_numpy(self.text_embedder(key))[0]
+        return self._put(key, embedding, time())
+
+    def embed_many(self, texts: list[str]) -> np.ndarray:
+        """Get the normalized embeddings of several texts, running the model once for all cache misses."""
+        keys = [normalize_query(text) for text in texts]
+        embeddings = {key: self._get(key) for key in dict.fromkeys(keys)}
+
+        missing = [key for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            now = time()
+            for key, embedding in zip(missing, to_numpy(self.text_embedder(missing)), strict=True):
+                embeddings[key] = self._put(key, embedding, now)
+
+        return np.stack([embeddings[key] for key in keys])
+
+    def save(self, path: Path | None = None) -> None:
+        """Write all unexpired entries to disk."""
+        path = path or self.persist_path
+        if path is None:
+            msg = "No path given to save the text embedding cache to"
+            raise ValueError(msg)
+
+        with self._lock:
+            entries = [(key, entry) for key, entry in self._entries.items() if not self._is_expired(entry[0])]
+
+        if not entries:
+            logger.info("Text embedding cache is empty, not saving it.")
+            return
+
+        keys, values = zip(*entries, strict=True)
+        created_at, embeddings = zip(*values, strict=True)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so a crash while saving never leaves a corrupt cache behind. Its name is
+        # unique, since every worker of a prefork server saves its own cache to the same path on shutdown.
+        tmp_path = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp.npz")
+        np.savez(tmp_path, keys=np.array(keys), created_at=np.array(created_at), embeddings=np.stack(embeddings))
+        tmp_path.replace(path)
+        logger.info(f"Saved {len(keys)} text embeddings to {path}")
+
+    def load(self, path: Path) -> None:
+        """Fill the cache from a file written by `save`, oldest entries first so LRU order is kept."""
+        try:
+            with np.load(path) as data:
+                keys, created_at, embeddings = data["keys"], data["created_at"], data["embeddings"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load text embedding cache from {path}: {e}, starting with an empty cache")
+            return
+
+        for key, timestamp, embedding in zip(keys.tolist(), created_at.tolist(), embeddings, strict=True):
+            if not self._is_expired(timestamp):
+                self._put(key, embedding, timestamp)
+
+        logger.info(f"Loaded {len(self._entries)} text embeddings from {path}")
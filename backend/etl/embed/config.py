@@ -1,3 +1,5 @@
 # The model that was used for all embeddings
 HF_IMG_BASE_URL = "openai/clip-vit-base-patch32"
 HF_TEXT_BASE_URL = "openai/clip-vit-base-patch32"
+# Side of the square pixel input of the CLIP vision encoder
+CLIP_IMAGE_SIZE = 224
@@ -1,25 +1,35 @@
 import argparse
 import asyncio
 import itertools
-import queue
-import threading
 import time
-from contextlib import contextmanager
-from queue import Queue
+from contextlib import contextmanager, nullcontext
 
 import httpx
 import numpy as np
-import torch
 from loguru import logger
-from PIL import Image
 from sqlalchemy import create_engine, exc
 from sqlalchemy.orm import sessionmaker
 
 from config import settings
-from db.crud import insert_batch_image_embeddings, retrieve_unembedded_image_art
+from db.crud import (
+    bump_dataset_version_after_ingest,
+    insert_batch_image_embeddings,
+    retrieve_unembedded_image_art,
+    save_coordinates,
+)
+from db.models import refresh_embedding_index
+from etl.dim_reduc import LinearProjection, load_pca
 from etl.embed.models import ImageEmbedder, TextEmbedder, get_image_embedder
+from etl.embed.pipeline import Pipeline, PipelineStage
+from etl.embed.preprocess import ImagePreprocessorPool, preprocess_images
+from etl.embed.utils import to_numpy
 from etl.errors import EmbeddingError
-from etl.images import fetch_images_from_pairs
+from etl.image_cache import ImageCache, get_image_cache
+from etl.images import fetch_image_bytes_from_pairs
+from etl.knn_graph import refresh_knn_graph
+
+# Batches that can wait in front of each stage of the embedding pipeline
+QUEUED_BATCHES = 4
 
 
 @contextmanager
@@ -41,206 +51,176 @@ def batched(iterable, n):
         yield batch
 
 
-def get_images_embeddings(
-    images: list[tuple[int, Image.Image]], image_embedder: ImageEmbedder
-) -> list[tuple[int, torch.Tensor]]:
-    """
-    Generate embeddings for a list of images with their IDs.
-    """
-    ids, imgs = zip(*images, strict=False)
-    embeddings = image_embedder(list(imgs)).detach()
-
-    if len(ids) != len(embeddings):
-        raise EmbeddingError(msg="Amount of IDs does not match amount of embeddings")
-
-    return list(zip(ids, embeddings, strict=False))
-
-
 def embed_text(text: str) -> np.ndarray:
     """Embeds one text."""
     embedder = TextEmbedder()
     return embedder(text)[0].cpu().detach().numpy()
 
 
-def image_producer(
-    id_url_pairs: list[tuple[int, str]],
-    batch_size: int,
-    image_queue: Queue,
-    terminate_flag: threading.Event,
-    all_images_downloaded_flag: threading.Event,
-):
-    """Retrieves images async in batches, places them into a queue."""
+def load_projection() -> LinearProjection | None:
+    """Load the map projection to compute coordinates of new embeddings with, if one has been fitted."""
+    try:
+        return LinearProjection.from_pipeline(load_pca())
+    except FileNotFoundError:
+        logger.warning("No PCA model found, coordinates of new embeddings are computed when the PCA is fitted.")
+        return None
 
-    async def async_image_producer():
-        try:
-            total_downloaded = 0
-            n = len(id_url_pairs) // batch_size
-            async with httpx.AsyncClient() as client:
-                for batch_id, id_url_batch in enumerate(batched(id_url_pairs, batch_size)):
-                    logger.info(f"Starting to fetch {batch_size} new images. Progress: ({batch_id}/{n})")
 
-                    if terminate_flag.is_set():
-                        logger.warning("Producer is exiting due to termination flag.")
-                        break
+def project_embeddings(
+    projection: LinearProjection, ids_and_embeddings: list[tuple[int, np.ndarray]]
+) -> list[tuple[int, float, float]]:
+    ids, embeddings = zip(*ids_and_embeddings, strict=True)
+    coordinates = projection(np.stack(embeddings))
+    return [(art_object_id, x.item(), y.item()) for art_object_id, (x, y) in zip(ids, coordinates, strict=True)]
 
-                    # Async call
-                    ids_and_images = await fetch_images_from_pairs(client, id_url_batch)
 
-                    if ids_and_images:
-                        for id_url_pair in ids_and_images:
-                            image_queue.put(id_url_pair)
-                            total_downloaded += 1
-                    else:
-                        logger.debug("No images retrieved in batch, skipped entire batch")
+@contextmanager
+def image_downloader(image_cache: ImageCache | None = None):
+    """Download worker with its own event loop and HTTP client, which it keeps for all of its batches."""
+    runner = asyncio.Runner()
+    client = httpx.AsyncClient()
+    try:
+        yield lambda id_url_pairs: runner.run(fetch_image_bytes_from_pairs(client, id_url_pairs, image_cache))
+    finally:
+        runner.run(client.aclose())
+        runner.close()
 
-                    logger.info(f"Done fetching {batch_size} images. Batch id: {batch_id}")
 
-        except Exception as e:
-            logger.error(f"Async producer encountered an error: {e}")
-            terminate_flag.set()
-            raise
+def image_preprocessor(image_embedder: ImageEmbedder):
+    """Preprocessing in the threads of the pipeline, for processes that can not start a preprocessing pool."""
 
-        all_images_downloaded_flag.set()
-        logger.info(f"Done downloading images. Downloaded {total_downloaded} in total.")
+    def preprocess(ids_and_data: list[tuple[int, bytes]]) -> list[tuple[int, np.ndarray]]:
+        ids, pixel_values = preprocess_images(image_embedder.processor, ids_and_data)
+        return list(zip(ids, pixel_values, strict=True)) if ids else []
 
-    # If everything is done and no errors occurred, signal completion
-    asyncio.run(async_image_producer())
+    return preprocess
 
 
-def image_consumer_embedding_producer(
-    image_embedder: ImageEmbedder,
-    batch_size: int,
-    image_queue: Queue,
-    embedding_queue: Queue,
-    terminate_flag: threading.Event,
-    all_images_downloaded_flag: threading.Event,
-    all_images_embedded_flag: threading.Event,
-):
-    """Takes images out of a queue and embeds them, to put them in an embedding queue."""
-    embed_batch_id = 0
-    total_embedded = 0
-
-    while not terminate_flag.is_set():
-        try:
-            ids_and_images = []
-
-            # Continue fetching images from queue until we have a full batch
-            while len(ids_and_images) < batch_size:
-                try:
-                    # Check if all images are downloaded and queue is empty
-                    if all_images_downloaded_flag.is_set():
-                        # If images are done downloading, empty the queue in one step
-                        while not image_queue.empty():
-                            ids_and_images.append(image_queue.get(timeout=1))
-
-                        break  # Exit the while loop since we got everything left
-
-                    # Fetch image from the queue with a timeout of 1 second
-                    ids_and_images.append(image_queue.get(timeout=1))
-
-                except queue.Empty:
-                    # If downloading is complete and nothing is in the queue, finish
-                    if all_images_downloaded_flag.is_set() and image_queue.empty():
-                        logger.info("No more images to embed. Processing the remaining ones.")
-                        break
-
-            # Proceed only if we have images to embed
-            if ids_and_images:
-                logger.info(f"Starting to embed batch id: {embed_batch_id} with {len(ids_and_images)} images")
-
-                # Embed the fetched images
-                ids_and_embeddings = get_images_embeddings(ids_and_images, image_embedder)
-                total_embedded += len(ids_and_embeddings)
-
-                # Place the embeddings in the embedding queue
-                embedding_queue.put(ids_and_embeddings)
-
-                logger.info(f"Done embedding batch id: {embed_batch_id} with {len(ids_and_embeddings)} embeddings")
-                embed_batch_id += 1
-            elif all_images_downloaded_flag.is_set() and image_queue.empty():
-                logger.info(f"All images have been embedded. Total {total_embedded} images embedded.")
-                all_images_embedded_flag.set()  # Signal that embedding is finished
-                break
-
-        except Exception as e:
-            logger.error(f"Image embedder thread encountered an error: {e}")
-            terminate_flag.set()
-            raise
-
-    logger.info(f"Image embedding process successfully terminated after embedding {total_embedded} images.")
-
-
-def embedding_consumer_bulk_insert(
-    embedding_queue, terminate_flag, all_images_embedded_flag, all_embeddings_saved_flag
-):
-    """Takes embeddings out of a queue and saves them in a Vector Database."""
-    total_inserted = 0
-    # Make sure each embedding store thread has it's own unique connection to DB
-    with get_db_connection() as conn:
-        while not terminate_flag.is_set():
-            try:
-                ids_and_embeddings = embedding_queue.get(timeout=1)
-                insert_batch_image_embeddings(conn, ids_and_embeddings)
-                total_inserted += len(ids_and_embeddings)
-                logger.info(f"Done inserting {len(ids_and_embeddings)} embeddings into SQL database.")
+def image_embedding(image_embedder: ImageEmbedder):
+    def embed(ids_and_pixels: list[tuple[int, np.ndarray]]) -> list[tuple[int, np.ndarray]]:
+        ids, pixels = zip(*ids_and_pixels, strict=True)
+        logger.info(f"Embedding {len(ids)} images")
+        embeddings = to_numpy(image_embedder.embed_preprocessed(np.stack(pixels)))
 
-            except queue.Empty:
-                if all_images_embedded_flag.is_set():
-                    logger.info(f"Done storing all embeddings in the SQL database. Stored a total of {total_inserted}.")
-                    all_embeddings_saved_flag.set()
-                    break
+        if len(ids) != len(embeddings):
+            raise EmbeddingError(msg="Amount of IDs does not match amount of embeddings")
+        return list(zip(ids, embeddings, strict=True))
 
-            except Exception as e:
-                logger.error(f"Embedder SQL inserter thread encountered an error: {e}")
-                terminate_flag.set()
-                raise
+    return embed
 
 
-def _run_embed_stage(
-    id_url_pairs: tuple[int, str],
-    image_embedder: ImageEmbedder,
-    retrieval_batch_size: int,
-    embedding_batch_size: int,
-):
-    try:
-        image_queue = Queue(maxsize=retrieval_batch_size * 100)
-        embedding_queue = Queue(maxsize=embedding_batch_size * 100)
+@contextmanager
+def embedding_saver(projection: LinearProjection | None = None):
+    """Save worker that stores embeddings, and their map coordinates, over its own database connection."""
+    with get_db_connection() as conn:
 
-        if not id_url_pairs:
-            logger.info("No unembedded images, exiting.")
-            return
+        def save(ids_and_embeddings: list[tuple[int, np.ndarray]]) -> list:
+            insert_batch_image_embeddings(conn, ids_and_embeddings)
+            if projection is not None:
+                save_coordinates(conn, project_embeddings(projection, ids_and_embeddings))
+            logger.info(f"Done inserting {len(ids_and_embeddings)} embeddings into SQL database.")
+            return []
 
-        terminate_flag = threading.Event()
+        yield save
 
-        all_images_downloaded_flag = threading.Event()
-        all_images_embedded_flag = threading.Event()
-        all_embeddings_saved_flag = threading.Event()
 
-        image_prod_args = [id_url_pairs, retrieval_batch_size, image_queue, terminate_flag, all_images_downloaded_flag]
-        image_producer_thread = threading.Thread(target=image_producer, args=image_prod_args)
+def embedding_pipeline(
+    image_embedder: ImageEmbedder,
+    retrieval_batch_size: int,
+    embedding_batch_size: int,
+    download_workers: int = 2,
+    preprocessor: ImagePreprocessorPool | None = None,
+    embed_workers: int = 1,
+    save_workers: int = 1,
+) -> Pipeline:
+    """
+    Pipeline that downloads, preprocesses, embeds and stores images, taking (id, url) pairs.
 
-        emb_prod_args = [
-            image_embedder,
-            embedding_batch_size,
-            image_queue,
-            embedding_queue,
-            terminate_flag,
-            all_images_downloaded_flag,
-            all_images_embedded_flag,
+    Every stage can be given more workers when its throughput in the stage statistics shows it holds
+    the others back. The embed workers share one model, more than one only helps when a single batch
+    does not keep the hardware busy, each save worker opens its own database connection. Images are downloaded
+    without decoding them, decoding happens in the processes of the preprocessor, or in a single
+    thread of the pipeline without one.
+    """
+    projection = load_projection()
+    # Created before the download workers start, so they share one cache and the accounting of its size
+    image_cache = get_image_cache()
+    if preprocessor is not None:
+        preprocess_stage = PipelineStage.from_function(
+            "preprocess",
+            preprocessor,
+            # A thread per process of the pool, each waits on the batch its process works on
+            workers=preprocessor.processes,
+            batch_size=preprocessor.batch_size,
+            queue_size=QUEUED_BATCHES * preprocessor.batch_size * preprocessor.processes,
+        )
+    else:
+        preprocess_stage = PipelineStage.from_function(
+            "preprocess",
+            image_preprocessor(image_embedder),
+            batch_size=embedding_batch_size,
+            queue_size=QUEUED_BATCHES * embedding_batch_size,
+        )
+
+    return Pipeline(
+        [
+            PipelineStage(
+                "download",
+                lambda: image_downloader(image_cache),
+                workers=download_workers,
+                batch_size=retrieval_batch_size,
+                queue_size=QUEUED_BATCHES * retrieval_batch_size * download_workers,
+            ),
+            preprocess_stage,
+            PipelineStage.from_function(
+                "embed",
+                image_embedding(image_embedder),
+                workers=embed_workers,
+                batch_size=embedding_batch_size,
+                queue_size=QUEUED_BATCHES * embedding_batch_size * embed_workers,
+            ),
+            PipelineStage(
+                "save",
+                lambda: embedding_saver(projection),
+                workers=save_workers,
+                batch_size=embedding_batch_size,
+                queue_size=QUEUED_BATCHES * embedding_batch_size * save_workers,
+            ),
         ]
-        embed_thread = threading.Thread(target=image_consumer_embedding_producer, args=emb_prod_args)
-
-        emb_save_args = [embedding_queue, terminate_flag, all_images_embedded_flag, all_embeddings_saved_flag]
-        embedding_consumer_insert_thread = threading.Thread(target=embedding_consumer_bulk_insert, args=emb_save_args)
+    )
 
-        image_producer_thread.start()
-        embed_thread.start()
-        embedding_consumer_insert_thread.start()
 
-        image_producer_thread.join()
-        embed_thread.join()
-        embedding_consumer_insert_thread.join()
+def _run_embed_stage(
+    id_url_pairs: list[tuple[int, str]],
+    image_embedder: ImageEmbedder,
+    retrieval_batch_size: int,
+    embedding_batch_size: int,
+    download_workers: int = 2,
+    preprocess_workers: int = 2,
+    embed_workers: int = 1,
+    save_workers: int = 1,
+):
+    if not id_url_pairs:
+        logger.info("No unembedded images, exiting.")
+        return
 
+    try:
+        preprocess_pool = None
+        if preprocess_workers:
+            preprocess_pool = ImagePreprocessorPool(preprocess_workers, embedding_batch_size)
+        with preprocess_pool or nullcontext():
+            pipeline = embedding_pipeline(
+                image_embedder,
+                retrieval_batch_size,
+                embedding_batch_size,
+                download_workers,
+                preprocess_pool,
+                embed_workers,
+                save_workers,
+            )
+            pipeline.run(id_url_pairs)
+        if (image_cache := get_image_cache()) is not None:
+            logger.info(f"Image cache stats: {image_cache.stats}")
         logger.info("Processing completed.")
 
     except EmbeddingError as e:
@@ -254,11 +234,32 @@ def _run_embed_stage(
         raise
 
 
-def run_embed_stage(image_count: int, retrieval_batch_size: int, embedding_batch_size: int, offset: int = 0):
+def run_embed_stage(
+    image_count: int,
+    retrieval_batch_size: int,
+    embedding_batch_size: int,
+    offset: int = 0,
+    download_workers: int = 2,
+    preprocess_workers: int = 2,
+    embed_workers: int = 1,
+    save_workers: int = 1,
+):
     """Main function to retrieve, embed, and store images in batches."""
     image_embedder = get_image_embedder()
     id_url_pairs = retrieve_unembedded_image_art(image_count, offset=offset)
-    _run_embed_stage(id_url_pairs, image_embedder, retrieval_batch_size, embedding_batch_size)
+    with bump_dataset_version_after_ingest():
+        _run_embed_stage(
+            id_url_pairs,
+            image_embedder,
+            retrieval_batch_size,
+            embedding_batch_size,
+            download_workers,
+            preprocess_workers,
+            embed_workers,
+            save_workers,
+        )
+        refresh_embedding_index()
+        refresh_knn_graph()
 
 
 if __name__ == "__main__":
@@ -269,15 +270,23 @@ if __name__ == "__main__":
     parser.add_argument("--embedding-batch-size", type=int, default=8, help="Batch size for embedding images")
     parser.add_argument("--count", type=int, default=10000, help="Number of images to embed")
     parser.add_argument("--offset", type=int, default=0, help="Offset for this process to run")
+    parser.add_argument("--download-workers", type=int, default=2, help="Threads downloading images")
+    parser.add_argument(
+        "--preprocess-workers", type=int, default=2, help="Processes decoding and preprocessing images, 0 for none"
+    )
+    parser.add_argument("--embed-workers", type=int, default=1, help="Threads running the model on batches")
+    parser.add_argument("--save-workers", type=int, default=1, help="Threads storing embeddings in the database")
     args = parser.parse_args()
 
-    image_embedder = get_image_embedder()
     run_embed_stage(
-        image_embedder,
         image_count=args.count,
         retrieval_batch_size=args.retrieval_batch_size,
         embedding_batch_size=args.embedding_batch_size,
         offset=args.offset,
+        download_workers=args.download_workers,
+        preprocess_workers=args.preprocess_workers,
+        embed_workers=args.embed_workers,
+        save_workers=args.save_workers,
     )
 
     end = time.time()
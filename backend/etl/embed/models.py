@@ -1,5 +1,6 @@
 from time import time
 
+import numpy as np
 import torch
 from loguru import logger
 from PIL import Image
@@ -10,9 +11,11 @@ from transformers import (
     CLIPVisionModelWithProjection,
 )
 
+from config import EmbedderBackend, settings
 from etl.constants import HF_CACHE_DIR
 from etl.embed.config import HF_IMG_BASE_URL, HF_TEXT_BASE_URL
 from etl.errors import EmbeddingError
+from metrics import Stage, timed_stage
 
 
 class ArtEmbedder:
@@ -47,18 +50,18 @@ class ImageEmbedder(ArtEmbedder):
         self.model.to(self.device)
         logger.info(f"Using ImageEmbedder with device {self.device}")
 
-    def _process(self, images: Image.Image | list[Image.Image]) -> torch.Tensor:
+    def preprocess(self, images: Image.Image | list[Image.Image]) -> np.ndarray:
         """
-        Process the input images to prepare them for embedding.
+        Decode, resize and normalize the input images into the pixel values the model takes.
         """
-        tensor = self.processor(images, return_tensors="pt")
-        return tensor
+        return self.processor(images, return_tensors="np")["pixel_values"]
 
-    def _embed(self, inputs: torch.Tensor) -> torch.Tensor:
+    def embed_preprocessed(self, pixel_values: np.ndarray) -> torch.Tensor:
         """
-        Generate embeddings for the processed images.
+        Generate normalized embeddings for images that went through `preprocess`.
         """
-        return self.model(**inputs).image_embeds
+        inputs = torch.from_numpy(pixel_values).to(self.device)
+        return self.norm(self.model(pixel_values=inputs).image_embeds)
 
     def __call__(self, images: Image.Image | list[Image.Image]) -> torch.Tensor:
         """
@@ -69,10 +72,7 @@ class ImageEmbedder(ArtEmbedder):
             logger.info(f"Embedding {batch_size} images")
             start_time = time()
 
-            inputs = self._process(images)
-            inputs.to(self.device)
-            image_embeds = self._embed(inputs)
-            proj_embeddings = self.norm(image_embeds)
+            proj_embeddings = self.embed_preprocessed(self.preprocess(images))
             logger.info(
                 f"Finished embedding texts in {time() - start_time} seconds.")
             return proj_embeddings
@@ -96,9 +96,9 @@ class TextEmbedder(ArtEmbedder):
         self.model.to(self.device)
         logger.info(f"Using TextEmbedder with device {self.device}")
 
-    def _tokenize(self, texts: str | list[str]) -> torch.Tensor:
+    def tokenize(self, texts: str | list[str]) -> torch.Tensor:
         """
-        Process the input texts to prepare them for embedding.
+        Tokenize and pad the input texts into the inputs the model takes.
         """
         return self.tokenizer(texts, return_tensors="pt", padding=True)
 
@@ -117,10 +117,12 @@ class TextEmbedder(ArtEmbedder):
             logger.info(f"Embedding {batch_size} texts")
             start_time = time()
 
-            inputs = self._tokenize(texts)
-            inputs.to(self.device)
-            text_embeds = self._embed(inputs)
-            proj_embeddings = self.norm(text_embeds)
+            with timed_stage(Stage.TOKENIZATION):
+                inputs = self.tokenize(texts)
+                inputs.to(self.device)
+            with timed_stage(Stage.MODEL_FORWARD):
+                text_embeds = self._embed(inputs)
+                proj_embeddings = self.norm(text_embeds)
             logger.info(
                 f"Finished embedding texts in {time() - start_time} seconds.")
             return proj_embeddings
@@ -131,6 +133,10 @@ class TextEmbedder(ArtEmbedder):
 
 
 def get_image_embedder() -> ImageEmbedder:
+    if settings.embedder_backend == EmbedderBackend.ONNX:
+        from etl.embed.onnx_models import get_onnx_image_embedder
+
+        return get_onnx_image_embedder()
     return ImageEmbedder()
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+import argparse
+from pathlib import Path
+from time import time
+
+import numpy as np
+import onnxruntime as ort
+from loguru import logger
+from PIL import Image
+from transformers import CLIPImageProcessor, CLIPTokenizerFast
+
+from config import settings
+from etl.constants import HF_CACHE_DIR
+from etl.embed.config import HF_IMG_BASE_URL, HF_TEXT_BASE_URL
+from etl.errors import EmbeddingError
+from metrics import Stage, timed_stage
+
+TEXT_ENCODER_FILE = "text_encoder"
+IMAGE_ENCODER_FILE = "image_encoder"
+OPSET_VERSION = 17
+# Operators whose weights are quantized per graph, None quantizes all supported ones. The CPU provider of ONNX Runtime
+# has no ConvInteger kernel for int8 weights, so the patch embedding convolution of the vision encoder stays float.
+QUANTIZED_OP_TYPES = {TEXT_ENCODER_FILE: None, IMAGE_ENCODER_FILE: ["MatMul", "Gemm"]}
+
+SAMPLE_TEXTS = [
+    "A portrait of a woman dressed in black, painted by Rembrandt",
+    "sunflowers",
+    "a stormy sea with sailing ships",
+]
+
+
+def onnx_model_path(model_dir: Path, name: str, *, quantized: bool = False) -> Path:
+    return model_dir / (f"{name}.int8.onnx" if quantized else f"{name}.onnx")
+
+
+class OnnxEmbedder:
+    def __init__(self, model_path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        """
+        Create an ONNX Runtime session on the CPU, 0 threads lets ONNX Runtime decide.
+        """
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        logger.info(f"Using {type(self).__name__} with model {model_path}")
+
+    def norm(self, embeddings: np.ndarray) -> np.ndarray:
+        return embeddings / np.linalg.norm(embeddings, ord=2, axis=-1, keepdims=True)
+
+
+class OnnxTextEmbedder(OnnxEmbedder):
+    """TextEmbedder that runs the exported CLIP text encoder on ONNX Runtime, returning NumPy arrays."""
+
+    def __init__(self, model_path: Path, hf_base_url: str = HF_TEXT_BASE_URL, **session_options):
+        super().__init__(model_path, **session_options)
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(hf_base_url, cache_dir=HF_CACHE_DIR)
+
+    def __call__(self, texts: str | list[str]) -> np.ndarray:
+        """
+        Call the OnnxTextEmbedder with one or more texts to get their embeddings.
+        """
+        try:
+            batch_size = 1 if isinstance(texts, str) else len(texts)
+            logger.info(f"Embedding {batch_size} texts")
+            start_time = time()
+
+            with timed_stage(Stage.TOKENIZATION):
+                inputs = self.tokenizer(texts, return_tensors="np", padding=True)
+            with timed_stage(Stage.MODEL_FORWARD):
+                (text_embeds,) = self.session.run(
+                    None,
+                    {
+                        "input_ids": inputs["input_ids"].astype(np.int64),
+                        "attention_mask": inputs["attention_mask"].astype(np.int64),
+                    },
+                )
+                proj_embeddings = self.norm(text_embeds)
+            logger.info(f"Finished embedding texts in {time() - start_time} seconds.")
+            return proj_embeddings
+
+        except Exception as e:
+            raise EmbeddingError(msg=str(e)) from e
+
+
+class OnnxImageEmbedder(OnnxEmbedder):
+    """ImageEmbedder that runs the exported CLIP vision encoder on ONNX Runtime, returning NumPy arrays."""
+
+    def __init__(self, model_path: Path, hf_base_url: str = HF_IMG_BASE_URL, **session_options):
+        super().__init__(model_path, **session_options)
+        self.processor = CLIPImageProcessor.from_pretrained(hf_base_url, cache_dir=HF_CACHE_DIR)
+
+    def preprocess(self, images: Image.Image | list[Image.Image]) -> np.ndarray:
+        """
+        Decode, resize and normalize the input images into the pixel values the model takes.
+        """
+        return self.processor(images, return_tensors="np")["pixel_values"]
+
+    def embed_preprocessed(self, pixel_values: np.ndarray) -> np.ndarray:
+        """
+        Generate normalized embeddings for images that went through `preprocess`.
+        """
+        (image_embeds,) = self.session.run(None, {"pixel_values": pixel_values.astype(np.float32)})
+        return self.norm(image_embeds)
+
+    def __call__(self, images: Image.Image | list[Image.Image]) -> np.ndarray:
+        """
+        Call the OnnxImageEmbedder with one or more images to get their embeddings.
+        """
+        try:
+            batch_size = 1 if isinstance(images, Image.Image) else len(images)
+            logger.info(f"Embedding {batch_size} images")
+            start_time = time()
+
+            proj_embeddings = self.embed_preprocessed(self.preprocess(images))
+            logger.info(f"Finished embedding images in {time() - start_time} seconds.")
+            return proj_embeddings
+
+        except Exception as e:
+            raise EmbeddingError(msg=str(e)) from e
+
+
+def get_onnx_text_embedder(intra_op_threads: int | None = None) -> OnnxTextEmbedder:
+    return OnnxTextEmbedder(
+        onnx_model_path(settings.onnx_model_dir, TEXT_ENCODER_FILE, quantized=settings.onnx_quantized),
+        intra_op_threads=settings.onnx_intra_op_threads if intra_op_threads is None else intra_op_threads,
+        inter_op_threads=settings.onnx_inter_op_threads,
+    )
+
+
+def get_onnx_image_embedder() -> OnnxImageEmbedder:
+    return OnnxImageEmbedder(
+        onnx_model_path(settings.onnx_model_dir, IMAGE_ENCODER_FILE, quantized=settings.onnx_quantized),
+        intra_op_threads=settings.onnx_intra_op_threads,
+        inter_op_threads=settings.onnx_inter_op_threads,
+    )
+
+
+def quantize_graph(model_path: Path, quantized_path: Path, op_types: list[str] | None = None) -> None:
+    """Dynamically quantize the weights of a graph to int8, only those of `op_types` when given."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    logger.info(f"Quantizing {model_path} to {quantized_path}")
+    quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8, op_types_to_quantize=op_types)
+
+
+def _sample_images() -> list[Image.Image]:
+    """Deterministic noise images, so the comparison does not depend on network access."""
+    rng = np.random.default_rng(42)
+    return [Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in range(3)]
+
+
+def _cosine_deviation(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Largest 1 - cosine similarity between corresponding rows of two sets of normalized embeddings."""
+    return float(np.max(1 - np.sum(reference * candidate, axis=-1)))
+
+
+def export_onnx(model_dir: Path = settings.onnx_model_dir, *, quantize: bool = False) -> dict[str, float]:
+    """
+    Export the CLIP text and vision encoders to ONNX and report how far their outputs deviate from PyTorch.
+
+    Parameters
+    ----------
+    model_dir: Path
+        Directory to write the ONNX graphs to.
+    quantize: bool
+        Also write dynamically int8 quantized versions of both graphs.
+
+    Returns
+    -------
+    dict[str, float]
+        Largest cosine deviation from the PyTorch embeddings on sample inputs, per exported graph.
+
+    """
+    # Only exporting needs torch, embedding with the exported graphs does not
+    import torch
+
+    from etl.embed.models import ImageEmbedder, TextEmbedder
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model(pixel_values=pixel_values).image_embeds
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    text_embedder = TextEmbedder(device="cpu")
+    image_embedder = ImageEmbedder(device="cpu")
+    text_inputs = text_embedder.tokenize(SAMPLE_TEXTS)
+    pixel_values = torch.from_numpy(image_embedder.preprocess(_sample_images()))
+
+    text_path = onnx_model_path(model_dir, TEXT_ENCODER_FILE)
+    image_path = onnx_model_path(model_dir, IMAGE_ENCODER_FILE)
+
+    logger.info(f"Exporting text encoder to {text_path}")
+    torch.onnx.export(
+        TextEncoder(text_embedder.model.eval()),
+        (text_inputs["input_ids"], text_inputs["attention_mask"]),
+        text_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["text_embeds"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "text_embeds": {0: "batch"},
+        },
+        opset_version=OPSET_VERSION,
+    )
+
+    logger.info(f"Exporting image encoder to {image_path}")
+    torch.onnx.export(
+        ImageEncoder(image_embedder.model.eval()),
+        (pixel_values,),
+        image_path,
+        input_names=["pixel_values"],
+        output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=OPSET_VERSION,
+    )
+
+    paths = {"text": text_path, "image": image_path}
+    if quantize:
+        for name, file in [("text", TEXT_ENCODER_FILE), ("image", IMAGE_ENCODER_FILE)]:
+            quantized_path = onnx_model_path(model_dir, file, quantized=True)
+            quantize_graph(paths[name], quantized_path, QUANTIZED_OP_TYPES[file])
+            paths[f"{name}_int8"] = quantized_path
+
+    with torch.no_grad():
+        reference_text = text_embedder(SAMPLE_TEXTS).numpy()
+        reference_image = image_embedder(_sample_images()).numpy()
+
+    deviations = {}
+    for name, path in paths.items():
+        if name.startswith("text"):
+            deviation = _cosine_deviation(reference_text, OnnxTextEmbedder(path)(SAMPLE_TEXTS))
+        else:
+            deviation = _cosine_deviation(reference_image, OnnxImageEmbedder(path)(_sample_images()))
+        deviations[name] = deviation
+        logger.info(f"Largest cosine deviation of {path.name} from PyTorch: {deviation:.2e}")
+
+    return deviations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the CLIP encoders to ONNX")
+    parser.add_argument("--model-dir", type=Path, default=settings.onnx_model_dir, help="Output directory")
+    parser.add_argument("--quantize", action="store_true", help="Also write dynamic int8 quantized graphs")
+    args = parser.parse_args()
+
+    export_onnx(args.model_dir, quantize=args.quantize)
@@ -0,0 +1,175 @@
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field
+from queue import Queue
+from time import perf_counter
+
+from loguru import logger
+
+# Put on the queue of a stage once for each of its workers when the stage before it is done, see `Pipeline._finish`
+_DONE = object()
+
+# Handles a batch of items of a stage, returning the items for the next stage
+Process = Callable[[list], list]
+
+
+@dataclass
+class PipelineStage:
+    """
+    Step of a `Pipeline`, run by `workers` threads that each handle up to `batch_size` items at a time.
+
+    `open_worker` is called once in each worker thread and gives the function that handles its batches,
+    as a context manager so that a worker can hold a client or connection for as long as it runs.
+    """
+
+    name: str
+    open_worker: Callable[[], AbstractContextManager[Process]]
+    workers: int = 1
+    batch_size: int = 1
+    # Items that can wait in front of the stage, the stage before it blocks when they are not taken fast enough
+    queue_size: int = 64
+
+    @classmethod
+    def from_function(cls, name: str, process: Process, **kwargs) -> "PipelineStage":
+        """Stage whose workers share a function that needs no setup."""
+        return cls(name, lambda: nullcontext(process), **kwargs)
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items_in: int = 0
+    items_out: int = 0
+    # Seconds spent handling batches, summed over the workers
+    busy: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, items_in: int, items_out: int, duration: float) -> None:
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy += duration
+
+    def summary(self, elapsed: float, queued: int) -> str:
+        """Throughput and the fraction of time the workers were busy, the busiest stage is the bottleneck."""
+        throughput = self.items_in / elapsed if elapsed else 0.0
+        utilization = self.busy / (self.workers * elapsed) if elapsed else 0.0
+        return (
+            f"{self.name}: {self.items_in} in, {self.items_out} out, {throughput:.1f} items/s, "
+            f"{utilization:.0%} busy over {self.workers} workers, {queued} queued"
+        )
+
+
+class Pipeline:
+    """
+    Run items through a sequence of stages, each in its own pool of threads, connected by bounded queues.
+
+    A full queue blocks the stage in front of it, so a slow stage holds back the ones before it instead of
+    having their output pile up in memory. When the input is exhausted, every stage finishes its queue and
+    then passes an end marker for each worker of the next stage, so shutdown needs no polling.
+
+    When a worker fails, the other stages stop handling items but keep emptying their queues until the end
+    markers arrive, after which `run` raises the first error.
+    """
+
+    def __init__(self, stages: list[PipelineStage], report_interval: float = 30.0):
+        self.stages = stages
+        self.report_interval = report_interval
+        self.stats = [StageStats(stage.name, stage.workers) for stage in stages]
+
+        self._queues: list[Queue] = [Queue(maxsize=stage.queue_size) for stage in stages]
+        self._running_workers = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._failed = threading.Event()
+        self._finished = threading.Event()
+        self._error: Exception | None = None
+
+    def _batches(self, index: int) -> Iterator[list]:
+        """Batches of the queue of a stage, until its end marker."""
+        inbox, batch_size = self._queues[index], self.stages[index].batch_size
+        batch = []
+        while (item := inbox.get()) is not _DONE:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _work(self, index: int) -> None:
+        stage, stats = self.stages[index], self.stats[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self.stages) else None
+        batches = self._batches(index)
+
+        try:
+            with stage.open_worker() as process:
+                for batch in batches:
+                    if self._failed.is_set():
+                        continue
+
+                    start = perf_counter()
+                    outputs = process(batch)
+                    stats.record(len(batch), len(outputs), perf_counter() - start)
+
+                    if outbox is not None:
+                        for output in outputs:
+                            outbox.put(output)
+        except Exception as e:
+            logger.exception(f"Worker of pipeline stage '{stage.name}' failed, stopping the pipeline.")
+            with self._lock:
+                self._error = self._error or e
+            self._failed.set()
+            # Keep emptying the queue, so the stage before this one is never blocked on it
+            for _ in batches:
+                pass
+        finally:
+            self._finish(index)
+
+    def _finish(self, index: int) -> None:
+        with self._lock:
+            self._running_workers[index] -= 1
+            last = self._running_workers[index] == 0
+
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self._queues[index + 1].put(_DONE)
+
+    def _report(self, start: float) -> None:
+        while not self._finished.wait(self.report_interval):
+            self.log_stats(perf_counter() - start)
+
+    def log_stats(self, elapsed: float) -> None:
+        for stats, inbox in zip(self.stats, self._queues, strict=True):
+            logger.info(stats.summary(elapsed, inbox.qsize()))
+
+    def run(self, items: Iterable) -> list[StageStats]:
+        """Push all items through the stages, blocking until the last stage is done with them."""
+        start = perf_counter()
+        workers = [
+            threading.Thread(target=self._work, args=(index,), name=f"pipeline-{stage.name}-{worker}", daemon=True)
+            for index, stage in enumerate(self.stages)
+            for worker in range(stage.workers)
+        ]
+        reporter = threading.Thread(target=self._report, args=(start,), name="pipeline-report", daemon=True)
+        for thread in [*workers, reporter]:
+            thread.start()
+
+        for item in items:
+            if self._failed.is_set():
+                break
+            self._queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self._queues[0].put(_DONE)
+
+        for thread in workers:
+            thread.join()
+        self._finished.set()
+        reporter.join()
+
+        logger.info(f"Pipeline finished in {perf_counter() - start:.1f} seconds.")
+        self.log_stats(perf_counter() - start)
+        if self._error is not None:
+            raise self._error
+        return self.stats
@@ -0,0 +1,142 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from etl.embed.config import CLIP_IMAGE_SIZE, HF_IMG_BASE_URL
+
+CHANNELS = 3
+
+# State of a worker process, set up once when the process starts
+_processor = None
+_memory: SharedMemory | None = None
+_pixels: np.ndarray | None = None
+
+
+def decode_image(data: bytes, size: int = CLIP_IMAGE_SIZE) -> Image.Image:
+    """
+    Decode an image as RGB, at no more than the resolution it is preprocessed at.
+
+    CLIP resizes the shortest side of an image to `size`, so for JPEGs the decoder is asked for a draft
+    that is only as large as needed for that. It then skips the detail it would otherwise decode and
+    immediately throw away, which makes decoding several times faster for large images.
+    """
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    scale = size / min(width, height)
+    if scale < 1:
+        # Only JPEGs support drafts, other formats ignore it and are decoded at full size
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    return image.convert("RGB")
+
+
+def _pixel_slots(memory: SharedMemory, slots: int, batch_size: int, size: int) -> np.ndarray:
+    return np.ndarray((slots, batch_size, CHANNELS, size, size), dtype=np.float32, buffer=memory.buf)
+
+
+def _start_worker(memory_name: str, slots: int, batch_size: int, size: int, hf_base_url: str) -> None:
+    global _processor, _memory, _pixels  # noqa: PLW0603
+    from threadpoolctl import threadpool_limits
+    from transformers import CLIPImageProcessor
+
+    from etl.constants import HF_CACHE_DIR
+
+    # The pool already runs a process per core, threads within them would only compete for the same cores
+    threadpool_limits(1)
+
+    _processor = CLIPImageProcessor.from_pretrained(hf_base_url, cache_dir=HF_CACHE_DIR)
+    _memory = SharedMemory(name=memory_name)
+    _pixels = _pixel_slots(_memory, slots, batch_size, size)
+
+
+def preprocess_images(
+    processor, ids_and_data: list[tuple[int, bytes]], size: int = CLIP_IMAGE_SIZE
+) -> tuple[list[int], np.ndarray | None]:
+    """
+    Decode images and turn them into pixel values with a CLIPImageProcessor.
+
+    Images that can not be decoded are logged and left out, the ids of the others are returned with their pixel values.
+    """
+    ids = []
+    images = []
+    for art_object_id, data in ids_and_data:
+        try:
+            images.append(decode_image(data, size))
+            ids.append(art_object_id)
+        except Exception as e:  # noqa: BLE001
+            logger.error(f"Error decoding image for art object {art_object_id}: {e}, skipping image")
+
+    if not images:
+        return ids, None
+    return ids, processor(images, return_tensors="np")["pixel_values"]
+
+
+def _preprocess_into_slot(slot: int, ids_and_data: list[tuple[int, bytes]]) -> list[int]:
+    ids, pixel_values = preprocess_images(_processor, ids_and_data, _pixels.shape[-1])
+    if ids:
+        _pixels[slot, : len(ids)] = pixel_values
+    return ids
+
+
+class ImagePreprocessorPool:
+    """
+    Decode images and turn them into CLIP pixel values in worker processes, so the GIL is not shared with the model.
+
+    Every worker writes its pixel values into a slot of one shared memory buffer, instead of pickling them back.
+    There are as many slots as processes, a call waits for a free slot and holds it until the pixel values have
+    been copied out, so `processes` threads can use the pool at the same time.
+    """
+
+    def __init__(
+        self, processes: int, batch_size: int, size: int = CLIP_IMAGE_SIZE, hf_base_url: str = HF_IMG_BASE_URL
+    ):
+        self.processes = processes
+        self.batch_size = batch_size
+
+        slot_bytes = batch_size * CHANNELS * size * size * np.dtype(np.float32).itemsize
+        self._memory = SharedMemory(create=True, size=processes * slot_bytes)
+        self._pixels = _pixel_slots(self._memory, processes, batch_size, size)
+        self._free_slots: Queue[int] = Queue()
+        for slot in range(processes):
+            self._free_slots.put(slot)
+
+        # The pipeline already runs threads, forking it could deadlock the children
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=get_context("spawn"),
+            initializer=_start_worker,
+            initargs=(self._memory.name, processes, batch_size, size, hf_base_url),
+        )
+
+    def __enter__(self) -> "ImagePreprocessorPool":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __call__(self, ids_and_data: list[tuple[int, bytes]]) -> list[tuple[int, np.ndarray]]:
+        """Preprocess up to `batch_size` encoded images, leaving out those that can not be decoded."""
+        if len(ids_and_data) > self.batch_size:
+            msg = f"Got {len(ids_and_data)} images, the pool preprocesses batches of at most {self.batch_size}"
+            raise ValueError(msg)
+
+        slot = self._free_slots.get()
+        try:
+            ids = self._executor.submit(_preprocess_into_slot, slot, ids_and_data).result()
+            pixels = self._pixels[slot, : len(ids)].copy()
+        finally:
+            self._free_slots.put(slot)
+        return list(zip(ids, pixels, strict=True))
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        # The buffer can only be released once no array refers to it anymore
+        del self._pixels
+        self._memory.close()
+        self._memory.unlink()
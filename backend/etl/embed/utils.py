@@ -0,0 +1,9 @@
+import numpy as np
+
+
+def to_numpy(embeddings) -> np.ndarray:
+    """Convert embeddings from either a PyTorch or an ONNX Runtime embedder to a float32 NumPy array."""
+    # Duck typed, so callers that only use ONNX Runtime never have to import torch
+    if hasattr(embeddings, "detach"):
+        embeddings = embeddings.detach().cpu().numpy()
+    return np.asarray(embeddings, dtype=np.float32)
@@ -6,3 +6,8 @@ class ExtractError(Exception):
 class EmbeddingError(Exception):
     def __init__(self, msg: str) -> None:
         self.msg = msg
+
+
+class ImageNotCachedError(Exception):
+    def __init__(self, msg: str) -> None:
+        self.msg = msg
@@ -0,0 +1,192 @@
+import contextlib
+import hashlib
+import os
+import threading
+import uuid
+from functools import cache
+from io import BytesIO
+from pathlib import Path
+
+from loguru import logger
+from PIL import Image
+
+from config import ImageCacheVariant, settings
+from etl.embed.config import CLIP_IMAGE_SIZE
+from etl.embed.preprocess import decode_image
+
+INDEX_DIR = "index"
+BLOBS_DIR = "blobs"
+# Eviction removes the least recently used images until the cache is this fraction of its maximum size
+EVICT_TO = 0.9
+
+
+def resize_for_embedding(data: bytes, size: int = CLIP_IMAGE_SIZE) -> bytes:
+    """Shrink an image to the size the CLIP image processor resizes it to, as PNG."""
+    image = decode_image(data, size)
+    width, height = image.size
+    if min(width, height) > size:
+        # Rounded like the image processor does, so it leaves the stored image at this size
+        if width < height:
+            image = image.resize((size, int(height * size / width)), Image.Resampling.BICUBIC)
+        else:
+            image = image.resize((int(width * size / height), size), Image.Resampling.BICUBIC)
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    # Other processes embedding from the same cache never see a partially written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    temporary.write_bytes(data)
+    temporary.replace(path)
+
+
+class ImageCache:
+    """
+    Content-addressed cache of downloaded images on disk, bounded in size.
+
+    Images are stored once per distinct content under their SHA-256 hash, and an index maps the hash of
+    each url to the content it served, so urls with the same image share the stored file. The modification
+    time of a stored image is its last use, when the cache grows beyond `max_bytes` the least recently used
+    images are removed. Several processes can share a directory, each keeps an estimate of its size.
+
+    In cache-only mode images that are not cached are never downloaded, so runs over cached images work
+    offline and at disk speed.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int,
+        variant: ImageCacheVariant = ImageCacheVariant.ORIGINAL,
+        *,
+        cache_only: bool = False,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.variant = variant
+        self.cache_only = cache_only
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._scan())
+        logger.info(f"Using image cache at {directory} holding {self._size / 1024**2:.0f} MiB.")
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+    def _index_path(self, url: str) -> Path:
+        key = hashlib.sha256(f"{self.variant}:{url}".encode()).hexdigest()
+        return self.directory / INDEX_DIR / key[:2] / key
+
+    def _blob_path(self, content_hash: str) -> Path:
+        return self.directory / BLOBS_DIR / content_hash[:2] / content_hash
+
+    def _scan(self) -> list[tuple[float, int, Path]]:
+        """Last use, size and path of every stored image."""
+        blobs = []
+        for path in (self.directory / BLOBS_DIR).glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, path))
+        return blobs
+
+    def get(self, url: str) -> bytes | None:
+        """Stored image of a url, None when it is not cached."""
+        index_path = self._index_path(url)
+        try:
+            blob_path = self._blob_path(index_path.read_text())
+            data = blob_path.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark the image as recently used, for eviction, unless another process just evicted it
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(blob_path)
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, url: str, data: bytes) -> bytes:
+        """Store a downloaded image, returns what was stored, which is smaller for the resized variant."""
+        if self.variant == ImageCacheVariant.RESIZED:
+            data = resize_for_embedding(data)
+
+        content_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(content_hash)
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            _write_atomic(blob_path, data)
+            with self._lock:
+                self._size += len(data)
+        _write_atomic(self._index_path(url), content_hash.encode())
+
+        if self._size > self.max_bytes:
+            self.evict()
+        return data
+
+    def evict(self) -> None:
+        """Remove the least recently used images until the cache is well below its maximum size."""
+        with self._lock:
+            blobs = sorted(self._scan())
+            size = sum(blob_size for _, blob_size, _ in blobs)
+            target = self.max_bytes * EVICT_TO
+
+            evicted = set()
+            for _, blob_size, path in blobs:
+                if size <= target:
+                    break
+                path.unlink(missing_ok=True)
+                size -= blob_size
+                evicted.add(path.name)
+
+            self._size = size
+        dropped = self._drop_index_entries(evicted)
+        logger.info(
+            f"Evicted {len(evicted)} images and {dropped} urls from the image cache, {size / 1024**2:.0f} MiB remain."
+        )
+
+    def _drop_index_entries(self, content_hashes: set[str]) -> int:
+        """Remove the index entries of urls that served one of the given images, returns how many were removed."""
+        if not content_hashes:
+            return 0
+
+        dropped = 0
+        for path in (self.directory / INDEX_DIR).glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                content_hash = path.read_text()
+            except FileNotFoundError:
+                continue
+            # An image that is stored again after its eviction only costs its urls a miss
+            if content_hash in content_hashes:
+                path.unlink(missing_ok=True)
+                dropped += 1
+        return dropped
+
+
+@cache
+def get_image_cache() -> ImageCache | None:
+    """The image cache of the settings, None when no cache directory is configured."""
+    if settings.image_cache_dir is None:
+        return None
+    return ImageCache(
+        settings.image_cache_dir,
+        settings.image_cache_max_bytes,
+        settings.image_cache_variant,
+        cache_only=settings.image_cache_only,
+    )
@@ -5,36 +5,70 @@ import httpx
 from loguru import logger
 from PIL import Image
 
+from etl.errors import ImageNotCachedError
+from etl.image_cache import ImageCache
 
-async def download_img(client: httpx.AsyncClient, url: str) -> Image.Image:
+
+async def download_img_bytes(client: httpx.AsyncClient, url: str, cache: ImageCache | None = None) -> bytes:
     """
-    Download an image from the given URL using the provided HTTP client.
+    Download the encoded image at the given URL using the provided HTTP client.
 
     Args:
     ----
         client (httpx.AsyncClient): The HTTP client to use for the request.
-        id (int): The ID of the art object.
         url (str): The URL of the image to download.
+        cache (ImageCache | None): Cache to read the image from, and to store it in after downloading it.
 
     Returns:
     -------
-        Optional[Tuple[int, Image.Image]]: A tuple containing the art object ID and the downloaded image, or None if the download or processing fails.
+        bytes: The image file, as served or as stored by the cache. It is not decoded.
 
     """
+    if cache is not None:
+        # Disk access and resizing for the cache would otherwise hold up the other downloads
+        if (data := await asyncio.to_thread(cache.get, url)) is not None:
+            return data
+        if cache.cache_only:
+            msg = f"{url} is not in the image cache"
+            raise ImageNotCachedError(msg)
+
     response = await client.get(url)
     response.raise_for_status()
-    return Image.open(BytesIO(response.content))
+    if cache is not None:
+        return await asyncio.to_thread(cache.put, url, response.content)
+    return response.content
+
+
+async def download_img(client: httpx.AsyncClient, url: str, cache: ImageCache | None = None) -> Image.Image:
+    """
+    Download an image from the given URL using the provided HTTP client.
+
+    Args:
+    ----
+        client (httpx.AsyncClient): The HTTP client to use for the request.
+        url (str): The URL of the image to download.
+        cache (Optional[ImageCache]): The image cache to read the image from and store it in, if any.
 
+    Returns:
+    -------
+        Image.Image: The downloaded image.
 
-async def download_img_w_id(client: httpx.AsyncClient, img_id: int, url: str) -> tuple[int, Image.Image] | None:
+    """
+    return Image.open(BytesIO(await download_img_bytes(client, url, cache)))
+
+
+async def download_img_w_id(
+    client: httpx.AsyncClient, img_id: int, url: str, cache: ImageCache | None = None
+) -> tuple[int, Image.Image] | None:
     """
     Download an image from the given URL using the provided HTTP client.
 
     Args:
     ----
         client (httpx.AsyncClient): The HTTP client to use for the request.
-        id (int): The ID of the art object.
+        img_id (int): The ID of the art object.
         url (str): The URL of the image to download.
+        cache (Optional[ImageCache]): The image cache to read the image from and store it in, if any.
 
     Returns:
     -------
@@ -42,8 +76,10 @@ async def download_img_w_id(client: httpx.AsyncClient, img_id: int, url: str) ->
 
     """
     try:
-        image = await download_img(client, url)
+        image = await download_img(client, url, cache)
         return (img_id, image)
+    except ImageNotCachedError:
+        logger.warning(f"Image for art object {img_id} is not cached, skipping image")
     except httpx.HTTPStatusError:
         logger.error(
             f"Error fetching image for art object {img_id}, skipping image")
@@ -54,8 +90,56 @@ async def download_img_w_id(client: httpx.AsyncClient, img_id: int, url: str) ->
     return None
 
 
+async def download_img_bytes_w_id(
+    client: httpx.AsyncClient, img_id: int, url: str, cache: ImageCache | None = None
+) -> tuple[int, bytes] | None:
+    """
+    Download the encoded image at the given URL, logging and skipping it when the download fails.
+    """
+    try:
+        return (img_id, await download_img_bytes(client, url, cache))
+    except ImageNotCachedError:
+        logger.warning(f"Image for art object {img_id} is not cached, skipping image")
+    except httpx.HTTPStatusError:
+        logger.error(f"Error fetching image for art object {img_id}, skipping image")
+    except Exception as e:
+        logger.error(f"Error downloading image for art object {img_id}: {e}, skipping image")
+
+    return None
+
+
+def embedding_image_url(image_url: str) -> str:
+    """Url of the image at the size that is embedded, rather than at its original size."""
+    return image_url.replace("=s0", "=w1000")
+
+
+async def fetch_image_bytes_from_pairs(
+    client: httpx.AsyncClient, id_url_pairs: list[tuple[int, str]], cache: ImageCache | None = None
+) -> list[tuple[int, bytes]]:
+    """
+    Retrieve images without decoding them, so they can be decoded elsewhere.
+
+    Args:
+    ----
+        client (httpx.AsyncClient): The HTTP client to use for the requests.
+        id_url_pairs: list[tuple[int, str]]
+            List of identifiers and image URLs.
+        cache (ImageCache | None): Cache to read images from, and to store downloaded images in.
+
+    Returns:
+    -------
+        List[Tuple[int, bytes]]: A list of tuples containing IDs and their encoded images.
+
+    """
+    tasks = [
+        download_img_bytes_w_id(client, img_id, embedding_image_url(image_url), cache)
+        for img_id, image_url in id_url_pairs
+    ]
+    return [image for image in await asyncio.gather(*tasks) if image is not None]
+
+
 async def fetch_images_from_pairs(
-    client: httpx.AsyncClient, id_url_pairs: list[tuple[int, str]]
+    client: httpx.AsyncClient, id_url_pairs: list[tuple[int, str]], cache: ImageCache | None = None
 ) -> list[tuple[int, Image.Image]]:
     """
     Retrieve and download images.
@@ -65,6 +149,7 @@ async def fetch_images_from_pairs(
         client (httpx.AsyncClient): The HTTP client to use for the requests.
         id_url_pairs: list[tuple[int, str]]
             List of identifiers and image URLs.
+        cache (ImageCache | None): Cache to read images from, and to store downloaded images in.
 
     Returns:
     -------
@@ -73,8 +158,9 @@ async def fetch_images_from_pairs(
     """
     images: list[tuple[int, Image.Image]] = []
 
-    tasks = [download_img_w_id(client, img_id, image_url.replace(
-        "=s0", "=w1000")) for img_id, image_url in id_url_pairs]
+    tasks = [
+        download_img_w_id(client, img_id, embedding_image_url(image_url), cache) for img_id, image_url in id_url_pairs
+    ]
     batch_images = await asyncio.gather(*tasks)
     images.extend([img for img in batch_images if img is not None])
 
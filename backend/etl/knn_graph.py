@@ -0,0 +1,167 @@
+import argparse
+
+import numpy as np
+from loguru import logger
+from sqlmodel import Session, col, select
+
+from config import settings
+from db.crud import (
+    bump_dataset_version,
+    knn_graph_is_built,
+    retrieve_neighbour_thresholds,
+    retrieve_neighbours,
+    save_neighbours,
+)
+from db.models import Embeddings, engine
+from db.vector_store import VectorStore
+
+EMBEDDINGS_BATCH_SIZE = 10000
+# Objects whose neighbours are searched for in one pass over all embeddings
+QUERY_BLOCK_SIZE = 1024
+NEIGHBOURS_BATCH_SIZE = 1000
+
+
+def load_embeddings() -> tuple[np.ndarray, np.ndarray]:
+    """Load the ids, sorted, and the normalized embeddings of all ArtObjects with an embedding."""
+    ids = []
+    vectors = []
+    with Session(engine) as session:
+        result = session.exec(
+            select(Embeddings.art_object_id, Embeddings.image)
+            .order_by(col(Embeddings.art_object_id).asc())
+            .execution_options(yield_per=EMBEDDINGS_BATCH_SIZE)
+        )
+        for art_object_id, image in result:
+            ids.append(art_object_id)
+            vectors.append(image)
+
+    logger.info(f"Loaded {len(ids)} embeddings.")
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    return np.array(ids, dtype=np.int64), np.stack(vectors).astype(np.float32)
+
+
+def compute_neighbours(
+    store: VectorStore, art_object_ids: np.ndarray, size: int
+) -> list[tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Find the `size` nearest neighbours of the given ArtObjects among all embeddings in `store`.
+
+    The queries are handled a block at a time, so every pass over the embeddings is a matrix product
+    that NumPy's BLAS spreads over all cores.
+    """
+    neighbours = []
+    for start in range(0, len(art_object_ids), QUERY_BLOCK_SIZE):
+        block_ids = art_object_ids[start : start + QUERY_BLOCK_SIZE].tolist()
+        ids_per_query, scores_per_query = store.search_batch(store.get_vectors(block_ids), size, exclude_ids=block_ids)
+        neighbours.extend(zip(block_ids, ids_per_query, scores_per_query, strict=True))
+    return neighbours
+
+
+def save_all_neighbours(neighbours: list[tuple[int, np.ndarray, np.ndarray]]) -> None:
+    with Session(engine) as conn:
+        for start in range(0, len(neighbours), NEIGHBOURS_BATCH_SIZE):
+            save_neighbours(conn, neighbours[start : start + NEIGHBOURS_BATCH_SIZE])
+            logger.info(f"Saved neighbours of {min(start + NEIGHBOURS_BATCH_SIZE, len(neighbours))} art objects.")
+
+
+def build_knn_graph(size: int = settings.knn_graph_size) -> None:
+    """Compute and store the neighbours of every ArtObject with an embedding."""
+    ids, vectors = load_embeddings()
+    store = VectorStore(ids, vectors)
+
+    logger.info(f"Computing {size} neighbours for {len(ids)} art objects.")
+    save_all_neighbours(compute_neighbours(store, ids, size))
+    bump_dataset_version()
+    logger.info("Done building the neighbour graph!")
+
+
+def _merge_neighbours(
+    neighbour_ids: np.ndarray, similarities: np.ndarray, size: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """The `size` most similar neighbours, where an id that occurs more than once is kept only once."""
+    order = np.argsort(-similarities, kind="stable")
+    # The first occurrence of an id in similarity order is its most similar one
+    _, first = np.unique(neighbour_ids[order], return_index=True)
+    order = order[np.sort(first)[:size]]
+    return neighbour_ids[order], similarities[order]
+
+
+def update_knn_graph(size: int = settings.knn_graph_size) -> None:
+    """
+    Bring the neighbour graph up to date with embeddings that were ingested after it was computed.
+
+    Only the neighbourhoods of ArtObjects without complete graph entries are computed in full. Of the
+    others, just those for which a new ArtObject is more similar than their least similar stored
+    neighbour are updated, by merging in the new ArtObjects.
+    """
+    ids, vectors = load_embeddings()
+    store = VectorStore(ids, vectors)
+    thresholds = retrieve_neighbour_thresholds()
+
+    # A neighbourhood is complete when it holds `size` neighbours, or every other ArtObject there is
+    expected = min(size, len(ids) - 1)
+    is_new = np.array([thresholds.get(art_object_id, (0, 0.0))[0] < expected for art_object_id in ids.tolist()])
+    new_ids, old_ids = ids[is_new], ids[~is_new]
+    if not len(new_ids):
+        logger.info("The neighbour graph is up to date.")
+        return
+
+    logger.info(f"Computing {size} neighbours for {len(new_ids)} new art objects.")
+    save_all_neighbours(compute_neighbours(store, new_ids, size))
+
+    # Reverse entries: search the new ArtObjects for the best candidates of every existing one
+    new_store = VectorStore(new_ids, store.get_vectors(new_ids.tolist()))
+    affected = []
+    for start in range(0, len(old_ids), QUERY_BLOCK_SIZE):
+        block_ids = old_ids[start : start + QUERY_BLOCK_SIZE].tolist()
+        ids_per_query, scores_per_query = new_store.search_batch(store.get_vectors(block_ids), size)
+        for art_object_id, candidate_ids, candidate_scores in zip(
+            block_ids, ids_per_query, scores_per_query, strict=True
+        ):
+            _, threshold = thresholds[art_object_id]
+            beats_threshold = candidate_scores > threshold
+            if beats_threshold.any():
+                affected.append((art_object_id, candidate_ids[beats_threshold], candidate_scores[beats_threshold]))
+
+    logger.info(f"Updating the neighbours of {len(affected)} existing art objects.")
+    updated = []
+    for start in range(0, len(affected), NEIGHBOURS_BATCH_SIZE):
+        batch = affected[start : start + NEIGHBOURS_BATCH_SIZE]
+        stored = retrieve_neighbours([art_object_id for art_object_id, _, _ in batch])
+        for art_object_id, candidate_ids, candidate_scores in batch:
+            neighbour_ids, similarities = stored[art_object_id]
+            updated.append(
+                (
+                    art_object_id,
+                    *_merge_neighbours(
+                        np.concatenate([np.array(neighbour_ids, dtype=np.int64), candidate_ids]),
+                        np.concatenate([np.array(similarities, dtype=np.float32), candidate_scores]),
+                        size,
+                    ),
+                )
+            )
+    save_all_neighbours(updated)
+    bump_dataset_version()
+    logger.info("Done updating the neighbour graph!")
+
+
+def refresh_knn_graph() -> None:
+    """Merge newly ingested embeddings into the neighbour graph, when a graph was built and lookups are enabled."""
+    if not settings.knn_graph_size or not knn_graph_is_built():
+        return
+    update_knn_graph()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the nearest neighbours of every art object")
+    parser.add_argument(
+        "--incremental", action="store_true", help="Only add art objects that are not in the graph yet"
+    )
+    parser.add_argument("--size", type=int, default=settings.knn_graph_size, help="Neighbours per art object")
+    args = parser.parse_args()
+
+    if args.incremental:
+        update_knn_graph(args.size)
+    else:
+        build_knn_graph(args.size)
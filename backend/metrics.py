@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from enum import StrEnum
+from pathlib import Path
+from time import perf_counter
+from typing import TypeVar
+
+from loguru import logger
+
+# Upper bounds in seconds, from a sub-millisecond cache hit up to a cold model call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Stage(StrEnum):
+    TOKENIZATION = "tokenization"
+    MODEL_FORWARD = "model_forward"
+    DB_QUERY = "db_query"
+    VECTOR_SEARCH = "vector_search"
+    HYDRATION = "hydration"
+    PROJECTION = "projection"
+    SERIALIZATION = "serialization"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonically increasing count per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self) -> dict[tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(snapshots: list[dict[tuple[str, ...], float]]) -> dict[tuple[str, ...], float]:
+        merged: dict[tuple[str, ...], float] = {}
+        for snapshot in snapshots:
+            for label_values, value in snapshot.items():
+                merged[label_values] = merged.get(label_values, 0) + value
+        return merged
+
+    def render(self, snapshot: dict[tuple[str, ...], float] | None = None) -> list[str]:
+        """Render the values of this process, or those of a given, e.g. merged, snapshot."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        values = self.snapshot() if snapshot is None else snapshot
+        for label_values, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed durations per combination of label values, in cumulative buckets.
+
+    Observing is a bisect and a few additions under a lock, cheap enough to leave on in production.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values: the count in each bucket, with a last one for +Inf, and the sum
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(label_values)
+            if counts is None:
+                counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+                self._sums[label_values] = 0.0
+            counts[bucket] += 1
+            self._sums[label_values] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *label_values)
+
+    def snapshot(self) -> dict[tuple[str, ...], tuple[list[int], float]]:
+        with self._lock:
+            return {
+                label_values: (list(counts), self._sums[label_values]) for label_values, counts in self._counts.items()
+            }
+
+    @staticmethod
+    def merge(
+        snapshots: list[dict[tuple[str, ...], tuple[list[int], float]]],
+    ) -> dict[tuple[str, ...], tuple[list[int], float]]:
+        merged: dict[tuple[str, ...], tuple[list[int], float]] = {}
+        for snapshot in snapshots:
+            for label_values, (counts, total) in snapshot.items():
+                if label_values in merged:
+                    merged_counts, merged_total = merged[label_values]
+                    counts = [a + b for a, b in zip(merged_counts, counts, strict=True)]
+                    total += merged_total
+                merged[label_values] = (counts, total)
+        return merged
+
+    def render(self, snapshot: dict[tuple[str, ...], tuple[list[int], float]] | None = None) -> list[str]:
+        """Render the distributions of this process, or those of a given, e.g. merged, snapshot."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        values = self.snapshot() if snapshot is None else snapshot
+
+        for label_values, (counts, total) in values.items():
+            cumulative = 0
+            for upper_bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values, f'le="{upper_bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+Metric = TypeVar("Metric", Counter, Histogram)
+
+
+class Registry:
+    """
+    Metrics exposed in the Prometheus text format, plus collectors that render values owned elsewhere.
+
+    Every process keeps its own metrics. When several processes serve the same API, each can share its
+    metrics through a directory, where it writes a snapshot of them every interval. Rendering then sums the
+    snapshots of all processes, including those that have exited, so counters keep increasing no matter
+    which process answers the scrape. Collectors are still rendered for the answering process only.
+    """
+
+    def __init__(self):
+        self._metrics: list[Counter | Histogram] = []
+        self._collectors: list[Callable[[], list[str]]] = []
+        self._shared_dir: Path | None = None
+        self._stop_sharing = threading.Event()
+        self._sharing_thread: threading.Thread | None = None
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], list[str]]) -> None:
+        self._collectors.append(collector)
+
+    @property
+    def _snapshot_path(self) -> Path:
+        return self._shared_dir / f"{os.getpid()}.json"
+
+    def share(self, directory: Path, interval: float = 1.0) -> None:
+        """Write snapshots of the metrics of this process to `directory` every `interval` seconds."""
+        directory.mkdir(parents=True, exist_ok=True)
+        self._shared_dir = directory
+        self._stop_sharing.clear()
+        self._sharing_thread = threading.Thread(
+            target=self._write_snapshots, args=(interval,), name="metrics-snapshots", daemon=True
+        )
+        self._sharing_thread.start()
+
+    def stop_sharing(self) -> None:
+        """Stop writing snapshots, after writing a last one so nothing that was recorded is lost."""
+        if self._sharing_thread is None:
+            return
+        self._stop_sharing.set()
+        self._sharing_thread.join()
+        self._sharing_thread = None
+        self.write_snapshot()
+
+    def _write_snapshots(self, interval: float) -> None:
+        while not self._stop_sharing.wait(interval):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                logger.warning(f"Could not write the metrics snapshot: {e}")
+
+    def write_snapshot(self) -> None:
+        snapshot = {
+            metric.name: [[list(label_values), value] for label_values, value in metric.snapshot().items()]
+            for metric in self._metrics
+        }
+        # Other processes rendering the metrics never read a partially written snapshot
+        temporary = self._snapshot_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(snapshot))
+        temporary.replace(self._snapshot_path)
+
+    def _read_snapshots(self) -> list[dict]:
+        snapshots = []
+        for path in self._shared_dir.glob("*.json"):
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read the metrics snapshot {path}: {e}")
+        return snapshots
+
+    def render(self) -> str:
+        if self._shared_dir is not None:
+            # This process renders its current values, the others what they wrote last
+            self.write_snapshot()
+            snapshots = self._read_snapshots()
+
+        lines = []
+        for metric in self._metrics:
+            if self._shared_dir is None:
+                lines.extend(metric.render())
+                continue
+            metric_snapshots = [
+                {tuple(label_values): value for label_values, value in snapshot.get(metric.name, [])}
+                for snapshot in snapshots
+            ]
+            lines.extend(metric.render(metric.merge(metric_snapshots)))
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(
+    Histogram("sem_art_search_stage_duration_seconds", "Time spent per stage of handling a request", ("stage",))
+)
+REQUESTS = REGISTRY.register(
+    Counter("sem_art_search_requests_total", "Handled requests", ("method", "route", "status"))
+)
+REQUEST_DURATION = REGISTRY.register(
+    Histogram("sem_art_search_request_duration_seconds", "Time spent handling a request", ("method", "route"))
+)
+
+
+def timed_stage(stage: Stage):
+    """Record how long the wrapped code takes in the histogram of its stage."""
+    return STAGE_DURATION.time(stage)